@@ -6,8 +6,13 @@ Copyright 2015-2017
 Released under the MIT license.
 """
 
-import smbus
+import struct
 import math
+try:
+    import smbus
+except ImportError:
+    # off the Pi: an SMBus-like object must be given to bmp180
+    smbus = None
 from time import sleep
 
 
@@ -15,7 +20,12 @@ class bmp180:
     # Global variables
     address = None
     bus = None
-    mode = 1  # TODO: Add a way to change the mode
+    mode = 1
+
+    # Conversion times from the datasheet: temperature, then pressure for
+    # each oversampling mode (0: ultra low power ... 3: ultra high resolution)
+    TEMP_WAIT_SECONDS = 0.0045
+    PRESSURE_WAIT_SECONDS = (0.0045, 0.0075, 0.0135, 0.0255)
 
     # BMP180 registers
     CONTROL_REG = 0xF4
@@ -34,6 +44,11 @@ class bmp180:
     CAL_MC_REG = 0xBC
     CAL_MD_REG = 0xBE
 
+    # Calibration EEPROM: 11 big-endian words from CAL_AC1_REG, AC4 to AC6 unsigned
+    CAL_FORMAT = ">hhhHHHhhhhh"
+    CAL_NAMES = ("calAC1", "calAC2", "calAC3", "calAC4", "calAC5", "calAC6",
+                 "calB1", "calB2", "calMB", "calMC", "calMD")
+
     # Calibration data variables
     calAC1 = 0
     calAC2 = 0
@@ -48,28 +63,37 @@ class bmp180:
     calMD = 0
 
 
-    def __init__(self, bus, address):
-        self.bus = smbus.SMBus(bus)
+    def __init__(self, bus, address, mode=1, i2c=None):
+        """bus -- the I2C bus number.
+        address -- the I2C address of the sensor.
+        mode -- the pressure oversampling mode, 0 to 3.
+        i2c -- an SMBus-like object to use instead of smbus.SMBus(bus), e.g.
+        a simulated sensor.
+        """
+        self.bus = smbus.SMBus(bus) if i2c is None else i2c
         self.address = address
+        self.set_mode(mode)
 
-        # Get the calibration data from the BMP180
+        # Get the calibration data from the BMP180, always: a sensor swapped at the same address has its own
         self.read_calibration_data()
 
     # I2C methods
 
+    def read_block(self, register, length):
+        """Reads length consecutive registers in one I2C transaction.
+
+        register -- the first register to read from.
+        Returns the read bytes.
+        """
+        return bytes(self.bus.read_i2c_block_data(self.address, register, length))
+
     def read_signed_16_bit(self, register):
         """Reads a signed 16-bit value.
 
         register -- the register to read from.
         Returns the read value.
         """
-        msb = self.bus.read_byte_data(self.address, register)
-        lsb = self.bus.read_byte_data(self.address, register + 1)
-
-        if msb > 127:
-            msb -= 256
-
-        return (msb << 8) + lsb
+        return struct.unpack(">h", self.read_block(register, 2))[0]
 
     def read_unsigned_16_bit(self, register):
         """Reads an unsigned 16-bit value.
@@ -79,26 +103,31 @@ class bmp180:
         register -- the register to read from.
         Returns the read value.
         """
-        msb = self.bus.read_byte_data(self.address, register)
-        lsb = self.bus.read_byte_data(self.address, register + 1)
-
-        return (msb << 8) + lsb
+        return struct.unpack(">H", self.read_block(register, 2))[0]
 
     # BMP180 interaction methods
 
+    def set_mode(self, mode):
+        """Sets the pressure oversampling mode.
+
+        mode -- 0 (1 sample, 4.5 ms) to 3 (8 samples, 25.5 ms).
+        """
+        if mode not in (0, 1, 2, 3):
+            raise ValueError(f"Invalid oversampling mode: {mode}")
+        self.mode = mode
+
+    def set_calibration_data(self, values):
+        """Checks and stores the 11 calibration values, in CAL_NAMES order."""
+        # the datasheet guarantees that no word is 0 or 0xFFFF: anything else is a bus error
+        for name, value in zip(self.CAL_NAMES, values):
+            if value in (0, -1, 0xFFFF):
+                raise ValueError(f"Invalid calibration data: {name}={value}")
+        for name, value in zip(self.CAL_NAMES, values):
+            setattr(self, name, value)
+
     def read_calibration_data(self):
-        """Reads and stores the raw calibration data."""
-        self.calAC1 = self.read_signed_16_bit(self.CAL_AC1_REG)
-        self.calAC2 = self.read_signed_16_bit(self.CAL_AC2_REG)
-        self.calAC3 = self.read_signed_16_bit(self.CAL_AC3_REG)
-        self.calAC4 = self.read_unsigned_16_bit(self.CAL_AC4_REG)
-        self.calAC5 = self.read_unsigned_16_bit(self.CAL_AC5_REG)
-        self.calAC6 = self.read_unsigned_16_bit(self.CAL_AC6_REG)
-        self.calB1 = self.read_signed_16_bit(self.CAL_B1_REG)
-        self.calB2 = self.read_signed_16_bit(self.CAL_B2_REG)
-        self.calMB = self.read_signed_16_bit(self.CAL_MB_REG)
-        self.calMC = self.read_signed_16_bit(self.CAL_MC_REG)
-        self.calMD = self.read_signed_16_bit(self.CAL_MD_REG)
+        """Reads and stores the raw calibration data, in one block read."""
+        self.set_calibration_data(struct.unpack(self.CAL_FORMAT, self.read_block(self.CAL_AC1_REG, 22)))
 
     def get_raw_temp(self):
         """Reads and returns the raw temperature data."""
@@ -106,7 +135,7 @@ class bmp180:
         self.bus.write_byte_data(self.address, self.CONTROL_REG, 0x2E)
 
         # Wait 4,5 ms
-        sleep(0.0045)
+        sleep(self.TEMP_WAIT_SECONDS)
 
         # Read the raw data from the DATA_REG, 0xF6
         raw_data = self.read_unsigned_16_bit(self.DATA_REG)
@@ -119,87 +148,181 @@ class bmp180:
         # Write appropriate data to sensor to start the measurement
         self.bus.write_byte_data(self.address, self.CONTROL_REG, 0x34 + (self.mode << 6))
 
-        # Sleep for 8 ms.
-        # TODO: Way to use the correct wait time for the current mode
-        sleep(0.008)
+        # Wait for the conversion time of the current mode
+        sleep(self.PRESSURE_WAIT_SECONDS[self.mode])
 
-        MSB = self.bus.read_byte_data(self.address, self.DATA_REG)
-        LSB = self.bus.read_byte_data(self.address, self.DATA_REG + 1)
-        XLSB = self.bus.read_byte_data(self.address, self.DATA_REG + 2)
+        MSB, LSB, XLSB = self.read_block(self.DATA_REG, 3)
 
         raw_data = ((MSB << 16) + (LSB << 8) + XLSB) >> (8 - self.mode)
 
         return raw_data
 
-    def get_temp(self):
-        """Reads the raw temperature and calculates the actual temperature.
+    @classmethod
+    def burst_seconds(cls, samples, pressure_mode=None):
+        """Returns the least time a burst of samples readings takes.
 
-        The calculations used to get the actual temperature are from the BMP-180
-        datasheet.
-        Returns the actual temperature in degrees Celcius.
+        pressure_mode -- None for temperature readings, else the oversampling
+        mode of pressure readings.
         """
-        UT = self.get_raw_temp()
+        if pressure_mode is None:
+            return samples * cls.TEMP_WAIT_SECONDS
+        return samples * cls.PRESSURE_WAIT_SECONDS[pressure_mode]
 
-        X1 = 0
-        X2 = 0
-        B5 = 0
-        actual_temp = 0.0
+    def read_raw_burst(self, read_raw, samples):
+        """Takes samples back-to-back raw readings and averages them.
 
-        X1 = ((UT - self.calAC6) * self.calAC5) / math.pow(2, 15)
-        X2 = (self.calMC * math.pow(2, 11)) / (X1 + self.calMD)
-        B5 = X1 + X2
-        actual_temp = ((B5 + 8) / math.pow(2, 4)) / 10
+        read_raw -- the raw reading method, get_raw_temp or get_raw_pressure.
+        samples -- the number of readings.
+        Returns the rounded integer mean and the standard deviation of the
+        readings (the noise estimate), in raw counts.
+        """
+        if samples < 1:
+            raise ValueError(f"Invalid number of samples: {samples}")
+        values = [read_raw() for _ in range(samples)]
+        total = sum(values)
+        mean = (total + samples // 2) // samples
+        variance = (samples * sum(value * value for value in values) - total * total) / (samples * samples)
+        return mean, math.sqrt(max(variance, 0))
+
+    def get_raw_temp_burst(self, samples):
+        """Returns the mean raw temperature over samples readings and its noise."""
+        return self.read_raw_burst(self.get_raw_temp, samples)
+
+    def get_raw_pressure_burst(self, samples):
+        """Returns the mean raw pressure over samples readings and its noise."""
+        return self.read_raw_burst(self.get_raw_pressure, samples)
+
+    def get_temp_burst(self, samples):
+        """Averages samples temperature readings.
+
+        Each reading takes 4.5 ms: more samples trade acquisition time for
+        noise.
+        Returns the temperature in degrees Celcius and the noise estimate
+        (standard deviation of a single reading) in degrees Celcius.
+        """
+        UT, noise = self.get_raw_temp_burst(samples)
+        # B5 is 16 times the temperature in 0.1 degrees and close to linear in UT
+        slope = (self.calc_b5(UT + 256) - self.calc_b5(UT)) / 256 / 160
+        return self.calc_temp(UT), noise * abs(slope)
+
+    def get_temp(self):
+        """Reads the raw temperature and calculates the actual temperature.
 
-        return actual_temp
+        Returns the actual temperature in degrees Celcius.
+        """
+        return self.calc_temp(self.get_raw_temp())
 
     def get_pressure(self):
         """Reads and calculates the actual pressure.
 
         Returns the actual pressure in Pascal.
         """
-        UP = self.get_raw_pressure()
+        return self.get_temp_and_pressure()[1]
+
+    def get_temp_and_pressure(self):
+        """Reads the temperature and the pressure.
+
+        One raw temperature reading is used for both, as the pressure
+        compensation needs it anyway.
+        Returns the temperature in degrees Celcius and the pressure in Pascal.
+        """
         UT = self.get_raw_temp()
-        B3 = 0
-        B4 = 0
-        B5 = 0
-        B6 = 0
-        B7 = 0
-        X1 = 0
-        X2 = 0
-        X3 = 0
-        pressure = 0
-
-        # These calculations are from the BMP180 datasheet, page 15
-
-        # Not sure if these calculations should be here, maybe they could be
-        # removed?
-        X1 = ((UT - self.calAC6) * self.calAC5) / math.pow(2, 15)
-        X2 = (self.calMC * math.pow(2, 11)) / (X1 + self.calMD)
-        B5 = X1 + X2
+        UP = self.get_raw_pressure()
+        return self.calc_temp(UT), self.calc_pressure(UT, UP)
 
-        # Todo: change math.pow cals to constants
-        B6 = B5 - 4000
-        X1 = (self.calB2 * (B6 * B6 / math.pow(2, 12))) / math.pow(2, 11)
-        X2 = self.calAC2 * B6 / math.pow(2, 11)
+    # Compensation, in integer arithmetic exactly as in the BMP180 datasheet
+    # (page 15). Divisions truncate toward zero like in C, shifts are
+    # arithmetic.
+
+    @staticmethod
+    def c_div(a, b):
+        """Integer division truncating toward zero, as in C."""
+        q = abs(a) // abs(b)
+        return q if (a >= 0) == (b >= 0) else -q
+
+    def calc_b5(self, UT):
+        """Returns B5, the temperature term shared by both compensations."""
+        X1 = ((UT - self.calAC6) * self.calAC5) >> 15
+        X2 = self.c_div(self.calMC << 11, X1 + self.calMD)
+        return X1 + X2
+
+    def calc_temp(self, UT):
+        """Calculates the actual temperature from a raw reading.
+
+        Returns the actual temperature in degrees Celcius, with the 0.1
+        degree resolution of the sensor.
+        """
+        return ((self.calc_b5(UT) + 8) >> 4) / 10
+
+    def calc_pressure(self, UT, UP):
+        """Calculates the actual pressure from raw temperature and pressure
+        readings taken with the current mode.
+
+        Returns the actual pressure in Pascal.
+        """
+        B6 = self.calc_b5(UT) - 4000
+        X1 = (self.calB2 * ((B6 * B6) >> 12)) >> 11
+        X2 = (self.calAC2 * B6) >> 11
         X3 = X1 + X2
-        B3 = (((self.calAC1 * 4 + int(X3)) << self.mode) + 2) / 4
-        X1 = self.calAC3 * B6 / math.pow(2, 13)
-        X2 = (self.calB1 * (B6 * B6 / math.pow(2, 12))) / math.pow(2, 16)
-        X3 = ((X1 + X2) + 2) / math.pow(2, 2)
-        B4 = self.calAC4 * (X3 + 32768) / math.pow(2,15)
+        B3 = self.c_div(((self.calAC1 * 4 + X3) << self.mode) + 2, 4)
+        X1 = (self.calAC3 * B6) >> 13
+        X2 = (self.calB1 * ((B6 * B6) >> 12)) >> 16
+        X3 = ((X1 + X2) + 2) >> 2
+        B4 = (self.calAC4 * (X3 + 32768)) >> 15
         B7 = (UP - B3) * (50000 >> self.mode)
 
         if B7 < 0x80000000:
-            pressure = (B7 * 2) / B4
+            pressure = self.c_div(B7 * 2, B4)
         else:
-            pressure = (B7 / B4) * 2
+            pressure = self.c_div(B7, B4) * 2
+
+        X1 = (pressure >> 8) * (pressure >> 8)
+        X1 = (X1 * 3038) >> 16
+        X2 = (-7357 * pressure) >> 16
+        return pressure + ((X1 + X2 + 3791) >> 4)
+
+    def calc_batch(self, UT, UP=None):
+        """Compensates arrays of raw readings at once, e.g. archived samples.
+
+        Same integer arithmetic as calc_temp and calc_pressure, with this
+        sensor's calibration and mode. Needs numpy.
+        UT -- raw temperature readings.
+        UP -- raw pressure readings, paired with UT, or None.
+        Returns the temperatures in degrees Celcius and the pressures in
+        Pascal (None if UP is None), as numpy arrays.
+        """
+        import numpy as np
+
+        def c_div(a, b):
+            q = np.abs(a) // np.abs(b)
+            return np.where((a >= 0) == (b >= 0), q, -q)
+
+        UT = np.asarray(UT, dtype=np.int64)
+        X1 = ((UT - self.calAC6) * self.calAC5) >> 15
+        X2 = c_div(np.int64(self.calMC) << 11, X1 + self.calMD)
+        B5 = X1 + X2
+        temperatures = ((B5 + 8) >> 4) / 10
+        if UP is None:
+            return temperatures, None
+
+        UP = np.asarray(UP, dtype=np.int64)
+        B6 = B5 - 4000
+        X1 = (self.calB2 * ((B6 * B6) >> 12)) >> 11
+        X2 = (self.calAC2 * B6) >> 11
+        X3 = X1 + X2
+        B3 = c_div(((self.calAC1 * 4 + X3) << self.mode) + 2, 4)
+        X1 = (self.calAC3 * B6) >> 13
+        X2 = (self.calB1 * ((B6 * B6) >> 12)) >> 16
+        X3 = ((X1 + X2) + 2) >> 2
+        B4 = (self.calAC4 * (X3 + 32768)) >> 15
+        B7 = (UP - B3) * (50000 >> self.mode)
 
-        X1 = (pressure / math.pow(2, 8)) * (pressure / math.pow(2, 8))
-        X1 = (X1 * 3038) / math.pow(2, 16)
-        X2 = (-7357 * pressure) / math.pow(2, 16)
-        pressure = pressure + (X1 + X2 + 3791) / math.pow(2, 4)
+        pressures = np.where(B7 < 0x80000000, c_div(B7 * 2, B4), c_div(B7, B4) * 2)
 
-        return pressure
+        X1 = (pressures >> 8) * (pressures >> 8)
+        X1 = (X1 * 3038) >> 16
+        X2 = (-7357 * pressures) >> 16
+        return temperatures, pressures + ((X1 + X2 + 3791) >> 4)
 
     def get_altitude(self, sea_level_pressure = 101325):
         """Calulates the altitude.
@@ -1,22 +1,75 @@
 import os
+import glob
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ds18b20:
-    def __init__(self, address, rootdir='/sys/bus/w1/devices/'):
+    # conversion time for each resolution, in seconds
+    CONVERSION_SECONDS = {9: 0.09375, 10: 0.1875, 11: 0.375, 12: 0.75}
+
+    def __init__(self, address, rootdir='/sys/bus/w1/devices/', resolution=None):
         self.address = address
         self.rootdir = rootdir
+        self.device_dir = os.path.join(self.rootdir, "28-" + self.address)
+        # file descriptor kept open between reads: the temperature attribute, or w1_slave on older kernels
+        self.fd = None
+        self.fd_is_temperature = False
+        if resolution is not None:
+            self.set_resolution(resolution)
 
+    @staticmethod
+    def discover(rootdir='/sys/bus/w1/devices/'):
+        # addresses (without the 28- family prefix) of all the ds18b20 probes seen by the kernel
+        return sorted(os.path.basename(path)[3:] for path in glob.glob(os.path.join(rootdir, "28-*")))
 
-    def read_temp_raw(self):
-        device_filepath = os.path.join(self.rootdir, "28-" + self.address, "w1_slave")
+    def get_resolution(self):
+        with open(os.path.join(self.device_dir, "resolution"), "r") as f:
+            return int(f.read().strip())
+
+    def set_resolution(self, resolution):
+        # 9 to 12 bits: each bit less halves the conversion time (0.5 to 0.0625 degree steps)
+        if resolution not in self.CONVERSION_SECONDS:
+            raise ValueError(f"Invalid resolution: {resolution}, expected 9 to 12 bits")
+        with open(os.path.join(self.device_dir, "resolution"), "w") as f:
+            f.write(str(resolution))
+
+    def open(self):
+        temperature_path = os.path.join(self.device_dir, "temperature")
         try:
-            with open(device_filepath, 'r') as f:
-                lines = f.readlines()
-            return lines
-        except:
+            if os.path.exists(temperature_path):
+                self.fd = os.open(temperature_path, os.O_RDONLY)
+                self.fd_is_temperature = True
+            else:
+                self.fd = os.open(os.path.join(self.device_dir, "w1_slave"), os.O_RDONLY)
+                self.fd_is_temperature = False
+        except OSError:
+            self.fd = None
             raise Exception("Unable to load w1 device file: not connected?")
 
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read_device(self):
+        # sysfs regenerates the attribute on each read from offset 0
+        if self.fd is None:
+            self.open()
+        try:
+            data = os.pread(self.fd, 256, 0)
+        except OSError:
+            # device gone: open it again next time
+            self.close()
+            raise Exception("Unable to read w1 device file: not connected?")
+        return data.decode("ascii", errors="replace")
+
+    def read_temp_raw(self):
+        if self.fd is None:
+            self.open()
+        if self.fd_is_temperature:
+            return [self.read_device()]
+        return self.read_device().splitlines(keepends=True)
 
     def read_temp(self):
         # read device file
@@ -24,6 +77,9 @@ class ds18b20:
         # check something was read
         assert lines is not None, "Unable to read device file"
         assert len(lines) > 0, "Device file is empty"
+        if self.fd_is_temperature:
+            # temperature attribute: millidegrees, the kernel already checked the crc
+            return int(lines[0].strip()) / 1000.0
         # check file was read and says status is OK
         assert lines[0].strip()[-3:] == 'YES', "Device file was read but status != YES"
         # read temperature from buffer
@@ -34,10 +90,111 @@ class ds18b20:
         return temp_c
 
 
+class ds18b20_bus:
+    """Reads several ds18b20 probes with one conversion for all of them.
+
+    The probes are told to convert at the same time through the
+    therm_bulk_read attribute of the w1 bus masters, so reading all of them
+    takes one conversion time instead of one per probe. Without bulk read
+    support (older kernels, or no write access), each probe converts on its
+    own read: the probes are then read from one thread each, so that their
+    conversions overlap instead of adding up.
+    """
+
+    def __init__(self, addresses, rootdir='/sys/bus/w1/devices/', sleep=time.sleep):
+        self.rootdir = rootdir
+        # waits for the conversions, can be replaced by a simulated clock
+        self.sleep = sleep
+        self.devices = {address: ds18b20(address=address, rootdir=rootdir) for address in addresses}
+        self.resolution = 12
+        # address -> error of the last read_temps, for the caller to report
+        self.errors = {}
+        # address -> error of the last set_resolution, kept until the resolution is set again: these probes convert at their former one
+        self.config_errors = {}
+        self.executor = None
+
+    def bulk_read_paths(self):
+        return glob.glob(os.path.join(self.rootdir, "w1_bus_master*", "therm_bulk_read"))
+
+    def set_resolution(self, resolution):
+        # not retried on failure (e.g. no write access): the conversion end is polled anyway
+        self.resolution = resolution
+        self.config_errors = {}
+        for address, device in self.devices.items():
+            try:
+                device.set_resolution(resolution)
+            except Exception as error:
+                self.config_errors[address] = error
+
+    def trigger_conversion(self, paths):
+        # paths: the bulk read attributes, polled afterwards for the end of the conversion
+        for path in paths:
+            with open(path, "w") as f:
+                f.write("trigger")
+
+    def wait_conversion(self, paths, timeout_seconds=1.):
+        # therm_bulk_read reads -1 while a conversion is running
+        self.sleep(ds18b20.CONVERSION_SECONDS.get(self.resolution, 0.75))
+        deadline = time.monotonic() + timeout_seconds
+        for path in paths:
+            while True:
+                with open(path, "r") as f:
+                    if f.read().strip() != "-1":
+                        break
+                if time.monotonic() > deadline:
+                    raise Exception(f"Bulk conversion did not end: {path}")
+                self.sleep(0.01)
+
+    def read_temps(self, resolution=None):
+        """Returns {address: temperature, None if the read failed}.
+
+        resolution -- if given and different from the current one, the probes
+        are set to it first.
+
+        If the bulk conversion fails (e.g. therm_bulk_read is only writable by
+        root), the error is kept in errors under the therm_bulk_read path and
+        each probe converts on its own read.
+        """
+        self.errors = {}
+        if resolution is not None and resolution != self.resolution:
+            self.set_resolution(resolution)
+        paths = self.bulk_read_paths()
+        converted = False
+        try:
+            self.trigger_conversion(paths)
+            if paths:
+                self.wait_conversion(paths)
+                converted = True
+        except Exception as error:
+            for path in paths:
+                self.errors[path] = error
+        if converted or len(self.devices) < 2:
+            results = [self.read_probe(device) for device in self.devices.values()]
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=len(self.devices), thread_name_prefix="ds18b20")
+            results = list(self.executor.map(self.read_probe, self.devices.values()))
+        temps = {}
+        for address, (temp, error) in zip(self.devices, results):
+            temps[address] = temp
+            if error is not None:
+                self.errors[address] = error
+        return temps
+
+    @staticmethod
+    def read_probe(device):
+        # (temperature, None) or (None, error)
+        try:
+            return device.read_temp(), None
+        except Exception as error:
+            return None, error
+
+
 if __name__ == "__main__":
     addr1 = "000000bb35e7"
     addr2 = "000000bc51c5"
 
+    print(f"found probes: {ds18b20.discover()}")
     for address in (addr1, addr2):
         # read temps
         print(f"reading temp_c at {address=}")
@@ -49,3 +206,10 @@ if __name__ == "__main__":
             print(f"    {temp_c=} acquired in {tdur:.1f} seconds")
         except Exception as error:
             print(f"    unable to read, {error=}")
+
+    print("reading all probes with one bulk conversion")
+    bus = ds18b20_bus(ds18b20.discover())
+    tstart = time.time()
+    temps = bus.read_temps()
+    tdur = time.time() - tstart
+    print(f"    {temps=} acquired in {tdur:.1f} seconds")
@@ -1,11 +1,20 @@
-import json
 import os
+import re
+import math
 import time
 import argparse
 import sys
 import socket
+import signal
+import json
+import atexit
+import logging
 from datetime import datetime, timedelta
-from gpiozero import LED
+try:
+    from gpiozero import LED
+except ImportError:
+    # off the Pi: only runs with --simulate
+    LED = None
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--mode")
@@ -14,7 +23,10 @@ parser.add_argument("--port")
 parser.add_argument("--clean_db")
 parser.add_argument("--clean_params")
 parser.add_argument("--rundir", default="/home/cav/winec_rundir")
-# sensors and actuators
+# zones: json list of {name, bmp180_bus, bmp180_address, tec_gpio, heatsink_address[, esp_udp_ip, esp_udp_port]},
+# zones.json in the rundir by default; without it, the left and right zones below
+parser.add_argument("--zones_file")
+# sensors and actuators of the left and right zones
 parser.add_argument("--left_bmp180_bus", default=1)
 parser.add_argument("--left_bmp180_address", default=0x77)
 parser.add_argument("--right_bmp180_bus", default=4)
@@ -31,137 +43,537 @@ parser.add_argument("--db_port", default=3306)
 parser.add_argument("--db_user", default="cav")
 parser.add_argument("--db_password", default="caveavin")
 parser.add_argument("--db_database", default="winec")
+parser.add_argument("--db_buffer_max_rows", default=8640)
+parser.add_argument("--db_partitioning", default="none")  # "daily" partitions measurements by day (mariadb only)
+# latest cycles kept in measurements.ring in the rundir, read by the dashboard without a query, 0 to disable
+parser.add_argument("--ring_cycles", default=8640)
+# simulation: fake sensors and tecs driven by a thermal model, no hardware needed
+parser.add_argument("--simulate")
+parser.add_argument("--sim_speed", default=1)  # simulated seconds per real second
+# prometheus metrics at http://metrics_host:metrics_port/metrics, 0 to disable; local only by default, as /events serves the
+# recent log: e.g. --metrics_host 0.0.0.0 to let a prometheus server on another machine scrape it
+parser.add_argument("--metrics_host", default="127.0.0.1")
+parser.add_argument("--metrics_port", default=9110)
+# log file in the rundir, rotated by size
+parser.add_argument("--log_max_bytes", default=1000000)
+parser.add_argument("--log_backup_count", default=5)
 args = parser.parse_args()
 
+os.makedirs(args.rundir, exist_ok=True)
+
+root_dir = os.path.split(sys.argv[0])[0]
+sys.path.append(root_dir)
+from winec_log import structured_logger
+
+# the control loop only queues its messages: a slow stdout or journald cannot stall it
+logger = structured_logger("winec_backend", path=os.path.join(args.rundir, "winec_backend.log"),
+                           max_bytes=int(args.log_max_bytes), backup_count=int(args.log_backup_count))
+
 
 def now():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
-def log(s):
-    print(f"{now()}    {s}")
+def log(s, level=logging.INFO, key=None, **fields):
+    # the same message (or key) is logged at most a few times a minute
+    logger.log(s, level=level, key=key, **fields)
 
 
 log(f"running at {args.rundir}")
 
-os.makedirs(args.rundir, exist_ok=True)
-log(f"running at {args.rundir}")
-
 if args.db_platform == "sqlite3":
     log("running with sqlite3")
-    import sqlite3
 elif args.db_platform == "mariadb":
     log("running with mariadb")
-    import mariadb
 
-root_dir = os.path.split(sys.argv[0])[0]
-log(f"appending {root_dir} to sys path")
-sys.path.append(root_dir)
+log(f"appended {root_dir} to sys path")
 log(f"importing bmp180 library")
 from bmp180 import bmp180
 log(f"importing ds18b20 library")
-from ds18b20 import ds18b20
+from ds18b20 import ds18b20, ds18b20_bus
+log(f"importing winec_db library")
+from winec_db import (db_connection_manager, measurement_buffer, measurement_spool, retention_manager, rollup_manager, to_wall_seconds, from_wall_seconds,
+                      to_centi, CENTI, TEC_STATUS_FLAG, TEC_ON_CD_FLAG, EVENT_CODES)
+log(f"importing winec_io library")
+from winec_io import io_stage, sensor_acquisition
+log(f"importing winec_scheduler library")
+from winec_scheduler import deadline_scheduler
+log(f"importing winec_settings library")
+from winec_settings import settings_cache, check_params
+log(f"importing winec_sim library")
+from winec_sim import simulator, system_clock
+log(f"importing winec_metrics library")
+from winec_metrics import metrics_registry, metrics_server
+log(f"importing winec_ring library")
+from winec_ring import measurement_ring
 
 
-def run_db_query_mariadb(query, query_args=None):
-    try:
-        conn = mariadb.connect(
-            host=args.db_host,
-            port=args.db_port,
-            user=args.db_user,
-            passwd=args.db_password,
-            database=args.db_database
-        )
-    except mariadb.Error as error:
-        log("Error connecting to MariaDB Platform")
-        log(f"{error=}")
+def default_zones():
+    # the two zones of the original cabinet, from the command line options
+    return [{"name": "left", "bmp180_bus": args.left_bmp180_bus, "bmp180_address": args.left_bmp180_address, "tec_gpio": args.left_tec_gpio,
+             "heatsink_address": args.left_heatsink_temp_address, "esp_udp_ip": "192.168.1.2", "esp_udp_port": 4210},
+            {"name": "right", "bmp180_bus": args.right_bmp180_bus, "bmp180_address": args.right_bmp180_address, "tec_gpio": args.right_tec_gpio,
+             "heatsink_address": args.right_heatsink_temp_address, "esp_udp_ip": "192.168.1.32", "esp_udp_port": 4210}]
+
+
+def load_zones():
+    # zone name -> zone, in the order of the file
+    path = args.zones_file or os.path.join(args.rundir, "zones.json")
+    if args.zones_file is None and not os.path.exists(path):
+        zone_list = default_zones()
+    else:
+        with open(path, "r") as f:
+            zone_list = json.load(f)
+    zones = {}
+    for zone in zone_list:
+        missing = [key for key in ("name", "bmp180_bus", "bmp180_address", "tec_gpio", "heatsink_address") if key not in zone]
+        if missing:
+            raise ValueError(f"zone {zone} lacks {', '.join(missing)}")
+        # names are settings keys, metric labels and database values
+        if not re.fullmatch(r"[a-z][a-z0-9_]{0,31}", zone["name"]) or zone["name"] in ("zones", "heatsinks"):
+            raise ValueError(f"invalid zone name: {zone['name']}")
+        if zone["name"] in zones:
+            raise ValueError(f"duplicate zone name: {zone['name']}")
+        zones[zone["name"]] = dict({"esp_udp_ip": None, "esp_udp_port": 4210}, **zone)
+    if len(zones) == 0:
+        raise ValueError(f"no zones in {path}")
+    return zones
+
+
+zones = load_zones()
+log(f"running with zones {', '.join(zones)}")
+
+# clock of the backend: simulated time runs faster than real time
+sim = None
+clock = system_clock()
+if args.simulate is not None:
+    log(f"running on simulated hardware at {args.sim_speed}x speed")
+    sim = simulator(list(zones), {name: zone["heatsink_address"] for name, zone in zones.items()},
+                    w1_rootdir=os.path.join(args.rundir, "sim_w1"), speed=float(args.sim_speed))
+    clock = sim.clock
+    args.w1_rootdir = sim.w1_rootdir
+
+# metrics: histograms and counters are updated in place (a lock and a few additions), the rest is read at scrape time
+metrics = metrics_registry()
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+metric_job_duration = metrics.histogram("winec_job_duration_seconds", "Duration of the scheduled jobs (control cycle, udp, retention)", SECONDS_BUCKETS, ("job", ))
+metric_job_lateness = metrics.histogram("winec_job_lateness_seconds", "Delay between the deadline and the start of the scheduled jobs", SECONDS_BUCKETS, ("job", ))
+metric_sensor_read = metrics.histogram("winec_sensor_read_seconds", "Duration of the sensor reads", SECONDS_BUCKETS, ("sensor", ))
+metric_sensor_failures = metrics.counter("winec_sensor_failures_total", "Sensor reads that failed, timed out or were skipped", ("sensor", ))
+metric_db_query = metrics.histogram("winec_db_query_seconds", "Duration of the database queries", SECONDS_BUCKETS)
+metrics.counter("winec_db_query_failures_total", "Failed database queries", collect=lambda: {(): db.counters["query_failures"]})
+metrics.gauge("winec_db_buffered_rows", "Measurements waiting to be written", collect=lambda: {(): len(measurements_buffer.rows)})
+metrics.gauge("winec_db_spooled_rows", "Measurements spooled to disk while the database was down", collect=lambda: {(): len(measurements_spool)})
+metric_udp_errors = metrics.counter("winec_udp_send_errors_total", "UDP messages that could not be sent", ("zone", ))
+metric_security_shutdowns = metrics.counter("winec_security_shutdowns_total", "Security shutdowns of the tecs")
+# filled with the tec instances at startup
+tecs = {}
+metrics.counter("winec_tec_switches_total", "TEC switches", ("zone", "state"),
+                collect=lambda: {(zone, state): tec.switches[state == "on"] for zone, tec in tecs.items() for state in ("on", "off")})
+metrics.counter("winec_tec_on_seconds_total", "Time the TEC has been on", ("zone", ), collect=lambda: {(zone, ): tec.on_seconds() for zone, tec in tecs.items()})
+metrics.gauge("winec_tec_duty_cycle", "Fraction of time the TEC has been on since startup", ("zone", ), collect=lambda: {(zone, ): tec.duty_cycle() for zone, tec in tecs.items()})
+metrics.gauge("winec_tec_on", "Whether the TEC is on", ("zone", ), collect=lambda: {(zone, ): tec.status for zone, tec in tecs.items()})
+metrics.counter("winec_log_dropped_total", "Log records dropped because the log queue was full", collect=lambda: {(): logger.dropped()})
+
+
+def observe_job(name, lateness, duration):
+    metric_job_lateness.observe(lateness, name)
+    metric_job_duration.observe(duration, name)
+
+
+def db_connect_kwargs():
+    if args.db_platform == "sqlite3":
+        return dict(database=os.path.join(args.rundir, "winec_db_v1.db"), timeout=10)
+    if args.db_platform == "mariadb":
+        return dict(host=args.db_host, port=int(args.db_port), user=args.db_user, passwd=args.db_password,
+                    database=args.db_database, connect_timeout=5)
+    return None
+
+
+# one connection for the whole process, reopened with backoff when lost
+db = db_connection_manager(args.db_platform, db_connect_kwargs(), log=log, on_query=metric_db_query.observe)
+
+
+def run_db_query(query, query_args=None):
+    return db.execute(query, query_args)
+
+
+# measurement rows as buffered, spooled and rolled up: one row per zone and cycle (long format)
+MEASUREMENT_COLUMNS = ("time", "event", "zone", "temperature", "target", "limithi", "limitlo", "heatsink_temperature", "tec_status", "tec_on_cd")
+# stored compactly, see db_write_measurements: zone_samples holds the readings of each cycle, keyed by integer time
+# (wall clock seconds) and zone id; zone_events holds the setpoints, written only when they change, and the startups
+INSERT_IGNORE = "INSERT OR IGNORE" if args.db_platform == "sqlite3" else "INSERT IGNORE"
+SAMPLE_COLUMNS = ("time", "zone_id", "temperature", "heatsink_temperature", "tec_flags")
+SAMPLE_INSERT_QUERY = f"{INSERT_IGNORE} INTO zone_samples ({', '.join(SAMPLE_COLUMNS)}) VALUES ({', '.join(['?'] * len(SAMPLE_COLUMNS))})"
+EVENT_COLUMNS = ("time", "zone_id", "event", "target", "limithi", "limitlo")
+EVENT_INSERT_QUERY = f"{INSERT_IGNORE} INTO zone_events ({', '.join(EVENT_COLUMNS)}) VALUES ({', '.join(['?'] * len(EVENT_COLUMNS))})"
+# the tables of the former versions, copied to the compact tables once, then dropped: table, query reading measurement rows, and the
+# name under which the previous versions kept the copied table
+LEGACY_MEASUREMENT_TABLES = (
+    # two-zone versions, one wide row per cycle
+    ("temperature_measurements",
+     "SELECT * FROM (" + " UNION ALL ".join(
+         f"SELECT time, event, '{side}' AS zone, {side}_temperature, {side}_target, {side}_limithi, {side}_limitlo, {side}_heatsink_temperature, "
+         f"{side}_tec_status, {side}_tec_on_cd FROM temperature_measurements" for side in ("left", "right")) + ") AS m",
+     "temperature_measurements_2zones"),
+    # one row per zone and cycle, with FLOAT temperatures and setpoints
+    ("zone_measurements", f"SELECT {', '.join(MEASUREMENT_COLUMNS)} FROM zone_measurements", "zone_measurements_float"),
+)
+
+# 1 minute, 15 minutes and 1 hour summaries of the measurements of each zone, for the long dashboard views
+rollups = rollup_manager(db, MEASUREMENT_COLUMNS,
+                         minmax_columns=["temperature", "heatsink_temperature"],
+                         sum_columns=["target", "limithi", "limitlo", "tec_status", "tec_on_cd"],
+                         key_columns=["zone"], table_prefix="zone_rollup", log=log)
+
+
+def db_update_rollups(rows):
+    if not rollups.update(rows):
+        log("unable to update rollups")
+
+
+def db_read_measurements(dt_start, dt_end):
+    """Reads the measurement rows (MEASUREMENT_COLUMNS) with dt_start <= time < dt_end back from zone_samples and zone_events.
+
+    Returns None if the database failed. Entries get the setpoints in force
+    at their time, as written by db_write_measurements, with the values
+    stored (hundredths of a degree).
+    """
+    start, end = to_wall_seconds(dt_start), to_wall_seconds(dt_end)
+    samples = db.fetch(f"SELECT {', '.join(SAMPLE_COLUMNS)} FROM zone_samples WHERE time >= ? AND time < ? ORDER BY time", (start, end))
+    # the events of the range, and the last setpoints of each zone before it
+    events = db.fetch(f"SELECT {', '.join(EVENT_COLUMNS)} FROM zone_events e WHERE time < ? AND (time >= ? OR (event = {EVENT_CODES['setpoint']} AND time = "
+                      f"(SELECT MAX(time) FROM zone_events WHERE zone_id = e.zone_id AND event = {EVENT_CODES['setpoint']} AND time < ?))) ORDER BY time",
+                      (end, start, start))
+    if samples is None or events is None:
+        return None
+    # zones not loaded in zone_ids (no longer configured) are left out: their buckets are not replaced
+    zone_names = {zone_id: name for name, zone_id in zone_ids.items()}
+    no_values = [None] * (len(MEASUREMENT_COLUMNS) - 3)
+    rows = [(from_wall_seconds(event_time), "startup", zone_names[zone_id], *no_values)
+            for event_time, zone_id, code, *values in events if code == EVENT_CODES["startup"] and zone_id in zone_names]
+    changes = [event for event in events if event[2] == EVENT_CODES["setpoint"]]
+    setpoints, next_change = {}, 0
+    for sample_time, zone_id, temperature, heatsink_temperature, tec_flags in samples:
+        # setpoints written at the time of a sample apply to it
+        while next_change < len(changes) and changes[next_change][0] <= sample_time:
+            setpoints[changes[next_change][1]] = [value / CENTI for value in changes[next_change][3:]]
+            next_change += 1
+        if zone_id not in zone_names:
+            continue
+        rows.append((from_wall_seconds(sample_time), "entry", zone_names[zone_id],
+                     None if temperature is None else temperature / CENTI, *setpoints.get(zone_id, [None] * 3),
+                     None if heatsink_temperature is None else heatsink_temperature / CENTI,
+                     bool(tec_flags & TEC_STATUS_FLAG), bool(tec_flags & TEC_ON_CD_FLAG)))
+    return rows
+
+
+def db_rebuild_rollups(rows):
+    # replayed rows may have been written (and added to the rollups) before: their buckets are computed again from the raw rows
+    if not rollups.rebuild(rows, db_read_measurements):
+        log("unable to rebuild rollups")
         return False
+    return True
 
-    cur = conn.cursor()
 
-    try:
-        if query_args is None:
-            cur.execute(query)
-        else:
-            cur.execute(query, query_args)
-    except mariadb.Error as error:
-        log("Error executing query in MariaDB database")
-        log(f"{error=}")
+# old samples are removed in chunks by a separate, less frequent job, see db_clean; the primary key starts with the time
+# events are few (setpoint changes and startups) and are kept, so the oldest samples still find their setpoints
+measurements_retention = retention_manager(db, "zone_samples", partitioned=args.db_partitioning == "daily", wall_seconds=True,
+                                           row_key="time, zone_id", time_index=False, log=log)
+rollups_retention = {name: retention_manager(db, rollups.table(name), time_column="bucket", log=log) for name, seconds in rollups.resolutions}
+
+# zone name -> zone_id in zone_names: samples and events refer to zones by id
+zone_ids = {}
+# zone -> (time, setpoints) of the newest setpoints written, see db_write_measurements
+written_setpoints = {}
+
+
+def db_load_zone_ids(names):
+    # adds the zones never seen before to zone_names, then reads all ids
+    if all(name in zone_ids for name in names):
+        return True
+    rows = db.fetch("SELECT name, zone_id FROM zone_names")
+    if rows is None:
+        return False
+    zone_ids.update(rows)
+    new_names = [(name, ) for name in sorted(names) if name not in zone_ids]
+    if len(new_names) == 0:
+        return True
+    if not db.execute(f"{INSERT_IGNORE} INTO zone_names (name) VALUES (?)", new_names, many=True):
         return False
+    rows = db.fetch("SELECT name, zone_id FROM zone_names")
+    if rows is None:
+        return False
+    zone_ids.update(rows)
+    return True
+
+
+def db_write_measurements(rows):
+    """Writes measurement rows (MEASUREMENT_COLUMNS) to zone_samples and zone_events. Returns True on success.
 
-    conn.commit()
-    conn.close()
+    The setpoints of an entry are written only when they differ from those of
+    the previous entry of its zone. Rows older than the newest ones written
+    (replayed from the spool) are only compared with each other, so the
+    setpoints in force at their time are written again. Inserts ignore rows
+    already there, so a batch written twice is harmless.
+    """
+    if not db_load_zone_ids({row[2] for row in rows}):
+        return False
+    samples, events = [], []
+    previous, newest = {}, {}
+    for row in rows:
+        row_time, event, zone = to_wall_seconds(db.parse_time(row[0])), row[1], row[2]
+        if event == "startup":
+            events.append((row_time, zone_ids[zone], EVENT_CODES["startup"], None, None, None))
+            continue
+        setpoints = tuple(to_centi(value) for value in row[4:7])
+        if zone in previous:
+            reference = previous[zone]
+        else:
+            written = written_setpoints.get(zone)
+            reference = written[1] if written is not None and row_time >= written[0] else None
+        if setpoints != reference:
+            events.append((row_time, zone_ids[zone], EVENT_CODES["setpoint"], *setpoints))
+        previous[zone] = setpoints
+        if zone not in newest or row_time >= newest[zone][0]:
+            newest[zone] = (row_time, setpoints)
+        tec_flags = (TEC_STATUS_FLAG if row[8] else 0) | (TEC_ON_CD_FLAG if row[9] else 0)
+        samples.append((row_time, zone_ids[zone], to_centi(row[3]), to_centi(row[7]), tec_flags))
+    if len(samples) > 0 and not db.execute(SAMPLE_INSERT_QUERY, samples, many=True):
+        return False
+    if len(events) > 0 and not db.execute(EVENT_INSERT_QUERY, events, many=True):
+        return False
+    for zone, (row_time, setpoints) in newest.items():
+        if zone not in written_setpoints or row_time >= written_setpoints[zone][0]:
+            written_setpoints[zone] = (row_time, setpoints)
     return True
 
 
-def run_db_query_sqlite3(query):
-    try:
-        connection = sqlite3.connect(os.path.join(args.rundir, "winec_db_v1.db"), timeout=10)
-        cursor = connection.cursor()
-        cursor.execute(query)
-        connection.commit()
-        connection.close()
-    except Exception as error:
-        log(f"{error=}")
+def db_table_exists(table):
+    if args.db_platform == "sqlite3":
+        rows = db.fetch("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table, ))
+    else:
+        rows = db.fetch("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?", (table, ))
+    return None if rows is None else len(rows) > 0
+
+
+def db_migrate_measurements(table, select_query, archive_table, chunk_rows=10000):
+    # copies the rows of a former table in time order, chunk by chunk, checks that every entry is in zone_samples, then drops it
+    # the copy kept by the previous versions is dropped too: they renamed the table only once every chunk was written
+    exists = db_table_exists(archive_table)
+    if exists is None:
+        return False
+    if exists:
+        log(f"dropping {archive_table}, already copied to zone_samples and zone_events")
+        if not run_db_query(f"DROP TABLE {archive_table}"):
+            return False
+    exists = db_table_exists(table)
+    if exists is None:
+        return False
+    if not exists:
+        return True
+    # the rollups of the two-zone versions had another layout: build them along, unless copied from the former rollups
+    count = db.fetch(f"SELECT COUNT(*) FROM {rollups.tables()[0]}")
+    if count is None:
+        return False
+    build_rollups = count[0][0] == 0
+    log(f"copying {table} to zone_samples and zone_events")
+    # paged on time rather than with OFFSET: the rows of the last time of a chunk are read again with the next one
+    lower_time, copied, copied_zones = None, 0, set()
+    while True:
+        where = "" if lower_time is None else " WHERE time >= ?"
+        rows = db.fetch(f"{select_query}{where} ORDER BY time LIMIT {chunk_rows}", None if lower_time is None else (lower_time, ))
+        if rows is None:
+            return False
+        if len(rows) == chunk_rows and rows[-1][0] != rows[0][0]:
+            lower_time = rows[-1][0]
+            rows = [row for row in rows if row[0] != lower_time]
+        else:
+            lower_time = None
+        if not db_write_measurements(rows) or (build_rollups and not rollups.update(rows)):
+            return False
+        copied += len(rows)
+        copied_zones.update(row[2] for row in rows)
+        if lower_time is None:
+            break
+    # every (time, zone) of an entry must now be a sample: the table goes only then
+    expected = db.fetch(f"SELECT COUNT(*), MIN(time), MAX(time) FROM (SELECT DISTINCT time, zone FROM ({select_query}) AS l WHERE event = 'entry') AS d")
+    if expected is None:
         return False
+    n_expected, min_time, max_time = expected[0]
+    n_samples = 0
+    if n_expected > 0:
+        zone_id_list = ", ".join(str(zone_ids[zone]) for zone in copied_zones)
+        found = db.fetch(f"SELECT COUNT(*) FROM zone_samples WHERE time >= ? AND time <= ? AND zone_id IN ({zone_id_list})",
+                         (to_wall_seconds(db.parse_time(min_time)), to_wall_seconds(db.parse_time(max_time))))
+        if found is None:
+            return False
+        n_samples = found[0][0]
+    if n_samples < n_expected:
+        log(f"copied {copied} measurements, but only {n_samples} of the {n_expected} entries of {table} are in zone_samples: "
+            f"keeping it as {table}_unverified", level=logging.WARNING)
+        return run_db_query(f"ALTER TABLE {table} RENAME TO {table}_unverified")
+    log(f"copied {copied} measurements, dropping {table}")
+    return run_db_query(f"DROP TABLE {table}")
+
+
+def db_migrate_rollups():
+    # the rollups of the two-zone versions, one wide row per bucket, copied once for each zone: they hold the history older than
+    # the raw measurements kept; buckets already in the zone rollups are kept
+    for name, seconds in rollups.resolutions:
+        table = f"temperature_rollup_{name}"
+        exists = db_table_exists(table)
+        if exists is None:
+            return False
+        if not exists:
+            continue
+        log(f"copying {table} to {rollups.table(name)}")
+        for side in ("left", "right"):
+            columns = [column if column.startswith("n_") else f"{side}_{column}" for column in rollups.rollup_columns]
+            if not run_db_query(f"{INSERT_IGNORE} INTO {rollups.table(name)} (bucket, zone, {', '.join(rollups.rollup_columns)}) "
+                                f"SELECT bucket, '{side}', {', '.join(columns)} FROM {table}"):
+                return False
+        if not run_db_query(f"DROP TABLE {table}"):
+            return False
     return True
 
 
 def init_db():
     if args.db_platform == "sqlite3":
-        query = "CREATE TABLE IF NOT EXISTS temperature_measurements (time TEXT, event TEXT, left_temperature FLOAT, left_target FLOAT, left_limithi FLOAT, left_limitlo FLOAT, left_heatsink_temperature FLOAT, right_temperature FLOAT, right_target FLOAT, right_limithi FLOAT, right_limitlo FLOAT, right_heatsink_temperature FLOAT, left_tec_status BOOLEAN, right_tec_status BOOLEAN, left_tec_on_cd BOOLEAN, right_tec_on_cd BOOLEAN)"
-        return run_db_query_sqlite3(query)
-    if args.db_platform == "mariadb":
-        query = "CREATE TABLE IF NOT EXISTS temperature_measurements (time DATETIME, event TEXT, left_temperature FLOAT, left_target FLOAT, left_limithi FLOAT, left_limitlo FLOAT, left_heatsink_temperature FLOAT, right_temperature FLOAT, right_target FLOAT, right_limithi FLOAT, right_limitlo FLOAT, right_heatsink_temperature FLOAT, left_tec_status BOOLEAN, right_tec_status BOOLEAN, left_tec_on_cd BOOLEAN, right_tec_on_cd BOOLEAN)"
-        return run_db_query_mariadb(query)
-    log(f"Unknown {args.db_platform=}")
-    return False
+        # WITHOUT ROWID: the rows are stored in the primary key, with no separate index
+        queries = ["CREATE TABLE IF NOT EXISTS zone_names (zone_id INTEGER PRIMARY KEY, name VARCHAR(32) NOT NULL UNIQUE)",
+                   "CREATE TABLE IF NOT EXISTS zone_samples (time INTEGER NOT NULL, zone_id INTEGER NOT NULL, temperature SMALLINT, "
+                   "heatsink_temperature SMALLINT, tec_flags TINYINT NOT NULL, PRIMARY KEY (time, zone_id)) WITHOUT ROWID",
+                   "CREATE TABLE IF NOT EXISTS zone_events (time INTEGER NOT NULL, zone_id INTEGER NOT NULL, event TINYINT NOT NULL, "
+                   "target SMALLINT, limithi SMALLINT, limitlo SMALLINT, PRIMARY KEY (zone_id, event, time)) WITHOUT ROWID"]
+    elif args.db_platform == "mariadb":
+        # InnoDB stores the rows in the primary key
+        queries = ["CREATE TABLE IF NOT EXISTS zone_names (zone_id SMALLINT UNSIGNED AUTO_INCREMENT PRIMARY KEY, name VARCHAR(32) NOT NULL UNIQUE)",
+                   "CREATE TABLE IF NOT EXISTS zone_samples (time INT UNSIGNED NOT NULL, zone_id SMALLINT UNSIGNED NOT NULL, temperature SMALLINT, "
+                   "heatsink_temperature SMALLINT, tec_flags TINYINT UNSIGNED NOT NULL, PRIMARY KEY (time, zone_id))",
+                   "CREATE TABLE IF NOT EXISTS zone_events (time INT UNSIGNED NOT NULL, zone_id SMALLINT UNSIGNED NOT NULL, event TINYINT UNSIGNED NOT NULL, "
+                   "target SMALLINT, limithi SMALLINT, limitlo SMALLINT, PRIMARY KEY (zone_id, event, time))"]
+    else:
+        log(f"Unknown {args.db_platform=}")
+        return False
+    return (all(run_db_query(query) for query in queries) and db_load_zone_ids(zones) and measurements_retention.setup() and rollups.setup()
+            and db_migrate_rollups() and all(db_migrate_measurements(*legacy) for legacy in LEGACY_MEASUREMENT_TABLES))
 
 
 def clear_db():
-    if args.db_platform == "sqlite3":
-        query = "DROP TABLE IF EXISTS temperature_measurements"
-        return run_db_query_sqlite3(query)
-    if args.db_platform == "mariadb":
-        query = "DROP TABLE IF EXISTS temperature_measurements"
-        return run_db_query_mariadb(query)
-    log(f"Unknown {args.db_platform=}")
-    return False
+    # with the tables of the former versions
+    legacy_tables = [table for legacy in LEGACY_MEASUREMENT_TABLES for table in (legacy[0], legacy[2], f"{legacy[0]}_unverified")]
+    legacy_tables += [f"temperature_rollup_{name}" for name, seconds in rollups.resolutions]
+    for table in ["zone_samples", "zone_events", "zone_names"] + rollups.tables() + legacy_tables:
+        if not run_db_query(f"DROP TABLE IF EXISTS {table}"):
+            return False
+    zone_ids.clear()
+    written_setpoints.clear()
+    return True
 
 
 def db_clean(days_old_filter: int):
-    if args.db_platform == "mariadb":
-        dt_max_date_keep = (datetime.now() - timedelta(days=days_old_filter)).strftime('%Y-%m-%d %H:%M:%S')
-        query = f"DELETE FROM temperature_measurements WHERE time < '{dt_max_date_keep}'"
-        return run_db_query_mariadb(query)
-    log(f"Unknown {args.db_platform=}")
-    return False
+    dt_max_date_keep = clock.now() - timedelta(days=days_old_filter)
+    deleted = measurements_retention.run(dt_max_date_keep)
+    if deleted is None:
+        log("unable to clean old measurements")
+        return False
+    if deleted > 0:
+        log(f"removed {deleted} measurements older than {days_old_filter} days")
+    return True
+
+
+def db_clean_rollups(days_old_filters: dict):
+    for resolution_name, retention in rollups_retention.items():
+        days_old_filter = days_old_filters[resolution_name]
+        if retention.run(clock.now() - timedelta(days=days_old_filter)) is None:
+            log(f"unable to clean {resolution_name} rollups")
+            return False
+    return True
+
+
+# spooled measurements: time, event, zone, 5 temperatures/setpoints as float32, 2 tec flags
+SPOOL_RECORD_FORMAT = "<dB32s5f2B"
+SPOOL_EVENTS = ("entry", "startup")
+
+
+def spool_encode(row):
+    dt = db.parse_time(row[0])
+    values = [math.nan if value is None else value for value in row[3:8]]
+    return (dt.timestamp(), SPOOL_EVENTS.index(row[1]), row[2].encode("ascii"), *values, *[bool(flag) for flag in row[8:10]])
+
+
+def spool_decode(record):
+    values = [None if math.isnan(value) else value for value in record[3:8]]
+    return (db_time(datetime.fromtimestamp(record[0])), SPOOL_EVENTS[record[1]], record[2].rstrip(b"\0").decode("ascii"), *values,
+            *[bool(flag) for flag in record[8:10]])
+
+
+# measurements that cannot reach the database are kept on disk until it comes back
+# (a new file: the records of measurements.spool, from the two-zone versions, have another layout)
+if os.path.exists(os.path.join(args.rundir, "measurements.spool")):
+    log("measurements.spool was written by a two-zone version and will not be replayed", level=logging.WARNING)
+measurements_spool = measurement_spool(os.path.join(args.rundir, "zone_measurements.spool"), SPOOL_RECORD_FORMAT, spool_encode, spool_decode, log=log)
+# measurements are written in batches, see db_flush_measurements; one row per zone and cycle
+measurements_buffer = measurement_buffer(db, db_write_measurements, max_rows=int(args.db_buffer_max_rows) * len(zones), spool=measurements_spool, on_written=db_update_rollups, log=log)
+
+
+# the latest cycles are also in a memory-mapped file, for the dashboard: written at every cycle, with no system call
+measurements_ring = None
+if int(args.ring_cycles) > 0:
+    measurements_ring = measurement_ring(os.path.join(args.rundir, "measurements.ring"), zones=list(zones), capacity=int(args.ring_cycles))
+
+# database writes, retention and udp run in background threads so the control loop keeps its cadence
+io_jobs = io_stage(lanes=("db", "udp"), log=log)
+
+
+def db_time(dt=None):
+    if dt is None:
+        dt = clock.now()
+    return db.format_time(dt)
 
 
 def db_store_startup():
-    if args.db_platform == "sqlite3":
-        query = f"INSERT INTO temperature_measurements VALUES ('{now()}', 'startup', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, false, false, false, false)"
-        return run_db_query_sqlite3(query)
-    if args.db_platform == "mariadb":
-        query = f"INSERT INTO temperature_measurements (time, event, left_temperature, left_target, left_limithi, left_limitlo, left_heatsink_temperature, right_temperature, right_target, right_limithi, right_limitlo, right_heatsink_temperature, left_tec_status, right_tec_status, left_tec_on_cd, right_tec_on_cd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        query_args = (datetime.now(), 'startup', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, False, False, False, False)
-        return run_db_query_mariadb(query, query_args)
-    log(f"Unknown {args.db_platform=}")
-    return False
+    # one startup row per zone, so that each zone can be read on its own
+    startup_dt = clock.now()
+    startup_time = db_time(startup_dt)
+    if measurements_ring is not None:
+        measurements_ring.append(to_wall_seconds(startup_dt), event="startup")
+    query_args = [(startup_time, 'startup', zone, None, None, None, None, None, False, False) for zone in zones]
+    if not db_write_measurements(query_args):
+        return False
+    db_update_rollups(query_args)
+    return True
 
 
-def db_store_measurements(left_temp, left_target, left_limithi, left_limitlo, left_heatsink_temp, right_temp, right_target, right_limithi, right_limitlo, right_heatsink_temp, left_tec_status, right_tec_status, left_tec_on_cd, right_tec_on_cd):
-    if args.db_platform == "sqlite3":
-        query = f"INSERT INTO temperature_measurements VALUES ('{now()}', 'entry', {left_temp:.2f}, {left_target:.2f}, {left_limithi:.2f}, {left_limitlo:.2f}, {left_heatsink_temp:.2f}, {right_temp:.2f}, {right_target:.2f}, {right_limithi:.2f}, {right_limitlo:.2f}, {right_heatsink_temp:.2f}, {left_tec_status:b}, {right_tec_status:b}, {left_tec_on_cd:b}, {right_tec_on_cd:b})"
-        return run_db_query_sqlite3(query)
-    if args.db_platform == "mariadb":
-        query = f"INSERT INTO temperature_measurements (time, event, left_temperature, left_target, left_limithi, left_limitlo, left_heatsink_temperature, right_temperature, right_target, right_limithi, right_limitlo, right_heatsink_temperature, left_tec_status, right_tec_status, left_tec_on_cd, right_tec_on_cd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        query_args = (datetime.now(), 'entry', left_temp, left_target, left_limithi, left_limitlo, left_heatsink_temp, right_temp, right_target, right_limithi, right_limitlo, right_heatsink_temp, left_tec_status, right_tec_status, left_tec_on_cd, right_tec_on_cd)
-        return run_db_query_mariadb(query, query_args)
-    log(f"Unknown {args.db_platform=}")
-    return False
+def db_store_measurements(zone_measurements, measurement_time=None):
+    """Buffers one cycle of measurements, and adds it to the ring.
+
+    zone_measurements -- zone -> (temperature, target, limithi, limitlo, heatsink temperature, tec status, tec on cooldown).
+    """
+    if measurement_time is None:
+        measurement_time = clock.now()
+    row_time = db_time(measurement_time)
+    if measurements_ring is not None:
+        measurements_ring.append(to_wall_seconds(measurement_time), zone_measurements)
+    for zone, values in zone_measurements.items():
+        measurements_buffer.append((row_time, 'entry', zone, *values))
+    return True
+
+
+def db_flush_measurements(force=False):
+    return measurements_buffer.flush(force=force)
 
 
+def db_flush_job(force=False):
+    written_rows = measurements_buffer.written_rows
+    if not db_flush_measurements(force=force):
+        log("unable to store measurements in database, spooling them")
+    elif measurements_spool.pending() and measurements_buffer.written_rows > written_rows:
+        # a batch just reached the database: load what was spooled during the outage
+        if measurements_spool.replay(db, db_write_measurements, on_written=db_rebuild_rollups) is None:
+            log("unable to replay spooled measurements")
+
 # settings
 def default_params():
     params = {
@@ -171,24 +583,26 @@ def default_params():
         "heatsink_security_temp_lo": 0,
         "heatsink_security_temp_hi": 80,
         "esp_udp_refresh_delay": 5,
+        "ds18b20_resolution": 12,  # heatsink probes resolution, 9 (0.1 s conversion) to 12 bits (0.75 s)
+        "sensor_timeout_seconds": 2,  # a sensor read taking longer is counted as failed for the cycle
         "auto_remove_older_than_days": 7,
-        "left": {
-            "status": True,
-            "target_temperature": 12.0,  # target temperature
-            "temperature_deviation": 0.5,  # the algorithm will tolerate values between target - dev and target + dev before switching tec on/off
-            "tec_cooldown_seconds": 60,  # the tec won't be activated again before waiting for the end of the cooldown delay
-            "esp_udp_ip": "192.168.1.2",
-            "esp_udp_port": 4210
-        },
-        "right": {
+        "retention_interval_seconds": 3600,  # how often old measurements are removed
+        "rollup_retention_days": {"1m": 14, "15m": 180, "1h": 1825},
+        "db_flush_rows": 10,  # measurements are written to the database by batches of this size...
+        "db_flush_seconds": 30,  # ...or once the oldest waiting measurement is this old
+        # names of the zones, in order, for the dashboard
+        "zones": list(zones),
+    }
+    for name, zone in zones.items():
+        params[name] = {
             "status": True,
             "target_temperature": 12.0,  # target temperature
             "temperature_deviation": 0.5,  # the algorithm will tolerate values between target - dev and target + dev before switching tec on/off
             "tec_cooldown_seconds": 60,  # the tec won't be activated again before waiting for the end of the cooldown delay
-            "esp_udp_ip": "192.168.1.32",
-            "esp_udp_port": 4210
+            "bmp180_samples": 1,  # temperature readings averaged per cycle (4.5 ms each, all within sensor_timeout_seconds), more samples for less noise
+            "esp_udp_ip": zone["esp_udp_ip"],  # None: no display for this zone
+            "esp_udp_port": zone["esp_udp_port"]
         }
-    }
     return params
 
 
@@ -202,54 +616,78 @@ def clear_params():
     return False
 
 
-def get_params():
-    json_path = os.path.join(args.rundir, "settings.json")
-    try:
-        with open(json_path, "r") as f:
-            params = json.load(f)
-    except Exception as error:
-        log(f"no params found at path {json_path}, loading defaults")
-        log(f"{error=}")
-        params = default_params()
-        try:
-            with open(json_path, "w") as f:
-                json.dump(params, f, indent=4)
-            log(f"saved params to json at path {json_path}")
-        except Exception as error:
-            log(f"could not save params to json at path {json_path}")
-            log(f"{error=}")
+def fill_missing_params(params, defaults):
+    # settings files written by older versions (or by the dashboard) may lack some keys
+    for key, value in defaults.items():
+        if key not in params:
+            params[key] = value
+        elif isinstance(value, dict) and isinstance(params[key], dict):
+            fill_missing_params(params[key], value)
     return params
 
 
-# measures, etc.
-def get_current_temperatures():
-    # log("getting sensor measurements")
-    left_temp, right_temp = None, None
-    try:
-        left_temp = left_bmp.get_temp()
-    except Exception as error:
-        log("unable to retrieve left sensor measurement")
-        log(f"{error=}")
+# set when settings.json lists other zones than the configured ones, so that get_params rewrites it for the dashboard
+settings_zones_changed = False
+
+
+def validate_params(params):
+    # runs once per change of settings.json: complete older files and reject values the control loop cannot run on
+    global settings_zones_changed
+    zones_changed = params.get("zones") != list(zones)
+    params = fill_missing_params(params, default_params())
+    params["zones"] = list(zones)
+    check_params(params, zones)
+    # only for a file that is used: a rejected one changes nothing
+    settings_zones_changed = zones_changed
+    return params
+
+
+# settings.json is parsed again only when it changes
+settings = settings_cache(os.path.join(args.rundir, "settings.json"), validate=validate_params, log=log)
+
+
+def get_params():
+    params = settings.get()
+    if params is None and settings.error is not None:
+        # an invalid file is the user's: left as it is until they fix it, the backend runs on defaults meanwhile
+        log(f"invalid params at path {settings.path}, running on defaults until it is fixed", level=logging.WARNING, key="invalid_params")
+        log(f"error={settings.error!r}", key="invalid_params_error")
+        return default_params()
+    if params is None:
+        log(f"no params found at path {settings.path}, loading defaults")
+        params = default_params()
+    elif not settings_zones_changed:
+        return params
+    else:
+        log(f"zones changed to {', '.join(zones)}, updating {settings.path}")
     try:
-        right_temp = right_bmp.get_temp()
+        settings.save(params)
+        log(f"saved params to json at path {settings.path}")
     except Exception as error:
-        log("unable to retrieve right sensor measurement")
+        log(f"could not save params to json at path {settings.path}")
         log(f"{error=}")
-    return left_temp, right_temp
+    return params
 
 
 class tec_instance():
-    def __init__(self, pin):
+    def __init__(self, pin, led_factory=None):
         self.pin = pin
+        # builds the gpio output from the pin, gpiozero.LED unless simulated
+        self.led_factory = LED if led_factory is None else led_factory
         self.tec = None
         self.status = False
         self.last_switched = None
+        # for the metrics: switches to off (False) and on (True), time spent on
+        self.switches = {False: 0, True: 0}
+        self.created = clock.monotonic()
+        self.on_since = None
+        self.on_seconds_total = 0.
 
     def initialize(self):
         log(f"initializing tec at gpio {self.pin=}")
         self.tec = None
         try:
-            self.tec = LED(self.pin)
+            self.tec = self.led_factory(self.pin)
             self.tec.off()
         except Exception as error:
             self.tec = None
@@ -264,11 +702,21 @@ class tec_instance():
                 self.tec.off()
         else:
             log("unable to turn tec on/off: not initialized")
+        if onoff != self.status:
+            self.switches[onoff] += 1
+            if onoff:
+                self.on_since = clock.monotonic()
+            elif self.on_since is not None:
+                self.on_seconds_total += clock.monotonic() - self.on_since
+                self.on_since = None
         self.status = onoff
         if not self.status:  # tec was turned off: run cooldown
-            self.last_switched = time.time()
+            self.last_switched = clock.time()
 
     def turn_on(self):
+        if security_shutdown_pending:
+            log(f"not turning tec at gpio {self.pin} on: security shutdown pending", level=logging.WARNING, key="tec_on_blocked")
+            return
         self.turn(onoff=True)
 
     def turn_off(self):
@@ -282,26 +730,267 @@ class tec_instance():
             return False
         if self.last_switched is None:
             return False
-        return time.time() - self.last_switched < cooldown
+        return clock.time() - self.last_switched < cooldown
+
+    def on_seconds(self):
+        if self.on_since is None:
+            return self.on_seconds_total
+        return self.on_seconds_total + clock.monotonic() - self.on_since
 
+    def duty_cycle(self):
+        elapsed = clock.monotonic() - self.created
+        return self.on_seconds() / elapsed if elapsed > 0 else 0.
 
-def security_shutdown(sd_left_tec_instance, sd_right_tec_instance):
-    success = False
-    log("running security shutdown")
-    while not success:
+
+# a failed security shutdown is retried a few times with backoff, then stays pending: it runs again at the start of every
+# cycle, and no tec can be turned on, until it succeeds
+SECURITY_SHUTDOWN_ATTEMPTS = 3
+SECURITY_SHUTDOWN_RETRY_SECONDS = 1
+security_shutdown_pending = False
+
+
+def security_shutdown(sd_tec_instances):
+    global security_shutdown_pending
+    log("running security shutdown", level=logging.WARNING)
+    metric_security_shutdowns.inc()
+    for attempt in range(SECURITY_SHUTDOWN_ATTEMPTS):
         try:
-            sd_left_tec_instance.turn_off()
-            sd_right_tec_instance.turn_off()
-            success = True
+            for sd_tec_instance in sd_tec_instances:
+                sd_tec_instance.turn_off()
+            break
         except Exception as error:
-            log("unable to run security shutdown, retrying in 1 second")
-            log(f"{error=}")
-            time.sleep(1)
-            continue
+            log(f"{error=}", level=logging.ERROR, key="security_shutdown_error")
+            if attempt + 1 == SECURITY_SHUTDOWN_ATTEMPTS:
+                log(f"unable to run security shutdown after {SECURITY_SHUTDOWN_ATTEMPTS} attempts", level=logging.CRITICAL)
+                security_shutdown_pending = True
+                return False
+            retry_seconds = SECURITY_SHUTDOWN_RETRY_SECONDS * 2 ** attempt
+            log(f"unable to run security shutdown, retrying in {retry_seconds} seconds", level=logging.ERROR, key="security_shutdown_retry")
+            clock.sleep(retry_seconds)
     log("successfully executed security shutdown")
+    security_shutdown_pending = False
+    # make sure the measurements leading to the shutdown reach the database
+    io_jobs.submit("db", "security_flush", db_flush_job, force=True)
+    return True
+
+
+def read_heatsink_temperatures():
+    temps = heatsinks.read_temps(resolution=params["ds18b20_resolution"])
+    for address, error in heatsinks.config_errors.items():
+        log(f"unable to set the resolution of heatsink probe {address}", level=logging.WARNING, key=f"heatsink_resolution_{address}")
+        log(f"{error=}", key=f"heatsink_resolution_error_{address}")
+    for address, error in heatsinks.errors.items():
+        if address not in heatsinks.devices:
+            # a therm_bulk_read path: the probes were read one by one instead
+            log(f"unable to run the bulk conversion at {address}, converting each probe on its own read", level=logging.WARNING, key=f"heatsink_bulk_{address}")
+            log(f"{error=}", key=f"heatsink_bulk_error_{address}")
+            continue
+        log(f"unable to read heatsink temperature at {address}")
+        log(f"{error=}")
+    return temps
+
+
+def send_udp_message(message, destinations):
+    for side, ip, port in destinations:
+        try:
+            sock.sendto(bytes(message, "utf-8"), (ip, port))
+        except Exception as error:
+            metric_udp_errors.inc(side)
+            log(f"error while sending UDP packet to {side} esp32")
+            log(f"{error=}")
+
+
+class cycle_jitter():
+    # keeps track of the loop period, to check that it stays steady
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.last_start = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean_period = 0.
+        self.m2_period = 0.
+        self.max_deviation = 0.
+        self.max_duration = 0.
+
+    def cycle_started(self, target_period):
+        start = self.clock()
+        if self.last_start is not None:
+            period = start - self.last_start
+            # running mean and variance (Welford)
+            self.count += 1
+            delta = period - self.mean_period
+            self.mean_period += delta / self.count
+            self.m2_period += delta * (period - self.mean_period)
+            self.max_deviation = max(self.max_deviation, abs(period - target_period))
+        self.last_start = start
+
+    def cycle_ended(self):
+        self.max_duration = max(self.max_duration, self.clock() - self.last_start)
+
+    def summary(self):
+        std_period = (self.m2_period / self.count) ** .5 if self.count > 0 else 0.
+        return (f"cycle stats: {self.count} periods, mean {self.mean_period:.3f}s, std {1000 * std_period:.1f}ms, "
+                f"max deviation {1000 * self.max_deviation:.1f}ms, max duration {1000 * self.max_duration:.1f}ms")
+
+
+def shutdown():
+    log("waiting for background jobs")
+    io_jobs.shutdown(wait=True)
+    log("flushing measurements before exit")
+    if not db_flush_measurements(force=True):
+        log(f"unable to flush measurements, {len(measurements_spool)} measurements left in spool")
+    measurements_spool.close()
+    db.close()
+
+
+# scheduled jobs of the backend, run by the deadline scheduler from the main thread
+def control_cycle():
+    global params, zone_temps
+    jitter.cycle_started(params["loop_delay_seconds"] if params is not None else 0)
+
+    # log("loop iteration")
+
+    # get params at every cycle in case something changed (the file is only parsed again when modified)
+    new_params = None
+    while new_params is None:
+        new_params = get_params()
+        if new_params is not None:  # could retrieve new params
+            params = new_params
+            break
+        elif params is not None:  # could not retrieve but can run on older params
+            log("unable to retrieve new params, running on old params")
+            break
+        else:  # no params at all: waiting until params are found
+            log("unable to retrieve params, retrying in 5 seconds")
+            time.sleep(5)
+
+    # a security shutdown that failed in a previous cycle is retried first
+    if security_shutdown_pending:
+        security_shutdown(tecs.values())
+
+    # read all sensors at once: the cycle waits for the slowest one, not for the sum
+    snapshot = acquisition.read(params["sensor_timeout_seconds"])
+    temps = {zone: snapshot["values"][zone] for zone in zones}
+    heatsink_readings = snapshot["values"]["heatsinks"] or {}
+    heatsink_temps = {name: heatsink_readings.get(zone["heatsink_address"]) for name, zone in zones.items()}
+    zone_temps = temps
+    for sensor, seconds in snapshot["read_seconds"].items():
+        metric_sensor_read.observe(seconds, sensor)
+    for zone in zones:
+        if temps[zone] is None:
+            metric_sensor_failures.inc(zone)
+        if heatsink_temps[zone] is None:
+            metric_sensor_failures.inc(f"{zone}_heatsink")
+
+    # check temperature measurements: a missing or inconsistent one shuts all tecs down
+    for zone, temp in temps.items():
+        if temp is None:  # problem retrieving temperatures: security shutdown
+            log(f"unable to retrieve {zone} temperature", level=logging.WARNING, key=f"no_temperature_{zone}")
+            security_shutdown(tecs.values())
+        elif (temp < params["bmp180_security_temp_lo"]) or (temp > params["bmp180_security_temp_hi"]):
+            log(f"inconsistent {zone} temperature {temp=}", level=logging.WARNING, key=f"inconsistent_temperature_{zone}")
+            security_shutdown(tecs.values())
+
+    # check heatsink temperature measurements
+    # turn tecs off if temperatures are too low (inconsistent?) or high (too hot!)
+    if any(temp is None for temp in heatsink_temps.values()):
+        security_shutdown(tecs.values())
+    else:
+        for zone, heatsink_temp in heatsink_temps.items():
+            if heatsink_temp < params["heatsink_security_temp_lo"]:
+                log(f"reached too low {zone} heatsink temperature {heatsink_temp=}, shutting down {zone} tec", level=logging.WARNING, key=f"heatsink_too_low_{zone}")
+                tecs[zone].turn_off()
+            elif heatsink_temp > params["heatsink_security_temp_hi"]:
+                log(f"reached too high {zone} heatsink temperature {heatsink_temp=}, shutting down {zone} tec", level=logging.WARNING, key=f"heatsink_too_high_{zone}")
+                tecs[zone].turn_off()
+
+    # store new temperature measurements
+    zone_measurements = {}
+    for zone, tec in tecs.items():
+        target, deviation = params[zone]["target_temperature"], params[zone]["temperature_deviation"]
+        zone_measurements[zone] = (temps[zone], target, target + deviation, target - deviation, heatsink_temps[zone],
+                                   tec.status, tec.on_cd(params[zone]["tec_cooldown_seconds"]))
+    query_status = db_store_measurements(zone_measurements, measurement_time=snapshot["time"])
+    if not query_status:
+        log("unable to buffer measurements")
+
+    # decide if tec has to go on or off
+    # log("measurement-based decision")
+    try:
+        for zone, tec in tecs.items():
+            temp = temps[zone]
+            if temp is None:  # already shut down
+                continue
+            if tec.status & (temp < (params[zone]["target_temperature"] - params[zone]["temperature_deviation"])):
+                # turn off and store
+                log(f"turning {zone} tec off")
+                tec.turn_off()
+            elif (not tec.status) & (temp > (params[zone]["target_temperature"] + params[zone]["temperature_deviation"])):
+                # before turning on, checked that the CD is off
+                if not tec.on_cd(params[zone]["tec_cooldown_seconds"]):
+                    # turn on and store
+                    log(f"turning {zone} tec on")
+                    tec.turn_on()
+    except Exception as error:
+        log("error during temp-based tec decision")
+        log(f"{error=}")
+        security_shutdown(tecs.values())
+
+    # write buffered measurements once a batch is due, in the background; the buffer holds one row per zone and cycle
+    measurements_buffer.flush_rows = params["db_flush_rows"] * len(zones)
+    measurements_buffer.flush_seconds = params["db_flush_seconds"]
+    io_jobs.submit("db", "flush", db_flush_job)
+
+    jitter.cycle_ended()
+
+
+def guarded_control_cycle():
+    # the scheduler logs the error and goes on: turn the tecs off first, rather than leave them in whatever state they were
+    try:
+        control_cycle()
+    except Exception:
+        security_shutdown(tecs.values())
+        raise
+
+
+def udp_refresh():
+    # send udp message: 4 characters per zone, in zone order, to the display of each zone
+    UDP_MESSAGE = ""
+    for zone in zones:
+        temp = zone_temps.get(zone)
+        if (temp is None):
+            UDP_MESSAGE += "0000"
+        else:
+            UDP_MESSAGE += f"{int(round(temp*10)):03}1"
+    if len(UDP_MESSAGE) == 4 * len(zones):
+        udp_destinations = [(zone, params[zone]["esp_udp_ip"], params[zone]["esp_udp_port"]) for zone in zones if params[zone]["esp_udp_ip"]]
+        io_jobs.submit("udp", "udp", send_udp_message, UDP_MESSAGE, udp_destinations)
+    else:
+        log(f"invalid UDP message: {UDP_MESSAGE=}, not sent")
+
+
+def retention():
+    # clean old entries in the background
+    io_jobs.submit("db", "clean", db_clean, params["auto_remove_older_than_days"])
+    io_jobs.submit("db", "clean_rollups", db_clean_rollups, params["rollup_retention_days"])
+
+
+def report_stats():
+    # report cycle jitter, scheduling lateness and db latency
+    log(jitter.summary())
+    log(scheduler.summary())
+    log(db.summary())
+    jitter.reset()
+    scheduler.reset()
 
 
 if __name__ == "__main__":
+    # systemd stops the service with SIGTERM: exit cleanly so that the shutdown hook runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(shutdown)
+
     if args.clean_db is not None:
         log("executing db clear")
         query_result = clear_db()
@@ -334,191 +1023,65 @@ if __name__ == "__main__":
         log("unable to log startup entry into database")
     
     # init actuators (tecs)
-    left_tec_instance = tec_instance(args.left_tec_gpio)
-    right_tec_instance = tec_instance(args.right_tec_gpio)
-    while True:
-        left_tec_instance.initialize()
-        if left_tec_instance.running():
-            break
-        else:
-            log(f"unable to initialize left tec at {args.left_tec_gpio=}, retrying in 5 seconds")
-        time.sleep(5)
-    log(f"successfully intialized left tec at {args.left_tec_gpio=}")
-    while True:
-        right_tec_instance.initialize()
-        if right_tec_instance.running():
-            break
-        else:
-            log(f"unable to initialize right tec at {args.right_tec_gpio=}, retrying in 5 seconds")
-        time.sleep(5)
-    log(f"successfully intialized right tec at {args.right_tec_gpio=}")
+    for name, zone in zones.items():
+        tec = tec_instance(zone["tec_gpio"], led_factory=None if sim is None else lambda pin, name=name: sim.led(name))
+        while True:
+            tec.initialize()
+            if tec.running():
+                break
+            else:
+                log(f"unable to initialize {name} tec at gpio {zone['tec_gpio']}, retrying in 5 seconds")
+            time.sleep(5)
+        log(f"successfully intialized {name} tec at gpio {zone['tec_gpio']}")
+        tecs[name] = tec
 
-    # init heatsink tmp sensors
-    left_heatsink_ds18b20 = ds18b20(address=args.left_heatsink_temp_address, rootdir=args.w1_rootdir)
-    right_heatsink_ds18b20 = ds18b20(address=args.right_heatsink_temp_address, rootdir=args.w1_rootdir)
+    # init heatsink tmp sensors, converted together at every cycle
+    found_addresses = ds18b20.discover(args.w1_rootdir)
+    log(f"found ds18b20 probes {found_addresses}")
+    heatsink_addresses = [zone["heatsink_address"] for zone in zones.values()]
+    for address in heatsink_addresses:
+        if address not in found_addresses:
+            log(f"heatsink probe {address} not found in {args.w1_rootdir}")
+    heatsinks = ds18b20_bus(heatsink_addresses, rootdir=args.w1_rootdir, sleep=clock.sleep)
 
     # init sensors
-    left_bmp, right_bmp = None, None
-    while left_bmp is None:
-        try:
-            left_bmp = bmp180(args.left_bmp180_bus, args.left_bmp180_address)
-        except Exception as error:
-            log(f"{error=}")
-        if left_bmp is not None:
-            break
-        else:
-            log(f"unable to initialize left bmp with {args.left_bmp180_bus=} and {args.left_bmp180_address=}, retrying in 5 seconds")
-        time.sleep(5)
-    log(f"successfully intialized left bmp with {args.left_bmp180_bus=} and {args.left_bmp180_address=}")
-    while right_bmp is None:
-        try:
-            right_bmp = bmp180(args.right_bmp180_bus, args.right_bmp180_address)
-        except Exception as error:
-            log(f"{error=}")
-        if right_bmp is not None:
-            break
-        else:
-            log(f"unable to initialize left bmp with {args.right_bmp180_bus=} and {args.right_bmp180_address=}, retrying in 5 seconds")
-        time.sleep(5)
-    log(f"successfully intialized left bmp with {args.right_bmp180_bus=} and {args.right_bmp180_address=}")
-
-    params = None
-    last_iteration_time = None
-    last_udp_update = None
-    left_temp, right_temp = None, None
-
-    while True:
-        if last_iteration_time is None or (time.time() - last_iteration_time >= params["loop_delay_seconds"]):
-            last_iteration_time = time.time()
-    
-            # log("loop iteration")
-    
-            # load params at every cycle in case something changed
-            new_params = None
-            while new_params is None:
-                new_params = get_params()
-                if new_params is not None:  # could retrieve new params
-                    params = new_params
-                    break
-                elif params is not None:  # could not retrieve but can run on older params
-                    log("unable to retrieve new params, running on old params")
-                    break
-                else:  # no params at all: waiting until params are found
-                    log("unable to retrieve params, retrying in 5 seconds")
-                    time.sleep(5)
-    
-            # get temperature measurements
-            left_temp, right_temp = get_current_temperatures()
-            if (left_temp is None) or (right_temp is  None):  # problem retrieving temperatures: security shutdown
-                log("unable to retrieve temperatures")
-                security_shutdown(left_tec_instance, right_tec_instance)
-    
-            if (left_temp < params["bmp180_security_temp_lo"]) or (left_temp > params["bmp180_security_temp_hi"]):
-                log(f"inconsistent {left_temp=}")
-                security_shutdown(left_tec_instance, right_tec_instance)
-    
-            if (right_temp < params["bmp180_security_temp_lo"]) or (right_temp > params["bmp180_security_temp_hi"]):
-                log(f"inconsistent {right_temp=}")
-                security_shutdown(left_tec_instance, right_tec_instance)
-    
-            # get heatsink temperature measurements
-            left_heatsink_temp, right_heatsink_temp = None, None
-            try:
-                left_heatsink_temp = left_heatsink_ds18b20.read_temp()
-            except Exception as error:
-                log("unable to read left heatsink temperature")
-                log(f"{error=}")
+    bmps = {}
+    for name, zone in zones.items():
+        while name not in bmps:
             try:
-                right_heatsink_temp = right_heatsink_ds18b20.read_temp()
+                bmps[name] = bmp180(zone["bmp180_bus"], zone["bmp180_address"], i2c=None if sim is None else sim.smbus(name))
             except Exception as error:
-                log("unable to read right heatsink temperature")
                 log(f"{error=}")
-            # turn tecs off if temperatures are too low (inconsistent?) or high (too hot!)
-            if (left_heatsink_temp is None) or (right_heatsink_temp is None):
-                security_shutdown(left_tec_instance, right_tec_instance)
+            if name in bmps:
+                break
             else:
-                if left_heatsink_temp < params["heatsink_security_temp_lo"]:
-                    log(f"reached too low left heatsink temperature {left_heatsink_temp=}, shutting down left tec")
-                    left_tec_instance.turn_off()
-                elif left_heatsink_temp > params["heatsink_security_temp_hi"]:
-                    log(f"reached too high left heatsink temperature {left_heatsink_temp=}, shutting down left tec")
-                    left_tec_instance.turn_off()
-                if right_heatsink_temp < params["heatsink_security_temp_lo"]:
-                    log(f"reached too low left heatsink temperature {right_heatsink_temp=}, shutting down left tec")
-                    right_tec_instance.turn_off()
-                elif right_heatsink_temp > params["heatsink_security_temp_hi"]:
-                    log(f"reached too high left heatsink temperature {right_heatsink_temp=}, shutting down left tec")
-                    right_tec_instance.turn_off()
-    
-            # store new temperature measurements
-            query_status = db_store_measurements(left_temp, params["left"]["target_temperature"], params["left"]["target_temperature"] + params["left"]["temperature_deviation"], params["left"]["target_temperature"] - params["left"]["temperature_deviation"],
-                                                 left_heatsink_temp,
-                                                 right_temp, params["right"]["target_temperature"], params["right"]["target_temperature"] + params["right"]["temperature_deviation"], params["right"]["target_temperature"] - params["right"]["temperature_deviation"],
-                                                 right_heatsink_temp,
-                                                 left_tec_instance.status, right_tec_instance.status,
-                                                 left_tec_instance.on_cd(params["left"]["tec_cooldown_seconds"]),
-                                                 right_tec_instance.on_cd(params["right"]["tec_cooldown_seconds"]))
-            if not query_status:
-                log("unable to store measurements in database")
-    
-            # decide if tec has to go on or off
-            # log("measurement-based decision")
-            try:
-                if left_tec_instance.status & (left_temp < (params["left"]["target_temperature"] - params["left"]["temperature_deviation"])):
-                    # turn off and store
-                    log("turning left tec off")
-                    left_tec_instance.turn_off()
-                elif (not left_tec_instance.status) & (left_temp > (params["left"]["target_temperature"] + params["left"]["temperature_deviation"])):
-                    # before turning on, checked that the CD is off
-                    if not left_tec_instance.on_cd(params["left"]["tec_cooldown_seconds"]):
-                        # turn on and store
-                        log("turning left tec on")
-                        left_tec_instance.turn_on()
-                # also for right
-                if right_tec_instance.status & (right_temp < (params["right"]["target_temperature"] - params["right"]["temperature_deviation"])):
-                    # turn off and store
-                    log("turning right tec off")
-                    right_tec_instance.turn_off()
-                elif (not right_tec_instance.status) & (right_temp > (params["right"]["target_temperature"] + params["right"]["temperature_deviation"])):
-                    # before turning on, checked that the CD is off
-                    if not right_tec_instance.on_cd(params["right"]["tec_cooldown_seconds"]):
-                        # turn on and store
-                        log("turning right tec on")
-                        right_tec_instance.turn_on()
-            except Exception as error:
-                log("error during temp-based tec decision")
-                log(f"{error=}")
-                security_shutdown(left_tec_instance, right_tec_instance)
+                log(f"unable to initialize {name} bmp with bus {zone['bmp180_bus']} and address {zone['bmp180_address']}, retrying in 5 seconds")
+            time.sleep(5)
+        log(f"successfully intialized {name} bmp with bus {zone['bmp180_bus']} and address {zone['bmp180_address']}")
 
-            # clean old entries
-            db_clean(params["auto_remove_older_than_days"])
+    # all sensors are read concurrently at every cycle
+    sensors = {name: (lambda name=name: bmps[name].get_temp_burst(params[name]["bmp180_samples"])[0]) for name in zones}
+    sensors["heatsinks"] = read_heatsink_temperatures
+    acquisition = sensor_acquisition(sensors, log=log, now=clock.now)
 
-            # wait until next cycle
-            # log(f"going to sleep for {params['loop_delay_seconds']} seconds")
+    # metrics endpoint
+    if int(args.metrics_port) > 0:
+        try:
+            metrics_server(metrics, host=args.metrics_host, port=int(args.metrics_port), log=log,
+                           routes={"/events": lambda: ("application/json", json.dumps(logger.recent(), default=str))}).start()
+            log(f"serving metrics at http://{args.metrics_host}:{args.metrics_port}/metrics, recent log events at /events")
+        except OSError as error:
+            log("unable to start metrics server")
+            log(f"{error=}")
 
-        if last_udp_update is None or (time.time() - last_udp_update >= params["esp_udp_refresh_delay"]):
-            last_udp_update = time.time()
+    params = None
+    zone_temps = {}
+    jitter = cycle_jitter(clock=clock.monotonic)
 
-            # send udp message
-            UDP_MESSAGE = ""
-            if (left_temp is None):
-                UDP_MESSAGE += "0000"
-            else:
-                UDP_MESSAGE += f"{int(round(left_temp*10)):03}1"
-            if (right_temp is None):
-                UDP_MESSAGE += "0000"
-            else:
-                UDP_MESSAGE += f"{int(round(right_temp*10)):03}1"
-            if len(UDP_MESSAGE ) == 8:
-                try:
-                    sock.sendto(bytes(UDP_MESSAGE, "utf-8"), (params["left"]["esp_udp_ip"], params["left"]["esp_udp_port"]))
-                except Exception as error:
-                    log("error while sending UDP packet to left esp32")
-                    log(f"{error=}")
-                try:
-                    sock.sendto(bytes(UDP_MESSAGE, "utf-8"), (params["right"]["esp_udp_ip"], params["right"]["esp_udp_port"]))
-                except Exception as error:
-                    log("error while sending UDP packet to left esp32")
-                    log(f"{error=}")
-            else:
-                log(f"invalid UDP message: {UDP_MESSAGE=}, not sent")
+    # control cycle, udp refresh and retention each run on their own period; periods follow the settings
+    scheduler = deadline_scheduler(clock=clock.monotonic, sleep=None if sim is None else clock.sleep, log=log, on_run=observe_job)
+    scheduler.add_job("control", guarded_control_cycle, lambda: params["loop_delay_seconds"])
+    scheduler.add_job("udp", udp_refresh, lambda: params["esp_udp_refresh_delay"])
+    scheduler.add_job("retention", retention, lambda: params["retention_interval_seconds"])
+    scheduler.add_job("stats", report_stats, 3600, delay=3600)
+    scheduler.run()
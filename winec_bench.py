@@ -0,0 +1,274 @@
+"""
+Benchmarks of the winec hot paths, with machine-readable results.
+
+- backend: the whole control loop on simulated hardware (--simulate), run as
+  a subprocess faster than real time
+- db: buffered inserts (db_store_measurements + flush, rollups included),
+  single batch flush latency on a full table, retention deletes and the
+  size of each table and index (sqlite3 only), with sqlite3 and optionally
+  a local MariaDB server
+- dashboard: fetch_db (cold and from the tail cache) and the whole
+  callback_update_from_db, for several window lengths
+
+Every case runs in its own process, since winec_backend and winec_display
+read their arguments and open their database when imported.
+
+python winec_bench.py --output bench.json --rows 10000 100000
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PREFIX = "BENCH_RESULT "
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--output", default="bench_results.json")
+parser.add_argument("--rows", nargs="+", type=int, default=[10000, 100000])  # cycles, one row per zone each
+parser.add_argument("--windows", nargs="+", type=int, default=[60, 360, 1440])
+parser.add_argument("--backend_seconds", type=float, default=20.)
+parser.add_argument("--sim_speed", type=float, default=1000.)
+parser.add_argument("--workdir")  # kept after the run if given
+# local mariadb server, benchmarked only if a host is given
+parser.add_argument("--mariadb_host")
+parser.add_argument("--mariadb_port", default=3306)
+parser.add_argument("--mariadb_user", default="cav")
+parser.add_argument("--mariadb_password", default="caveavin")
+parser.add_argument("--mariadb_database", default="winec_bench")
+# internal: a single case, run in a subprocess
+parser.add_argument("--case")
+parser.add_argument("--platform", default="sqlite3")
+parser.add_argument("--rundir")
+parser.add_argument("--n_rows", type=int)
+args = parser.parse_args()
+
+
+def log(s):
+    print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}    {s}", file=sys.stderr)
+
+
+def emit(result):
+    # the cases print logs too: the result is the last line with this prefix
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def run_case(case_args):
+    command = [sys.executable, os.path.abspath(__file__), *case_args]
+    completed = subprocess.run(command, cwd=PACKAGE_DIR, capture_output=True, text=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {"error": f"no result, exit code {completed.returncode}", "stderr": completed.stderr[-2000:]}
+
+
+def db_args(platform_name, rundir):
+    db_argv = ["--db_platform", platform_name, "--rundir", rundir]
+    if platform_name == "mariadb":
+        db_argv += ["--db_host", args.mariadb_host, "--db_port", str(args.mariadb_port), "--db_user", args.mariadb_user,
+                    "--db_password", args.mariadb_password, "--db_database", args.mariadb_database]
+    return db_argv
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def sqlite_table_bytes(path):
+    # bytes of each table and index, None if sqlite was built without the dbstat table
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY name").fetchall())
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+
+# cases, each run in its own process
+
+def case_db():
+    sys.argv = ["winec_backend.py", *db_args(args.platform, args.rundir)]
+    sys.path.insert(0, PACKAGE_DIR)
+    import winec_backend as backend
+
+    backend.clear_db()
+    backend.init_db()
+    # default settings.json, read by the dashboard case
+    backend.get_params()
+    n_rows = args.n_rows
+    # one measurement every 10 seconds, up to now
+    end_time = datetime.now()
+    times = [end_time - timedelta(seconds=10 * (n_rows - i)) for i in range(n_rows)]
+    # the buffer holds one row per zone and cycle
+    backend.measurements_buffer.flush_rows = 1000 * len(backend.zones)
+
+    def store(dt, i):
+        backend.db_store_measurements({"left": (12 + (i % 100) / 100, 12., 12.5, 11.5, 30., i % 3 == 0, False),
+                                       "right": (13 - (i % 100) / 100, 12., 12.5, 11.5, 30., i % 5 == 0, False)}, measurement_time=dt)
+
+    started = time.perf_counter()
+    for i, dt in enumerate(times):
+        store(dt, i)
+        backend.db_flush_measurements()
+    backend.db_flush_measurements(force=True)
+    insert_seconds = time.perf_counter() - started
+
+    # latency of one regular batch (10 cycles) on the full table
+    backend.measurements_buffer.flush_rows = 10 * len(backend.zones)
+    flush_ms = []
+    for batch in range(20):
+        for i in range(10):
+            store(end_time + timedelta(seconds=10 * (10 * batch + i + 1)), i)
+        started = time.perf_counter()
+        backend.db_flush_measurements(force=True)
+        flush_ms.append(1000 * (time.perf_counter() - started))
+
+    # retention: remove the older half
+    started = time.perf_counter()
+    deleted = backend.measurements_retention.run(times[n_rows // 2])
+    retention_seconds = time.perf_counter() - started
+
+    emit({
+        "platform": args.platform,
+        "rows": n_rows,
+        "zone_rows": n_rows * len(backend.zones),
+        "insert_seconds": insert_seconds,
+        "insert_rows_per_second": n_rows * len(backend.zones) / insert_seconds,
+        "flush_10_cycles_ms_median": percentile(flush_ms, .5),
+        "flush_10_cycles_ms_p95": percentile(flush_ms, .95),
+        "retention_deleted_rows": deleted,
+        "retention_seconds": retention_seconds,
+        "retention_rows_per_second": (deleted or 0) / retention_seconds if retention_seconds > 0 else None,
+        "db_counters": dict(backend.db.counters),
+        # after retention, with the newer half of the rows
+        "table_bytes": sqlite_table_bytes(os.path.join(args.rundir, "winec_db_v1.db")) if args.platform == "sqlite3" else None,
+    })
+
+
+def case_dashboard():
+    sys.argv = ["winec_display.py", *db_args(args.platform, args.rundir)]
+    sys.path.insert(0, PACKAGE_DIR)
+    import winec_display as display
+
+    results = []
+    for minutes in args.windows:
+        display.tail_cache.clear()
+        started = time.perf_counter()
+        fetched = display.fetch_db(minutes)
+        cold_ms = 1000 * (time.perf_counter() - started)
+        started = time.perf_counter()
+        display.fetch_db(minutes)
+        cached_ms = 1000 * (time.perf_counter() - started)
+        callback_ms = []
+        for diff_switch in (False, True):
+            started = time.perf_counter()
+            output = display.callback_update_from_db(minutes, 0, diff_switch)
+            callback_ms.append(1000 * (time.perf_counter() - started))
+        results.append({
+            "minutes": minutes,
+            "resolution": display.pick_resolution(minutes) or "raw",
+            "entries": sum(len(entries) for entries, startups in fetched.values()),
+            "fetch_db_cold_ms": cold_ms,
+            "fetch_db_cached_ms": cached_ms,
+            "callback_ms": callback_ms[0],
+            "callback_diff_ms": callback_ms[1],
+            "payload_bytes": sum(len(figure.to_json()) for figure in output[1] if figure is not None),
+        })
+    emit({"platform": args.platform, "windows": results})
+
+
+def case_backend():
+    # default settings: one cycle every 10 simulated seconds
+    os.makedirs(args.rundir, exist_ok=True)
+    command = [sys.executable, "-u", os.path.join(PACKAGE_DIR, "winec_backend.py"), "--simulate", "1", "--sim_speed", str(args.sim_speed),
+               *db_args("sqlite3", args.rundir)]
+    with open(os.path.join(args.rundir, "backend.log"), "w") as log_file:
+        process = subprocess.Popen(command, cwd=PACKAGE_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+        time.sleep(args.backend_seconds)
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+    with open(os.path.join(args.rundir, "backend.log"), "r") as f:
+        backend_log = f.read()
+    connection = sqlite3.connect(os.path.join(args.rundir, "winec_db_v1.db"))
+    n_entries = connection.execute("SELECT COUNT(DISTINCT time) FROM zone_samples").fetchone()[0]
+    connection.close()
+    # the hourly reports of the backend, in simulated time
+    cycle_stats = [{"mean_period_s": float(m[0]), "std_ms": float(m[1]), "max_deviation_ms": float(m[2]), "max_duration_ms": float(m[3])}
+                   for m in re.findall(r"mean ([\d.]+)s, std ([\d.]+)ms, max deviation ([\d.]+)ms, max duration ([\d.]+)ms", backend_log)]
+    control_stats = [{"runs": int(m[0]), "missed": int(m[1]), "lateness_mean_ms": float(m[2]), "lateness_max_ms": float(m[3])}
+                     for m in re.findall(r"control: (\d+) runs, (\d+) missed, lateness mean ([\d.]+)ms max ([\d.]+)ms", backend_log)]
+    emit({
+        "sim_speed": args.sim_speed,
+        "real_seconds": args.backend_seconds,
+        "cycles": n_entries,
+        "cycles_per_real_second": n_entries / args.backend_seconds,
+        # periods, durations and lateness below are in simulated time: divide by sim_speed for real time
+        "cycle_stats": cycle_stats,
+        "control_job_stats": control_stats,
+    })
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PACKAGE_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    workdir = args.workdir or tempfile.mkdtemp(prefix="winec_bench_")
+    platforms = ["sqlite3"] + (["mariadb"] if args.mariadb_host is not None else [])
+    results = {"backend": None, "db": [], "dashboard": []}
+
+    log("backend cycle on simulated hardware")
+    results["backend"] = run_case(["--case", "backend", "--rundir", os.path.join(workdir, "backend"),
+                                   "--backend_seconds", str(args.backend_seconds), "--sim_speed", str(args.sim_speed)])
+
+    for platform_name in platforms:
+        for n_rows in args.rows:
+            log(f"db with {platform_name}, {n_rows} rows")
+            rundir = os.path.join(workdir, f"db_{platform_name}_{n_rows}")
+            os.makedirs(rundir, exist_ok=True)
+            results["db"].append(run_case(["--case", "db", "--platform", platform_name, "--rundir", rundir, "--n_rows", str(n_rows)]))
+            # the dashboard reads the table just written (its newer half, after retention)
+            log(f"dashboard with {platform_name}, {n_rows} rows")
+            dashboard_result = run_case(["--case", "dashboard", "--platform", platform_name, "--rundir", rundir,
+                                         "--windows", *[str(minutes) for minutes in args.windows]])
+            dashboard_result["rows"] = n_rows
+            results["dashboard"].append(dashboard_result)
+
+    output = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    log(f"results written to {args.output}")
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if args.case == "db":
+        case_db()
+    elif args.case == "dashboard":
+        case_dashboard()
+    elif args.case == "backend":
+        case_backend()
+    else:
+        main()
@@ -0,0 +1,689 @@
+import os
+import time
+import struct
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+WALL_EPOCH = datetime(1970, 1, 1)
+
+
+def to_wall_seconds(dt):
+    # seconds since 1970 on the wall clock (no time zone conversion), as the dashboard reads them
+    return int((dt - WALL_EPOCH).total_seconds())
+
+
+def from_wall_seconds(seconds):
+    return WALL_EPOCH + timedelta(seconds=int(seconds))
+
+
+# compact measurement tables (zone_samples, zone_events): temperatures in hundredths of a degree, tec flags packed in one byte
+CENTI = 100
+TEC_STATUS_FLAG = 1
+TEC_ON_CD_FLAG = 2
+EVENT_CODES = {"setpoint": 0, "startup": 1}
+
+
+def to_centi(value):
+    return None if value is None else int(round(float(value) * CENTI))
+
+
+def write_rows(db, insert, rows):
+    # insert is an INSERT statement run with executemany, or a function writing the rows itself and returning True on success
+    if callable(insert):
+        return insert(rows)
+    return db.execute(insert, rows, many=True)
+
+
+class db_connection_manager:
+    """Keeps one long-lived database connection for the backend.
+
+    Works for both sqlite3 and mariadb. The connection is opened the first
+    time a query runs and then kept open. If a query or connection fails,
+    the connection is dropped. Reconnection attempts are spaced with an
+    exponential backoff, and during the backoff queries fail immediately
+    instead of waiting on the database.
+    """
+
+    def __init__(self, platform, connect_kwargs, log=print, backoff_min_seconds=1., backoff_max_seconds=60., on_query=None):
+        self.platform = platform
+        self.connect_kwargs = connect_kwargs
+        self.log = log
+        # called with the duration of each query, e.g. to fill a histogram
+        self.on_query = on_query
+        self.backoff_min_seconds = backoff_min_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.conn = None
+        self.lock = threading.Lock()
+        self.backoff_seconds = backoff_min_seconds
+        self.next_connect_attempt = None
+        if platform == "sqlite3":
+            import sqlite3
+            self.driver = sqlite3
+        elif platform == "mariadb":
+            import mariadb
+            self.driver = mariadb
+        else:
+            raise ValueError(f"Unknown {platform=}")
+        self.counters = {
+            "connects": 0,
+            "connect_failures": 0,
+            "queries": 0,
+            "query_failures": 0,
+            "rows": 0,
+            "query_seconds_total": 0.,
+            "query_seconds_max": 0.,
+            "query_seconds_last": 0.,
+        }
+
+    # sqlite3 stores time as text, mariadb as DATETIME
+
+    def format_time(self, dt):
+        if self.platform == "sqlite3":
+            return dt.strftime('%Y-%m-%d %H:%M:%S')
+        return dt
+
+    def parse_time(self, value):
+        if isinstance(value, datetime):
+            return value
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+    # connection handling
+
+    def connect(self):
+        """Opens the connection unless the backoff delay is still running.
+
+        Returns True if a connection is available.
+        """
+        if self.conn is not None:
+            return True
+        if self.next_connect_attempt is not None and time.monotonic() < self.next_connect_attempt:
+            return False
+        try:
+            if self.platform == "sqlite3":
+                self.conn = self.driver.connect(check_same_thread=False, **self.connect_kwargs)
+            else:
+                self.conn = self.driver.connect(**self.connect_kwargs)
+        except Exception as error:
+            self.conn = None
+            self.counters["connect_failures"] += 1
+            self.next_connect_attempt = time.monotonic() + self.backoff_seconds
+            self.log(f"unable to connect to {self.platform} database, next attempt in {self.backoff_seconds:.0f} seconds")
+            self.log(f"{error=}")
+            self.backoff_seconds = min(self.backoff_seconds * 2, self.backoff_max_seconds)
+            return False
+        self.counters["connects"] += 1
+        self.backoff_seconds = self.backoff_min_seconds
+        self.next_connect_attempt = None
+        return True
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+    # queries
+
+    def execute(self, query, query_args=None, many=False):
+        """Runs one statement (or one executemany batch) and commits it.
+
+        query -- the SQL statement, with ? placeholders.
+        query_args -- the parameters, or a sequence of parameter tuples if many is set.
+        Returns True on success, False if the database could not be reached or
+        the statement failed.
+        """
+        return self.run(query, query_args, many=many, fetch=False) is not None
+
+    def execute_count(self, query, query_args=None):
+        """Runs one statement and returns the number of affected rows, or None on failure."""
+        return self.run(query, query_args, many=False, fetch=False)
+
+    def fetch(self, query, query_args=None):
+        """Runs one statement and returns all rows, or None on failure."""
+        return self.run(query, query_args, many=False, fetch=True)
+
+    def run(self, query, query_args=None, many=False, fetch=False):
+        with self.lock:
+            if not self.connect():
+                return None
+            tstart = time.perf_counter()
+            try:
+                cursor = self.conn.cursor()
+                if many:
+                    cursor.executemany(query, query_args)
+                elif query_args is None:
+                    cursor.execute(query)
+                else:
+                    cursor.execute(query, query_args)
+                rowcount = max(cursor.rowcount, 0)
+                result = cursor.fetchall() if fetch else rowcount
+                self.counters["rows"] += rowcount
+                cursor.close()
+                self.conn.commit()
+            except Exception as error:
+                self.counters["query_failures"] += 1
+                self.log(f"error executing query in {self.platform} database")
+                self.log(f"{error=}")
+                # the connection may be broken: reconnect on next query
+                self.disconnect()
+                return None
+            finally:
+                self.record_latency(time.perf_counter() - tstart)
+            return result
+
+    def record_latency(self, duration):
+        self.counters["queries"] += 1
+        self.counters["query_seconds_total"] += duration
+        self.counters["query_seconds_last"] = duration
+        self.counters["query_seconds_max"] = max(self.counters["query_seconds_max"], duration)
+        if self.on_query is not None:
+            self.on_query(duration)
+
+    def summary(self):
+        queries = self.counters["queries"]
+        mean_ms = 1000 * self.counters["query_seconds_total"] / queries if queries > 0 else 0.
+        return (f"db stats: {queries} queries ({self.counters['query_failures']} failed), "
+                f"mean {mean_ms:.1f}ms, max {1000 * self.counters['query_seconds_max']:.1f}ms, "
+                f"{self.counters['connects']} connects ({self.counters['connect_failures']} failed)")
+
+
+class db_reader:
+    """Read-only database access for the dashboards (winec_display, winec_fleet).
+
+    The sqlite3 connection (opened read only) or the mariadb connection pool
+    is opened on first use and kept. The driver timeouts are set to
+    timeout_seconds, so a query on an unreachable server ends on its own.
+    Queries use :name parameters, understood by both sqlite3 and sqlalchemy.
+    """
+
+    def __init__(self, platform, sqlite_path=None, host="localhost", port=3306, user="cav", password="caveavin", database="winec",
+                 timeout_seconds=10., pool_size=2):
+        self.platform = platform
+        self.sqlite_path = sqlite_path
+        self.url = f"mariadb+mariadbconnector://{user}:{password}@{host}:{port}/{database}"
+        self.timeout_seconds = timeout_seconds
+        self.pool_size = pool_size
+        self.connection, self.engine = None, None
+        self.lock = threading.Lock()
+
+    def run(self, query, query_args, consume):
+        # consume gets the cursor (sqlite3) or result (sqlalchemy), both with fetchall and fetchmany
+        if self.platform == "sqlite3":
+            with self.lock:
+                if self.connection is None:
+                    import sqlite3
+                    self.connection = sqlite3.connect(f"file:{self.sqlite_path}?mode=ro", uri=True, timeout=self.timeout_seconds, check_same_thread=False)
+                return consume(self.connection.execute(query, query_args or {}))
+        if self.platform == "mariadb":
+            from sqlalchemy import create_engine, text
+            with self.lock:
+                if self.engine is None:
+                    timeout = int(max(1, self.timeout_seconds))
+                    self.engine = create_engine(self.url, pool_size=self.pool_size, pool_pre_ping=True, pool_recycle=3600,
+                                                connect_args={"connect_timeout": timeout, "read_timeout": timeout})
+            with self.engine.connect() as connection:
+                return consume(connection.execute(text(query), query_args or {}))
+        raise ValueError(f"Unknown {self.platform=}")
+
+    def read(self, query, query_args=None):
+        """Returns all the rows of query."""
+        return self.run(query, query_args, lambda result: result.fetchall())
+
+    def read_chunks(self, query, query_args=None, chunk_rows=10000, convert=list):
+        """Returns convert(rows) for every chunk_rows rows of query, so that the row tuples never all exist at once."""
+        def consume(result):
+            chunks = []
+            while rows := result.fetchmany(chunk_rows):
+                chunks.append(convert(rows))
+            return chunks
+        return self.run(query, query_args, consume)
+
+
+class measurement_buffer:
+    """Write-behind buffer for measurement rows.
+
+    Rows are kept in memory and written in one executemany batch once enough
+    rows are waiting or the oldest row has waited long enough. The buffer is
+    bounded: when it is full the oldest rows are dropped, so memory stays
+    flat during a long database outage. If a spool is given, batches that
+    cannot be written go to the spool instead of waiting in memory. Rows can
+    be appended by one thread while another one flushes. insert_query may
+    also be a function writing a batch of rows itself, see write_rows.
+    """
+
+    def __init__(self, db, insert_query, max_rows=8640, flush_rows=10, flush_seconds=30., spool=None, on_written=None, log=print):
+        self.db = db
+        self.insert_query = insert_query
+        self.spool = spool
+        self.on_written = on_written  # called with the rows once they are in the database
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.log = log
+        self.rows = deque(maxlen=max_rows)
+        self.oldest_row_time = None
+        self.dropped_rows = 0
+        self.written_rows = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, row):
+        with self.lock:
+            if len(self.rows) == self.max_rows:
+                self.dropped_rows += 1
+                if self.dropped_rows % 100 == 1:
+                    self.log(f"measurement buffer is full, dropping oldest rows ({self.dropped_rows} dropped so far)")
+            self.rows.append(row)
+            if self.oldest_row_time is None:
+                self.oldest_row_time = time.monotonic()
+
+    def flush_due(self):
+        if len(self.rows) == 0:
+            return False
+        if len(self.rows) >= self.flush_rows:
+            return True
+        return time.monotonic() - self.oldest_row_time >= self.flush_seconds
+
+    def flush(self, force=False):
+        """Writes the waiting rows if a threshold was reached (or always, if force is set).
+
+        Returns False if rows were due but could not be written; they are then
+        spooled, or kept for the next attempt if there is no spool.
+        """
+        with self.lock:
+            if len(self.rows) == 0 or not (force or self.flush_due()):
+                return True
+            rows = list(self.rows)
+            self.rows.clear()
+            self.oldest_row_time = None
+        if write_rows(self.db, self.insert_query, rows):
+            self.written_rows += len(rows)
+            if self.on_written is not None:
+                self.on_written(rows)
+            return True
+        if self.spool is None or not self.spool.append(rows):
+            self.requeue(rows)
+        return False
+
+    def requeue(self, rows):
+        # failed rows go back in front of the newer ones, the oldest being dropped if there is no room
+        with self.lock:
+            overflow = len(rows) + len(self.rows) - self.max_rows
+            if overflow > 0:
+                self.dropped_rows += overflow
+            self.rows = deque(list(rows) + list(self.rows), maxlen=self.max_rows)
+            self.oldest_row_time = time.monotonic()
+
+
+def to_days(day):
+    # same as the TO_DAYS() function of MariaDB
+    return day.toordinal() + 365
+
+
+class retention_manager:
+    """Deletes old rows of a time-indexed table.
+
+    Old rows are deleted in chunks of chunk_rows, using the index on the time
+    column, so one retention run never holds a long lock on the table. With
+    MariaDB the table can also be partitioned by day: whole days past the
+    retention limit are then dropped as partitions, which costs the same
+    whatever their size, and only the boundary day is deleted row by row.
+    """
+
+    def __init__(self, db, table, time_column="time", chunk_rows=5000, partitioned=False, partitions_ahead=2, wall_seconds=False,
+                 row_key="rowid", time_index=True, log=print):
+        self.db = db
+        self.table = table
+        self.time_column = time_column
+        # integer time columns hold wall clock seconds (see to_wall_seconds) instead of a DATETIME/TEXT time
+        self.wall_seconds = wall_seconds
+        # sqlite3 deletes chunks by row key: the primary key columns for a WITHOUT ROWID table
+        self.row_key = row_key
+        # not needed when the primary key starts with the time column
+        self.time_index = time_index
+        self.chunk_rows = chunk_rows
+        self.partitioned = partitioned and db.platform == "mariadb"
+        self.partitions_ahead = partitions_ahead
+        self.log = log
+        if partitioned and not self.partitioned:
+            log(f"partitioning is only available with mariadb, {table} will not be partitioned")
+
+    def setup(self):
+        """Creates the time index (and the partitions, if enabled). Returns True on success."""
+        query = f"CREATE INDEX IF NOT EXISTS {self.table}_{self.time_column} ON {self.table} ({self.time_column})"
+        if self.time_index and not self.db.execute(query):
+            return False
+        if self.partitioned:
+            return self.setup_partitions()
+        return True
+
+    def run(self, dt_max_date_keep: datetime):
+        """Removes the rows older than dt_max_date_keep.
+
+        Returns the number of deleted rows, or None if a query failed.
+        """
+        deleted = 0
+        if self.partitioned:
+            if not self.add_partitions() or not self.drop_partitions(dt_max_date_keep):
+                return None
+        if self.db.platform == "sqlite3":
+            query = (f"DELETE FROM {self.table} WHERE ({self.row_key}) IN "
+                     f"(SELECT {self.row_key} FROM {self.table} WHERE {self.time_column} < ? ORDER BY {self.time_column} LIMIT {self.chunk_rows})")
+        else:
+            query = f"DELETE FROM {self.table} WHERE {self.time_column} < ? ORDER BY {self.time_column} LIMIT {self.chunk_rows}"
+        while True:
+            chunk = self.db.execute_count(query, (self.format_time(dt_max_date_keep), ))
+            if chunk is None:
+                return None
+            deleted += chunk
+            if chunk < self.chunk_rows:
+                return deleted
+
+    def format_time(self, dt):
+        if self.wall_seconds:
+            return to_wall_seconds(dt)
+        return self.db.format_time(dt)
+
+    # mariadb partitions, one per day, named pYYYYMMDD, and pmax for everything after the last day
+
+    def partition_bound(self, day):
+        # partitions hold the days before the bound: TO_DAYS() of a DATETIME, or the wall clock seconds at midnight
+        if self.wall_seconds:
+            return to_wall_seconds(datetime.combine(day, datetime.min.time()))
+        return to_days(day)
+
+    def partition_expression(self):
+        if self.wall_seconds:
+            return self.time_column
+        return f"TO_DAYS({self.time_column})"
+
+    def partition_clause(self, day):
+        return f"PARTITION p{day:%Y%m%d} VALUES LESS THAN ({self.partition_bound(day + timedelta(days=1))})"
+
+    def get_partitions(self):
+        query = "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? AND PARTITION_NAME IS NOT NULL"
+        return self.db.fetch(query, (self.table, ))
+
+    def setup_partitions(self):
+        partitions = self.get_partitions()
+        if partitions is None:
+            return False
+        if len(partitions) > 0:
+            return self.add_partitions()
+        self.log(f"partitioning {self.table} by day")
+        today = datetime.now().date()
+        clauses = [f"PARTITION pold VALUES LESS THAN ({self.partition_bound(today)})"]
+        clauses += [self.partition_clause(today + timedelta(days=i)) for i in range(self.partitions_ahead + 1)]
+        clauses += ["PARTITION pmax VALUES LESS THAN MAXVALUE"]
+        query = f"ALTER TABLE {self.table} PARTITION BY RANGE ({self.partition_expression()}) ({', '.join(clauses)})"
+        return self.db.execute(query)
+
+    def add_partitions(self):
+        partitions = self.get_partitions()
+        if partitions is None:
+            return False
+        bounds = [int(description) for name, description in partitions if name != "pmax"]
+        last_bound = max(bounds) if len(bounds) > 0 else 0
+        today = datetime.now().date()
+        new_days = [today + timedelta(days=i) for i in range(self.partitions_ahead + 1)]
+        new_days = [day for day in new_days if self.partition_bound(day + timedelta(days=1)) > last_bound]
+        if len(new_days) == 0:
+            return True
+        clauses = [self.partition_clause(day) for day in new_days] + ["PARTITION pmax VALUES LESS THAN MAXVALUE"]
+        query = f"ALTER TABLE {self.table} REORGANIZE PARTITION pmax INTO ({', '.join(clauses)})"
+        return self.db.execute(query)
+
+    def drop_partitions(self, dt_max_date_keep: datetime):
+        partitions = self.get_partitions()
+        if partitions is None:
+            return False
+        # a partition can go once all of its days are older than the limit
+        expired = [name for name, description in partitions if name != "pmax" and int(description) <= self.partition_bound(dt_max_date_keep.date())]
+        if len(expired) == 0:
+            return True
+        self.log(f"dropping partitions {', '.join(expired)} of {self.table}")
+        return self.db.execute(f"ALTER TABLE {self.table} DROP PARTITION {', '.join(expired)}")
+
+
+class measurement_spool:
+    """Append-only on-disk spool for rows that could not reach the database.
+
+    Rows are packed as fixed-width binary records (record_format, a struct
+    format) by the encode callable, and a whole batch is appended with a
+    single write on a descriptor that stays open, so spooling costs a couple
+    of syscalls and no rewrite of the file. The spool is replayed in chunks
+    once the database answers again; the replay position is saved after each
+    chunk, so a crash replays at most one chunk twice.
+    """
+
+    def __init__(self, path, record_format, encode, decode, log=print):
+        self.path = path
+        self.replay_path = path + ".replay"
+        self.offset_path = path + ".offset"
+        self.record = struct.Struct(record_format)
+        self.encode = encode
+        self.decode = decode
+        self.log = log
+        self.fd = None
+        self.lock = threading.Lock()
+        self.spooled_rows = 0
+        self.replayed_rows = 0
+
+    def pending(self):
+        return os.path.exists(self.path) or os.path.exists(self.replay_path)
+
+    def __len__(self):
+        # rows waiting on disk, including a replay that was interrupted
+        size = 0
+        for path in (self.path, self.replay_path):
+            if os.path.exists(path):
+                size += os.path.getsize(path) // self.record.size
+        return size - self.read_offset()
+
+    def append(self, rows):
+        """Appends rows to the spool. Returns True on success."""
+        data = b"".join(self.record.pack(*self.encode(row)) for row in rows)
+        with self.lock:
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                os.write(self.fd, data)
+            except Exception as error:
+                self.log(f"unable to write to spool {self.path}")
+                self.log(f"{error=}")
+                return False
+        self.spooled_rows += len(rows)
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def read_offset(self):
+        try:
+            with open(self.offset_path, "r") as f:
+                return int(f.read())
+        except Exception:
+            return 0
+
+    def write_offset(self, offset):
+        with open(self.offset_path, "w") as f:
+            f.write(str(offset))
+
+    def replay(self, db, insert_query, chunk_rows=1000, on_written=None):
+        """Inserts the spooled rows into the database, chunk_rows at a time.
+
+        on_written, if given, is called with each chunk once it is written,
+        and returns True on success. Returns the number of replayed rows, or
+        None if the database or on_written failed (the remaining rows stay
+        spooled, and the failed chunk is sent again next time: both have to
+        be harmless when run twice).
+        """
+        with self.lock:
+            # new rows go to a fresh spool while the current one is replayed
+            if not os.path.exists(self.replay_path):
+                if not os.path.exists(self.path):
+                    return 0
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+                os.replace(self.path, self.replay_path)
+                self.write_offset(0)
+        replayed = 0
+        offset = self.read_offset()
+        with open(self.replay_path, "rb") as f:
+            f.seek(offset * self.record.size)
+            while True:
+                data = f.read(chunk_rows * self.record.size)
+                n_records = len(data) // self.record.size  # an incomplete last record comes from a crash: skip it
+                if n_records == 0:
+                    break
+                rows = [self.decode(values) for values in self.record.iter_unpack(data[:n_records * self.record.size])]
+                if not write_rows(db, insert_query, rows) or (on_written is not None and not on_written(rows)):
+                    return None
+                offset += n_records
+                replayed += n_records
+                self.write_offset(offset)
+        os.remove(self.replay_path)
+        os.remove(self.offset_path)
+        self.replayed_rows += replayed
+        self.log(f"replayed {replayed} spooled measurements")
+        return replayed
+
+
+ROLLUP_RESOLUTIONS = (("1m", 60), ("15m", 900), ("1h", 3600))
+
+
+class rollup_manager:
+    """Keeps downsampled copies of the measurements, one table per resolution.
+
+    Each rollup row covers one time bucket and holds the number of entries
+    and startups, the min/max/sum of the minmax_columns and the sum of the
+    sum_columns; means are sums divided by n_entries. The tables are updated
+    with an upsert adding every batch written to the raw table, so they do
+    not need to be rebuilt from raw rows. Rows that may have been added
+    already (a spool chunk sent again) go through rebuild instead, which
+    recomputes their buckets from the raw table. With key_columns (e.g. the
+    zone), there is one rollup row per bucket and key.
+    """
+
+    def __init__(self, db, columns, minmax_columns, sum_columns, time_column="time", event_column="event", key_columns=(),
+                 table_prefix="temperature_rollup", resolutions=ROLLUP_RESOLUTIONS, log=print):
+        self.db = db
+        self.columns = columns  # names of the fields of a measurement row, in order
+        self.minmax_columns = minmax_columns
+        self.sum_columns = sum_columns
+        self.time_column = time_column
+        self.event_column = event_column
+        self.key_columns = tuple(key_columns)
+        self.table_prefix = table_prefix
+        self.resolutions = resolutions
+        self.log = log
+        self.rollup_columns = ["n_entries", "n_startups"]
+        self.rollup_columns += [f"{column}_{agg}" for column in minmax_columns for agg in ("min", "max", "sum")]
+        self.rollup_columns += [f"{column}_sum" for column in sum_columns]
+
+    def table(self, resolution_name):
+        return f"{self.table_prefix}_{resolution_name}"
+
+    def tables(self):
+        return [self.table(name) for name, seconds in self.resolutions]
+
+    def setup(self):
+        """Creates the rollup tables. Returns True on success."""
+        time_type = "TEXT" if self.db.platform == "sqlite3" else "DATETIME"
+        key_types = "".join(f"{column} VARCHAR(32), " for column in self.key_columns)
+        column_types = ", ".join(f"{column} {'INTEGER' if column.startswith('n_') else 'FLOAT'}" for column in self.rollup_columns)
+        primary_key = ", ".join(("bucket", ) + self.key_columns)
+        for table in self.tables():
+            if not self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (bucket {time_type}, {key_types}{column_types}, PRIMARY KEY ({primary_key}))"):
+                return False
+        return True
+
+    def upsert_query(self, table, replace=False):
+        columns = ("bucket", ) + self.key_columns + tuple(self.rollup_columns)
+        values = f"{table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+        if replace:
+            return f"{'INSERT OR REPLACE' if self.db.platform == 'sqlite3' else 'REPLACE'} INTO {values}"
+        insert = f"INSERT INTO {values}"
+        updates = []
+        for column in self.rollup_columns:
+            new = f"excluded.{column}" if self.db.platform == "sqlite3" else f"VALUES({column})"
+            if column.endswith("_min") or column.endswith("_max"):
+                if self.db.platform == "sqlite3":
+                    merge = "MIN" if column.endswith("_min") else "MAX"
+                else:
+                    merge = "LEAST" if column.endswith("_min") else "GREATEST"
+                # buckets holding only startups have no min/max yet
+                updates.append(f"{column} = {merge}(COALESCE({column}, {new}), COALESCE({new}, {column}))")
+            else:
+                updates.append(f"{column} = {column} + {new}")
+        if self.db.platform == "sqlite3":
+            return f"{insert} ON CONFLICT({', '.join(('bucket', ) + self.key_columns)}) DO UPDATE SET {', '.join(updates)}"
+        return f"{insert} ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+
+    def aggregate(self, rows, seconds):
+        buckets = {}
+        time_index = self.columns.index(self.time_column)
+        event_index = self.columns.index(self.event_column)
+        key_indices = [self.columns.index(column) for column in self.key_columns]
+        minmax_indices = [self.columns.index(column) for column in self.minmax_columns]
+        sum_indices = [self.columns.index(column) for column in self.sum_columns]
+        for row in rows:
+            # buckets aligned on the wall clock, as the raw tables: whole local hours whatever the utc offset, and the same bucket keys as the dashboard
+            timestamp = to_wall_seconds(self.db.parse_time(row[time_index]))
+            key = (timestamp - timestamp % seconds, *[row[i] for i in key_indices])
+            bucket = buckets.setdefault(key, [0, 0] + [None, None, 0.] * len(minmax_indices) + [0.] * len(sum_indices))
+            if row[event_index] == "startup":
+                bucket[1] += 1
+                continue
+            # entries with a missing value (failed sensor) are left out rather than skewing the means
+            if any(row[i] is None for i in minmax_indices + sum_indices):
+                continue
+            bucket[0] += 1
+            for k, i in enumerate(minmax_indices):
+                value = float(row[i])
+                bucket[2 + 3 * k] = value if bucket[2 + 3 * k] is None else min(bucket[2 + 3 * k], value)
+                bucket[3 + 3 * k] = value if bucket[3 + 3 * k] is None else max(bucket[3 + 3 * k], value)
+                bucket[4 + 3 * k] += value
+            for k, i in enumerate(sum_indices):
+                bucket[2 + 3 * len(minmax_indices) + k] += float(row[i])
+        return buckets
+
+    def update(self, rows, replace=False):
+        """Adds freshly written measurement rows to every rollup table (or replaces their buckets). Returns True on success."""
+        for name, seconds in self.resolutions:
+            buckets = self.aggregate(rows, seconds)
+            query_args = [(self.db.format_time(from_wall_seconds(key[0])), *key[1:], *values) for key, values in sorted(buckets.items())]
+            if len(query_args) > 0 and not self.db.execute(self.upsert_query(self.table(name), replace=replace), query_args, many=True):
+                return False
+        return True
+
+    def rebuild(self, rows, read_rows):
+        """Recomputes every bucket touched by rows from the raw table. Returns True on success.
+
+        read_rows(start, end) returns all the measurement rows written with
+        start <= time < end, as datetimes on bucket bounds of the coarsest
+        resolution, or None if the database failed.
+        """
+        if len(rows) == 0:
+            return True
+        time_index = self.columns.index(self.time_column)
+        times = [to_wall_seconds(self.db.parse_time(row[time_index])) for row in rows]
+        span = max(seconds for name, seconds in self.resolutions)
+        start, end = min(times) - min(times) % span, max(times) - max(times) % span + span
+        raw_rows = read_rows(from_wall_seconds(start), from_wall_seconds(end))
+        if raw_rows is None:
+            return False
+        return self.update(raw_rows, replace=True)
@@ -1,14 +1,20 @@
 import os
 import argparse
 import pandas as pd
-from dash import Dash, html, dcc, Input, Output, callback, State
+from dash import Dash, html, dcc, Input, Output, callback, State, ALL, no_update
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
 import numpy as np
 import time
-import json
+import copy
+import logging
+import threading
+from winec_settings import settings_cache, check_params
+from winec_log import structured_logger
+from winec_db import db_reader, to_wall_seconds, from_wall_seconds, CENTI, TEC_STATUS_FLAG, TEC_ON_CD_FLAG, EVENT_CODES
+from winec_ring import measurement_ring, RING_EVENTS
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--mode")
@@ -28,87 +34,273 @@ args = parser.parse_args()
 args.auto_debug = args.auto_debug is not None
 
 
+if args.auto_debug and not os.path.exists(args.rundir):
+    args.dash_ip = "127.0.0.1"
+    # args.rundir = r"C:\Users\flori\OneDrive - univ-angers.fr\Documents\Home\Research\Common"
+    args.rundir = r"C:\Users\flori\OneDrive\Documents\winec_temp"
+
+# callbacks only queue their messages; the log file is kept next to the backend one when the rundir exists
+logger = structured_logger("winec_display", path=os.path.join(args.rundir, "winec_display.log") if os.path.isdir(args.rundir) else None)
+
+
 def now():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
-def log(s):
-    print(f"{now()}    {s}")
+def log(s, level=logging.INFO, key=None, **fields):
+    logger.log(s, level=level, key=key, **fields)
 
 
-if args.auto_debug and not os.path.exists(args.rundir):
-    args.dash_ip = "127.0.0.1"
-    # args.rundir = r"C:\Users\flori\OneDrive - univ-angers.fr\Documents\Home\Research\Common"
-    args.rundir = r"C:\Users\flori\OneDrive\Documents\winec_temp"
+# one connection (sqlite3) or connection pool (mariadb) for the whole dashboard, opened on first use
+db = db_reader(args.db_platform, sqlite_path=os.path.join(args.rundir, "winec_db_v1.db"), host=args.db_host, port=args.db_port,
+               user=args.db_user, password=args.db_password, database=args.db_database)
+
 
-if args.db_platform == "sqlite3":
-    import sqlite3
-elif args.db_platform == "mariadb":
-    from sqlalchemy import create_engine
+# settings.json is parsed again only when the backend or another dashboard changed it
+settings = settings_cache(os.path.join(args.rundir, "settings.json"), log=log)
 
 
 def load_params_():
-    json_path = os.path.join(args.rundir, "settings.json")
-    with open(json_path, "r") as f:
-        params = json.load(f)
-    return params
+    # shared with the other callbacks: copy before modifying
+    return settings.get()
 
 
 def save_params(params):
-    json_path = os.path.join(args.rundir, "settings.json")
-    with open(json_path, "w") as f:
-        json.dump(params, f, indent=4)
-
-
-def db_get_measurements_mariadb(minutes):
-    engine = create_engine(f"mariadb+mariadbconnector://{args.db_user}:{args.db_password}@{args.db_host}:{args.db_port}/{args.db_database}")
-    # engine = create_engine(f"mariadb:///?User={args.db_user}&;Password={args.db_password}&Database={args.db_database}&Server={args.db_host}&Port={args.db_port}")
-    dt_start = (datetime.now() - timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    dt_end = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    output_data = pd.read_sql(f"SELECT * FROM temperature_measurements WHERE time BETWEEN '{dt_start}' and '{dt_end}'", engine)
-    return output_data
-
-
-def db_get_measurements_sqlite3(minutes):
-    connection = sqlite3.connect(os.path.join(args.rundir, "winec_db_v1.db"), timeout=10)
-    cursor = connection.cursor()
-    colnames = ["time", "event",
-                "left_temperature", "left_target", "left_limithi", "left_limitlo", "left_heatsink_temperature", "left_tec_status", "left_tec_on_cd",
-                "right_temperature", "right_target", "right_limithi", "right_limitlo", "right_heatsink_temperature", "right_tec_status", "right_tec_on_cd", ]
-    # cursor.execute(f"SELECT {', '.join(colnames)} FROM temperature_measurements WHERE time > DATETIME('now', '-{minutes} minute')")  # execute a simple SQL select query
-    dt_start = (datetime.now() - timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    dt_end = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute(f"SELECT {', '.join(colnames)} FROM temperature_measurements WHERE time BETWEEN '{dt_start}' and '{dt_end}'")  # execute a simple SQL select query
-    query_results = cursor.fetchall()
-    connection.commit()
-    connection.close()
-    output_data = pd.DataFrame(query_results, columns=colnames)
-    return output_data
-
-
-
-# get temp/tec status measurements over the last X minutes, formatted as a pandas dataframe
-def fetch_db(minutes):
-    # if set to debug: create fake data
-    log("retrieving up-to-date db data")
-    # the real function
-    output_data = None
+    # checked as the backend will check it (raises ValueError), then written through a temporary file,
+    # so the backend never reads a half-written or rejected file
+    check_params(params, params.get("zones") or ZONES)
+    settings.save(params)
+
+
+# zones shown by the dashboard, as listed in settings.json by the backend
+ZONES = (load_params_() or {}).get("zones") or ["left", "right"]
+
+# measurement columns of a zone with their dtype on the dashboard side, after time
+ENTRY_COLUMNS = (("temperature", np.float32), ("target", np.float32), ("limithi", np.float32), ("limitlo", np.float32),
+                 ("heatsink_temperature", np.float32), ("tec_status", np.uint8), ("tec_on_cd", np.uint8), )
+
+
+def epoch_seconds(column):
+    # datetime column as seconds since 1970 on the wall clock (no time zone conversion), so results are all numeric
     if args.db_platform == "sqlite3":
-        output_data = db_get_measurements_sqlite3(minutes=minutes)
-    if args.db_platform == "mariadb":
-        output_data = db_get_measurements_mariadb(minutes=minutes)
-    # format correctly
-    if output_data is not None:
-        output_data.time = pd.to_datetime(output_data.time)
-        output_data = output_data.astype({"left_temperature": float, 'left_target': float, 'left_limithi': float, 'left_limitlo': float, 'left_heatsink_temperature': float, 'left_tec_status': int, 'left_tec_on_cd': int,
-                                          'right_temperature': float, 'right_target': float, 'right_limithi': float, 'right_limitlo': float, 'right_heatsink_temperature': float, 'right_tec_status': int, 'right_tec_on_cd': int})
-    else:
-        print(f"unable to retrieve db data: unknown {args.db_platform}")
-    return output_data
+        return f"CAST(strftime('%s', {column}) AS INTEGER)"
+    return f"TIMESTAMPDIFF(SECOND, '1970-01-01', {column})"
+
+
+# raw measurements of one zone, from the compact tables written by the backend: the samples, the setpoints in force
+# (the last change before the window and the changes within it), joined on read, and the startups
+ZONE_ID = "(SELECT zone_id FROM zone_names WHERE name = :zone)"
+SAMPLES_QUERY = (f"SELECT time, temperature, heatsink_temperature, tec_flags FROM zone_samples "
+                 f"WHERE zone_id = {ZONE_ID} AND time BETWEEN :t_start AND :t_end ORDER BY time")
+SETPOINTS_QUERY = (f"SELECT time, target, limithi, limitlo FROM zone_events WHERE zone_id = {ZONE_ID} AND event = {EVENT_CODES['setpoint']} "
+                   f"AND time BETWEEN COALESCE((SELECT MAX(time) FROM zone_events WHERE zone_id = {ZONE_ID} AND event = {EVENT_CODES['setpoint']} "
+                   f"AND time <= :t_start), :t_start) AND :t_end ORDER BY time")
+STARTUPS_QUERY = (f"SELECT time FROM zone_events WHERE zone_id = {ZONE_ID} AND event = {EVENT_CODES['startup']} "
+                  f"AND time BETWEEN :t_start AND :t_end ORDER BY time")
+
+
+def db_read_array(query, query_args, n_columns, chunk_rows=10000):
+    # numeric results straight into a float64 array, chunk by chunk, so the row tuples never all exist at once
+    chunks = db.read_chunks(query, query_args, chunk_rows=chunk_rows, convert=lambda rows: np.array(rows, dtype=np.float64))
+    if len(chunks) == 0:
+        return np.empty((0, n_columns), dtype=np.float64)
+    return np.concatenate(chunks)
+
+
+def to_datetime64(seconds):
+    return seconds.astype(np.int64).astype("datetime64[s]")
+
+
+def join_setpoints(samples, setpoints):
+    # entries as laid out by ENTRY_COLUMNS, after time; each sample takes the last setpoints written at or before its time
+    values = np.full((len(samples), len(ENTRY_COLUMNS) + 1), np.nan)
+    values[:, 0] = samples[:, 0]
+    values[:, 1] = samples[:, 1] / CENTI
+    index = np.searchsorted(setpoints[:, 0], samples[:, 0], side="right") - 1
+    known = index >= 0
+    values[known, 2:5] = setpoints[index[known], 1:4] / CENTI
+    values[:, 5] = samples[:, 2] / CENTI
+    tec_flags = samples[:, 3].astype(np.uint8)
+    values[:, 6] = (tec_flags & TEC_STATUS_FLAG) > 0
+    values[:, 7] = (tec_flags & TEC_ON_CD_FLAG) > 0
+    return values
+
+
+def entries_frame(values, tec_dtype):
+    # one typed array per column; tec columns are fractions (float32) when read from rollups
+    columns = {"time": to_datetime64(values[:, 0])}
+    for index, (column, dtype) in enumerate(ENTRY_COLUMNS):
+        columns[column] = values[:, index + 1].astype(tec_dtype if dtype == np.uint8 else dtype)
+    return pd.DataFrame(columns, copy=False)
+
+
+def startups_frame(values):
+    return pd.DataFrame({"time": to_datetime64(values[:, 0])}, copy=False)
+
+
+# rollup tables written by the backend, coarsest first: name, minutes per bucket
+ROLLUP_RESOLUTIONS = (("1h", 60), ("15m", 15), ("1m", 1))
+# about as many points as a plot can show
+PLOT_POINTS = 500
+
+
+def pick_resolution(minutes):
+    # coarsest rollup that still fills the plot, None for raw measurements
+    for resolution_name, bucket_minutes in ROLLUP_RESOLUTIONS:
+        if minutes / bucket_minutes >= PLOT_POINTS:
+            return resolution_name
+    return None
+
 
+def rollup_queries(resolution_name):
+    # means are stored as sums, tec status and cooldown become the fraction of time on
+    table = f"zone_rollup_{resolution_name}"
+    columns = ", ".join(f"{column}_sum / n_entries" for column, dtype in ENTRY_COLUMNS)
+    entries_query = f"SELECT {epoch_seconds('bucket')}, {columns} FROM {table} WHERE zone = :zone AND n_entries > 0 AND bucket BETWEEN :dt_start AND :dt_end ORDER BY bucket"
+    startups_query = f"SELECT {epoch_seconds('bucket')} FROM {table} WHERE zone = :zone AND n_startups > 0 AND bucket BETWEEN :dt_start AND :dt_end ORDER BY bucket"
+    return entries_query, startups_query
 
-def get_db_subset(db_extract: pd.DataFrame, events: list = ("entry", )):
-    return db_extract[db_extract.event.isin(events)]
+
+ROLLUP_QUERIES = {resolution_name: rollup_queries(resolution_name) for resolution_name, bucket_minutes in ROLLUP_RESOLUTIONS}
+
+
+def db_get_last_measurement_time():
+    # the primary key of zone_samples starts with the time: a single lookup
+    try:
+        last_time = db.read("SELECT MAX(time) FROM zone_samples")[0][0]
+    except Exception as error:
+        # unknown: the status falls back to the last time drawn
+        log(f"unable to retrieve the last measurement time from {args.db_platform}", level=logging.WARNING, key="last_measurement_time")
+        log(f"{error=}", key="last_measurement_time_error")
+        return None
+    return None if last_time is None else from_wall_seconds(last_time)
+
+
+def fetch_db_raw(dt_start, dt_end, zone):
+    query_args = {"zone": zone, "t_start": to_wall_seconds(dt_start), "t_end": to_wall_seconds(dt_end)}
+    samples = db_read_array(SAMPLES_QUERY, query_args, n_columns=4)
+    setpoints = db_read_array(SETPOINTS_QUERY, query_args, n_columns=4)
+    startups = db_read_array(STARTUPS_QUERY, query_args, n_columns=1)
+    return join_setpoints(samples, setpoints), startups
+
+
+# latest cycles, written by the backend into a memory-mapped file; mapped again when the backend creates it again at startup
+ring = None
+ring_lock = threading.Lock()
+
+
+def get_ring():
+    global ring
+    with ring_lock:
+        if ring is None or ring.replaced():
+            try:
+                ring = measurement_ring(os.path.join(args.rundir, "measurements.ring"))
+            except (OSError, ValueError):
+                ring = None
+        return ring
+
+
+def fetch_ring(dt_start, dt_end, zone):
+    # entries laid out as fetch_db_raw ones and startup times from the ring, with the time from which the ring holds every cycle;
+    # None if there is no ring or the zone is not in it
+    current_ring = get_ring()
+    if current_ring is None or zone not in current_ring.zones:
+        return None
+    records, first_seq, held_from = current_ring.read(to_wall_seconds(dt_start), to_wall_seconds(dt_end))
+    # the only copy: the columns of the zone (ring fields are named after ENTRY_COLUMNS), out of the mapped file before the backend overwrites them
+    index = current_ring.zones.index(zone)
+    values = np.column_stack([records["time"]] + [records[column][:, index] for column, dtype in ENTRY_COLUMNS]).astype(np.float64, copy=False)
+    events = np.array(records["event"])
+    unchanged = current_ring.unchanged(records, first_seq)
+    if not unchanged.all():
+        # overwritten while copied: those were the oldest, the database has them
+        held_from = int(values[unchanged, 0][0]) if unchanged.any() else None
+        values, events = values[unchanged], events[unchanged]
+    if held_from is None:
+        return None
+    is_entry = events == RING_EVENTS.index("entry")
+    return values[is_entry], values[~is_entry, :1], held_from
+
+
+def fetch_recent(dt_start, dt_end, zone):
+    # raw entries and startups: from the ring, and from the database only for what is older than the ring
+    fetched = fetch_ring(dt_start, dt_end, zone)
+    if fetched is None:
+        return fetch_db_raw(dt_start, dt_end, zone)
+    entries, startups, held_from = fetched
+    if to_wall_seconds(dt_start) >= held_from:
+        return entries, startups
+    older = fetch_db_raw(dt_start, from_wall_seconds(held_from - 1), zone)
+    return np.concatenate([older[0], entries]), np.concatenate([older[1], startups])
+
+
+# get temp/tec status entries and startup times of a zone between two dates, as two typed pandas dataframes
+def fetch_db_range(dt_start, dt_end, resolution_name, zone):
+    if resolution_name is None:
+        fetched = fetch_recent(dt_start, dt_end, zone)
+        tec_dtype = np.uint8
+    else:
+        query_args = {"zone": zone, "dt_start": dt_start.strftime('%Y-%m-%d %H:%M:%S'), "dt_end": dt_end.strftime('%Y-%m-%d %H:%M:%S')}
+        entries_query, startups_query = ROLLUP_QUERIES[resolution_name]
+        fetched = db_read_array(entries_query, query_args, n_columns=len(ENTRY_COLUMNS) + 1), db_read_array(startups_query, query_args, n_columns=1)
+        tec_dtype = np.float32
+    entries, startups = fetched
+    return entries_frame(entries, tec_dtype), startups_frame(startups)
+
+
+# last frames fetched for each resolution and zone, so that a refresh only queries the rows added since
+tail_cache = {}
+tail_cache_lock = threading.Lock()
+# the whole window is fetched again from time to time, to pick up rows replayed late from the backend spool
+TAIL_CACHE_MAX_AGE_SECONDS = 600
+
+
+def fetch_db_zone(resolution_name, zone, dt_start, dt_end):
+    # call with tail_cache_lock held; empty frames if the database cannot be read, so that the page still draws
+    try:
+        return fetch_db_zone_cached(resolution_name, zone, dt_start, dt_end)
+    except Exception as error:
+        log(f"unable to retrieve {zone} db data from {args.db_platform}", level=logging.WARNING, key=f"fetch_db_{zone}")
+        log(f"{error=}", key=f"fetch_db_error_{zone}")
+        # fetched again in full next time
+        tail_cache.pop((resolution_name, zone), None)
+        tec_dtype = np.uint8 if resolution_name is None else np.float32
+        return entries_frame(np.empty((0, len(ENTRY_COLUMNS) + 1)), tec_dtype), startups_frame(np.empty((0, 1)))
+
+
+def fetch_db_zone_cached(resolution_name, zone, dt_start, dt_end):
+    cached = tail_cache.get((resolution_name, zone))
+    if (cached is None or len(cached["entries"]) == 0 or cached["window_start"] > dt_start
+            or time.time() - cached["fetched_at"] > TAIL_CACHE_MAX_AGE_SECONDS):
+        entries, startups = fetch_db_range(dt_start, dt_end, resolution_name, zone)
+        cached = {"fetched_at": time.time()}
+    else:
+        # refetch from the last cached timestamp: its rollup bucket (or second) may have been completed since
+        last_time = cached["entries"].time.iloc[-1]
+        fetched = fetch_db_range(last_time, dt_end, resolution_name, zone)
+        entries = pd.concat([cached["entries"][cached["entries"].time < last_time], fetched[0]], ignore_index=True)
+        startups = pd.concat([cached["startups"][cached["startups"].time < last_time], fetched[1]], ignore_index=True)
+    # drop what went out of the window
+    entries = entries[entries.time >= dt_start].reset_index(drop=True)
+    startups = startups[startups.time >= dt_start].reset_index(drop=True)
+    cached.update(entries=entries, startups=startups, window_start=dt_start)
+    tail_cache[(resolution_name, zone)] = cached
+    return entries, startups
+
+
+# get temp/tec status entries and startup times over the last X minutes, as {zone: (entries, startups)}
+def fetch_db(minutes, zones=None):
+    # if set to debug: create fake data
+    log("retrieving up-to-date db data")
+    # long windows are read from the rollups instead of the raw measurements
+    resolution_name = pick_resolution(minutes)
+    dt_end = datetime.now()
+    dt_start = dt_end - timedelta(minutes=minutes)
+    fetched = {}
+    with tail_cache_lock:
+        for zone in (ZONES if zones is None else zones):
+                fetched[zone] = fetch_db_zone(resolution_name, zone, dt_start, dt_end)
+    return fetched
 
 
 app = Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
@@ -128,157 +320,212 @@ def rework_onoff_with_times(time, onoff):
     return time_rw, onoff_rw
 
 
+# plots are decimated server-side to about their width in pixels before being sent to the browser
+PLOT_WIDTH_PIXELS = 1000
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of n_out points of (x, y) that keep its visual shape:
+    the first and last points, and in each bucket the point making the
+    largest triangle with the previously kept point and the next bucket's mean.
+    """
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    if np.isnan(y).any():
+        y = np.nan_to_num(y, nan=float(np.nanmean(y)) if np.isfinite(y).any() else 0.)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, n_out):
+    # keeps the min and max of each bucket, so that short tec switches stay visible
+    n = len(y)
+    n_buckets = n_out // 2
+    if n <= n_out or n_buckets < 1:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    # the last bucket is padded with the last value
+    buckets = np.pad(y, (0, size * n_buckets - n), mode="edge").reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    indices = np.concatenate([[0, n - 1], offsets + np.argmin(buckets, axis=1), offsets + np.argmax(buckets, axis=1)])
+    return np.unique(np.minimum(indices, n - 1))
+
+
+def change_indices(*series):
+    # series that only change when the settings are saved: the points around each change are enough to draw them exactly
+    n = len(series[0])
+    changed = np.zeros(n, dtype=bool)
+    changed[[0, -1]] = True
+    for values in series:
+        steps = np.flatnonzero(np.diff(values) != 0)
+        changed[steps] = True
+        changed[steps + 1] = True
+    return np.flatnonzero(changed)
+
+
+def startup_trace(startup_times, min_y, max_y):
+    # all startups as one trace of vertical segments separated by gaps
+    startup_times = np.asarray(startup_times, dtype="datetime64[ms]")
+    x = np.repeat(startup_times, 3).astype(object)
+    x[2::3] = None
+    y = np.tile(np.array([min_y, max_y, None], dtype=object), len(startup_times))
+    return go.Scatter(x=x, y=y, mode="lines", name="Startup", line=dict(width=3, color='rgb(0,180,0)'))
+
+
 def draw_main_grap(time, temperature, heatsink_temperature, target, limithi, limitlo, tec_status, tec_on_cd, startup_times, display_diff):
     if len(time) == 0:
         return None
 
+    time = np.asarray(time, dtype="datetime64[ns]")
+    temperature, heatsink_temperature = np.asarray(temperature, dtype=float), np.asarray(heatsink_temperature, dtype=float)
+    tec_status, tec_on_cd = np.asarray(tec_status, dtype=float), np.asarray(tec_on_cd, dtype=float)
+    # time as float minutes, for the derivatives and the decimation
+    time_minutes = (time - time[0]) / np.timedelta64(1, "m")
+
     if display_diff:
-        time_delta = (time.iloc[1:].copy().reset_index(drop=True) - time.iloc[:-1].copy().reset_index(drop=True)) / pd.Timedelta(seconds=60)
-        temperature = temperature.copy().diff().iloc[1:].reset_index(drop=True) / time_delta.values
-        heatsink_temperature = heatsink_temperature.copy().diff().iloc[1:].reset_index(drop=True) / time_delta.values
-        time = time.iloc[1:].copy().reset_index(drop=True)
-            
+        time_delta = np.diff(time_minutes)
+        temperature = np.diff(temperature) / time_delta
+        heatsink_temperature = np.diff(heatsink_temperature) / time_delta
+        time, time_minutes = time[1:], time_minutes[1:]
+        tec_status, tec_on_cd = tec_status[1:], tec_on_cd[1:]
+        if len(time) == 0:
+            return None
+
         fig = make_subplots(specs=[[{"secondary_y": True}]])
-    
+
         # get secondary y axis height
-        min_sec_y, max_sec_y = min(heatsink_temperature) - 1, max(heatsink_temperature) + 1
-    
-        # make tec status values in the heatsink temp range
-        tec_status_filter_on = tec_status == 1
-        tec_status_cp = tec_status.copy()
-        tec_status_cp[tec_status_filter_on] = max_sec_y
-        tec_status_cp[~tec_status_filter_on] = min_sec_y
-    
-        # rework data for tec display
-        # tec_status_time_rw, tec_status_onoff_rw = rework_onoff_with_times(time, tec_status_cp)
-        # tec_cd_time_rw, tec_cd_onoff_rw = rework_onoff_with_times(time, tec_on_cd)
-    
+        min_sec_y, max_sec_y = np.nanmin(heatsink_temperature) - 1, np.nanmax(heatsink_temperature) + 1
+
+        # make tec status values in the heatsink temp range (fractions of time on for rollups)
+        tec_status_cp = min_sec_y + tec_status * (max_sec_y - min_sec_y)
+
         # TEC status
+        idx = minmax_indices(tec_status_cp, PLOT_WIDTH_PIXELS)
         fig.add_trace(
-        #    go.Scatter(x=tec_status_time_rw, y=tec_status_onoff_rw, name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
-        #               fill='tozeroy'),
-            go.Scatter(x=time, y=tec_status_cp, name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
+            go.Scatter(x=time[idx], y=tec_status_cp[idx], name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
                        fill='tozeroy'),
             secondary_y=True,
         )
         # & tec on cd
+        idx = minmax_indices(tec_on_cd, PLOT_WIDTH_PIXELS)
         fig.add_trace(
-        #    go.Scatter(x=tec_cd_time_rw, y=tec_cd_onoff_rw, name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
-        #               fill='tozeroy'),
-            go.Scatter(x=time, y=tec_on_cd, name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
+            go.Scatter(x=time[idx], y=tec_on_cd[idx], name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
                        fill='tozeroy'),
             secondary_y=True,
         )
-    
+
         # Temperature measures
+        idx = lttb_indices(time_minutes, temperature, PLOT_WIDTH_PIXELS)
         fig.add_trace(
-            go.Scatter(x=time, y=temperature, name="Measured", line=dict(color='blue')),
+            go.Scatter(x=time[idx], y=temperature[idx], name="Measured", line=dict(color='blue')),
             secondary_y=False,
         )
-    
+
         # Heatsink temperature measures
+        idx = lttb_indices(time_minutes, heatsink_temperature, PLOT_WIDTH_PIXELS)
         fig.add_trace(
-            go.Scatter(x=time, y=heatsink_temperature, name="Heatsink", line=dict(color='red')),
+            go.Scatter(x=time[idx], y=heatsink_temperature[idx], name="Heatsink", line=dict(color='red')),
             secondary_y=True,
         )
-    
+
         # add startup times
-        for startup_time in startup_times:
-            fig.add_trace(
-                go.Scatter(x=[startup_time, startup_time], y=[min_sec_y, max_sec_y], mode="lines", name="Startup",
-                           line=dict(width=3, color='rgb(0,180,0)')),
-                secondary_y=True,
-            )
-    
+        if len(startup_times) > 0:
+            fig.add_trace(startup_trace(startup_times, min_sec_y, max_sec_y), secondary_y=True)
+
         # Set x-axis title
         fig.update_xaxes(title_text="Time")
-    
+
         # get first y axis range
-        upper_temp_limit = max(temperature)
-        lower_temp_limit = min(temperature)
-    
+        upper_temp_limit = np.nanmax(temperature)
+        lower_temp_limit = np.nanmin(temperature)
+
         # Set y-axes titles
         fig.update_yaxes(title_text="Temperature Δ (°C/min)", range=(lower_temp_limit, upper_temp_limit), secondary_y=False)
         fig.update_yaxes(title_text="Heatsink temperature Δ (°C/min)", range=(min_sec_y, max_sec_y), secondary_y=True)
-    
+
         fig.update_layout(template="plotly_white", margin=dict(t=50, b=50))
-    
+
         return fig
 
+    target, limithi, limitlo = np.asarray(target, dtype=float), np.asarray(limithi, dtype=float), np.asarray(limitlo, dtype=float)
+
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     # get secondary y axis height
-    min_sec_y, max_sec_y = min(0, min(heatsink_temperature) - 1), max(100, max(heatsink_temperature) + 1)
-
-    # make tec status values in the heatsink temp range
-    tec_status_filter_on = tec_status == 1
-    tec_status_cp = tec_status.copy()
-    tec_status_cp[tec_status_filter_on] = max_sec_y
-    tec_status_cp[~tec_status_filter_on] = min_sec_y
+    min_sec_y, max_sec_y = min(0, np.nanmin(heatsink_temperature) - 1), max(100, np.nanmax(heatsink_temperature) + 1)
 
-    # rework data for tec display
-    # tec_status_time_rw, tec_status_onoff_rw = rework_onoff_with_times(time, tec_status_cp)
-    # tec_cd_time_rw, tec_cd_onoff_rw = rework_onoff_with_times(time, tec_on_cd)
+    # make tec status values in the heatsink temp range (fractions of time on for rollups)
+    tec_status_cp = min_sec_y + tec_status * (max_sec_y - min_sec_y)
 
     # TEC status
+    idx = minmax_indices(tec_status_cp, PLOT_WIDTH_PIXELS)
     fig.add_trace(
-    #    go.Scatter(x=tec_status_time_rw, y=tec_status_onoff_rw, name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
-    #               fill='tozeroy'),
-        go.Scatter(x=time, y=tec_status_cp, name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
+        go.Scatter(x=time[idx], y=tec_status_cp[idx], name="TEC status", line=dict(width=.5, color='rgb(255,200,200)'),
                    fill='tozeroy'),
         secondary_y=True,
     )
     # & tec on cd
+    idx = minmax_indices(tec_on_cd, PLOT_WIDTH_PIXELS)
     fig.add_trace(
-    #    go.Scatter(x=tec_cd_time_rw, y=tec_cd_onoff_rw, name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
-    #               fill='tozeroy'),
-        go.Scatter(x=time, y=tec_on_cd, name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
+        go.Scatter(x=time[idx], y=tec_on_cd[idx], name="TEC on CD", line=dict(width=.5, color='rgb(255,219,187)'),
                    fill='tozeroy'),
         secondary_y=True,
     )
 
-    # Limits
+    # Limits, share the same points so that the fill between them stays aligned
+    idx = change_indices(target, limithi, limitlo)
     fig.add_trace(
-        go.Scatter(x=time, y=limithi, name="Upper limit", line=dict(width=0.5, color='#cccccc')),
+        go.Scatter(x=time[idx], y=limithi[idx], name="Upper limit", line=dict(width=0.5, color='#cccccc')),
         secondary_y=False,
     )
     fig.add_trace(
-        go.Scatter(x=time, y=limitlo, name="Lower limit", line=dict(width=0.5, color='#cccccc'), fill='tonexty'),
+        go.Scatter(x=time[idx], y=limitlo[idx], name="Lower limit", line=dict(width=0.5, color='#cccccc'), fill='tonexty'),
         secondary_y=False,
     )
 
     # Target
     fig.add_trace(
-        go.Scatter(x=time, y=target, name="Target", line=dict(color='black')),
+        go.Scatter(x=time[idx], y=target[idx], name="Target", line=dict(color='black')),
         secondary_y=False,
     )
 
     # Temperature measures
+    idx = lttb_indices(time_minutes, temperature, PLOT_WIDTH_PIXELS)
     fig.add_trace(
-        go.Scatter(x=time, y=temperature, name="Measured", line=dict(color='blue')),
+        go.Scatter(x=time[idx], y=temperature[idx], name="Measured", line=dict(color='blue')),
         secondary_y=False,
     )
 
     # Heatsink temperature measures
+    idx = lttb_indices(time_minutes, heatsink_temperature, PLOT_WIDTH_PIXELS)
     fig.add_trace(
-        go.Scatter(x=time, y=heatsink_temperature, name="Heatsink", line=dict(color='red')),
+        go.Scatter(x=time[idx], y=heatsink_temperature[idx], name="Heatsink", line=dict(color='red')),
         secondary_y=True,
     )
 
     # add startup times
-    for startup_time in startup_times:
-        fig.add_trace(
-            go.Scatter(x=[startup_time, startup_time], y=[min_sec_y, max_sec_y], mode="lines", name="Startup",
-                       line=dict(width=3, color='rgb(0,180,0)')),
-            secondary_y=True,
-        )
+    if len(startup_times) > 0:
+        fig.add_trace(startup_trace(startup_times, min_sec_y, max_sec_y), secondary_y=True)
 
     # Set x-axis title
     fig.update_xaxes(title_text="Time")
 
     # get first y axis range
-    upper_temp_limit = max(max(temperature), max(limithi)) + 1
-    lower_temp_limit = min(min(temperature), min(limitlo)) - 1
+    upper_temp_limit = max(np.nanmax(temperature), np.nanmax(limithi)) + 1
+    lower_temp_limit = min(np.nanmin(temperature), np.nanmin(limitlo)) - 1
 
     # Set y-axes titles
     fig.update_yaxes(title_text="Temperature (°C)", range=(lower_temp_limit, upper_temp_limit), secondary_y=False)
@@ -325,6 +572,31 @@ TECCD_MIN = 10
 TECCD_MAX = 300
 TECCD_STEP = 1
 
+def zone_settings(zone):
+    # settings of one zone in the sidebar; the ids carry the zone so that one callback serves all zones
+    return html.Div([
+        html.Hr(),
+        html.P(zone.capitalize(), className="lead"),
+        html.Hr(),
+        html.Div([
+            html.P("Status:", style={"display": "inline-block", "width": "60%"}),
+            dcc.Dropdown(["ON", "OFF"], id={"type": "set-status", "zone": zone}, style={"display": "inline-block", "width": "40%", "text-align": "right"})
+        ]),
+        html.Div([
+            html.P("Target temperature (°C): ", style={"display": "inline-block", "width": "80%"}),
+            dcc.Input(id={"type": "set-target-temp", "zone": zone}, type="number", min=TTEMP_MIN, max=TTEMP_MAX, step=TTEMP_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
+        ]),
+        html.Div([
+            html.P("Tolerance (°C): +/-", style={"display": "inline-block", "width": "80%"}),
+            dcc.Input(id={"type": "set-temperature-deviation", "zone": zone}, type="number", min=TEMPDEV_MIN, max=TEMPDEV_MAX, step=TEMPDEV_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
+        ]),
+        html.Div([
+            html.P("TEC cooldown (seconds):", style={"display": "inline-block", "width": "80%"}),
+            dcc.Input(id={"type": "set-tec-cooldown", "zone": zone}, type="number", min=TECCD_MIN, max=TECCD_MAX, step=TECCD_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
+        ]),
+    ])
+
+
 sidebar = html.Div(
     [
         html.H2("WineC", className="display-4"),
@@ -336,13 +608,15 @@ sidebar = html.Div(
         html.Hr(),
         html.Div([
             html.P("Display last (min)", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(min=1, max=1440, step=1, value=60, id='display-length-slider', type="number",
+            dcc.Input(min=1, max=43200, step=1, value=60, id='display-length-slider', type="number",
                       style={"display": "inline-block", "width": "20%", "text-align": "right"}),
             dbc.Switch(
                 id="diff-switch",
                 label="Display differences",
                 value=False,
             ),
+            dcc.Checklist([{"label": f" {zone.capitalize()}", "value": zone} for zone in ZONES], value=list(ZONES), id="zone-select",
+                          inline=True, inputStyle={"margin-left": "1rem"}),
             html.Button('Refresh', id='refresh-button', style={"width": "100%"}, n_clicks=0),
         ]),
         html.Hr(),
@@ -351,83 +625,30 @@ sidebar = html.Div(
             dcc.Input(id="set-cycle-length", type="number", min=CLEN_MIN, max=CLEN_MAX, step=CLEN_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
         ]),
         html.P(id="obs-cycle-length", style={"color": "#aaaaaa"}),
-        html.Hr(),
-        html.P("Left", className="lead"),
-        html.Hr(),
-        html.Div([
-            html.P("Status:", style={"display": "inline-block", "width": "60%"}),
-            dcc.Dropdown(["ON", "OFF"], id="set-left-status", style={"display": "inline-block", "width": "40%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("Target temperature (°C): ", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-left-target-temp", type="number", min=TTEMP_MIN, max=TTEMP_MAX, step=TTEMP_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("Tolerance (°C): +/-", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-left-temperature-deviation", type="number", min=TEMPDEV_MIN, max=TEMPDEV_MAX, step=TEMPDEV_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("TEC cooldown (seconds):", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-left-tec-cooldown", type="number", min=TECCD_MIN, max=TECCD_MAX, step=TECCD_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
-        html.Hr(),
-        html.P("Right", className="lead"),
-        html.Hr(),
-        html.Div([
-            html.P("Status:", style={"display": "inline-block", "width": "60%"}),
-            dcc.Dropdown(["ON", "OFF"], id="set-right-status", style={"display": "inline-block", "width": "40%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("Target temperature (°C): ", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-right-target-temp", type="number", min=TTEMP_MIN, max=TTEMP_MAX, step=TTEMP_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("Tolerance (°C): +/-", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-right-temperature-deviation", type="number", min=TEMPDEV_MIN, max=TEMPDEV_MAX, step=TEMPDEV_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
-        html.Div([
-            html.P("TEC cooldown (seconds):", style={"display": "inline-block", "width": "80%"}),
-            dcc.Input(id="set-right-tec-cooldown", type="number", min=TECCD_MIN, max=TECCD_MAX, step=TECCD_STEP, style={"display": "inline-block", "width": "20%", "text-align": "right"})
-        ]),
+        *[zone_settings(zone) for zone in ZONES],
     ],
-    style=SIDEBAR_STYLE,
+    style={**SIDEBAR_STYLE, "overflow-y": "auto"},
 )
 
-content = html.Div(
-    [
-        html.Div([
-            html.H2(id="current-backend-status", className="lead"),
-            html.H2(children='Left compartment'),
-            html.Div([
-                html.Div([
-                    html.Div([dcc.Graph(id='live-update-graph-left')])
-                ], style={'width': '60%', 'display': 'table-cell', 'vertical-align': 'middle'}),
-                html.Div([
-                    html.P(id="left-frac-on"),
-                    html.P(id="left-watts"),
-                    html.P(id="left-tempdec"),
-                    html.P(id="left-tempinc"),
-                    html.P(id="left-tecbased-tempdec"),
-                    html.P(id="left-tecbased-tempinc"),
-                ], style={'width': '40%', 'display': 'table-cell', 'vertical-align': 'middle', "padding": "0rem 2rem"}),
-            ], style={"display": "table", 'width': '100%'})
-        ], id='left-div', style={'width': '100%', 'display': 'inline-block'}),
+
+def zone_content(zone):
+    # graph and statistics of one zone
+    return html.Div([
+        html.H2(children=f'{zone.capitalize()} compartment'),
         html.Div([
-            html.H2(children='Right compartment'),
             html.Div([
-                html.Div([
-                    html.Div([dcc.Graph(id='live-update-graph-right')])
-                ], style={'width': '60%', 'display': 'table-cell', 'vertical-align': 'middle'}),
-                html.Div([
-                    html.P(id="right-frac-on"),
-                    html.P(id="right-watts"),
-                    html.P(id="right-tempdec"),
-                    html.P(id="right-tempinc"),
-                    html.P(id="right-tecbased-tempdec"),
-                    html.P(id="right-tecbased-tempinc"),
-                ], style={'width': '40%', 'display': 'table-cell', 'vertical-align': 'middle', "padding": "0rem 2rem"}),
-            ], style={"display": "table", 'width': '100%'})
-        ], id='right-div', style={'width': '100%', 'display': 'inline-block'}),
+                html.Div([dcc.Graph(id={"type": "zone-graph", "zone": zone})])
+            ], style={'width': '60%', 'display': 'table-cell', 'vertical-align': 'middle'}),
+            html.Div(id={"type": "zone-stats", "zone": zone},
+                     style={'width': '40%', 'display': 'table-cell', 'vertical-align': 'middle', "padding": "0rem 2rem"}),
+        ], style={"display": "table", 'width': '100%'})
+    ], id={"type": "zone-div", "zone": zone}, style={'width': '100%', 'display': 'inline-block'})
+
+
+content = html.Div(
+    [
+        html.H2(id="current-backend-status", className="lead"),
+        *[zone_content(zone) for zone in ZONES],
     ], id="page-content", style=CONTENT_STYLE
 )
 
@@ -441,29 +662,21 @@ app.layout = html.Div(
 
 @callback(
     Output('set-cycle-length', 'value'),
-    Output('set-left-status', 'value'),
-    Output('set-left-target-temp', 'value'),
-    Output('set-left-temperature-deviation', 'value'),
-    Output('set-left-tec-cooldown', 'value'),
-    Output('set-right-status', 'value'),
-    Output('set-right-target-temp', 'value'),
-    Output('set-right-temperature-deviation', 'value'),
-    Output('set-right-tec-cooldown', 'value'),
+    Output({"type": "set-status", "zone": ALL}, 'value'),
+    Output({"type": "set-target-temp", "zone": ALL}, 'value'),
+    Output({"type": "set-temperature-deviation", "zone": ALL}, 'value'),
+    Output({"type": "set-tec-cooldown", "zone": ALL}, 'value'),
     Input('json-load', 'n_clicks')
 )
 def set_cycle_length(n_clicks):
+    # one value per zone, in the order of ZONES (the order of the layout)
     params = load_params_()
     return (
         params['loop_delay_seconds'],
-        'ON' if params['left']['status'] else 'OFF',
-        params['left']['target_temperature'],
-        params['left']['temperature_deviation'],
-        params['left']['tec_cooldown_seconds'],
-        'ON' if params['right']['status'] else 'OFF',
-        params['right']['target_temperature'],
-        params['right']['temperature_deviation'],
-        params['right']['tec_cooldown_seconds'],
-
+        ['ON' if params[zone]['status'] else 'OFF' for zone in ZONES],
+        [params[zone]['target_temperature'] for zone in ZONES],
+        [params[zone]['temperature_deviation'] for zone in ZONES],
+        [params[zone]['tec_cooldown_seconds'] for zone in ZONES],
     )
 
 
@@ -471,53 +684,38 @@ def set_cycle_length(n_clicks):
     Output('json-placeholder', 'children'),
     Input('json-save', 'n_clicks'),
     State('set-cycle-length', 'value'),
-    State('set-left-status', 'value'),
-    State('set-left-target-temp', 'value'),
-    State('set-left-temperature-deviation', 'value'),
-    State('set-left-tec-cooldown', 'value'),
-    State('set-right-status', 'value'),
-    State('set-right-target-temp', 'value'),
-    State('set-right-temperature-deviation', 'value'),
-    State('set-right-tec-cooldown', 'value'),
+    State({"type": "set-status", "zone": ALL}, 'value'),
+    State({"type": "set-target-temp", "zone": ALL}, 'value'),
+    State({"type": "set-temperature-deviation", "zone": ALL}, 'value'),
+    State({"type": "set-tec-cooldown", "zone": ALL}, 'value'),
     prevent_initial_call=True
 )
-def update_output(n_clicks, cycle_len, left_status, left_ttemp, left_tempdev, left_teccd, right_status, right_ttemp, right_tempdev, right_teccd):
+def update_output(n_clicks, cycle_len, statuses, ttemps, tempdevs, teccds):
     # check values
     if (cycle_len < CLEN_MIN) or (cycle_len > CLEN_MAX) or (((1 / CLEN_STEP) * cycle_len) % 1 != 0):
         return "Invalid settings cycle length"
-    if left_status not in ("ON", "OFF"):
-        return "Invalid settings for left status"
-    if (left_ttemp < TTEMP_MIN) or (left_ttemp > TTEMP_MAX) or (((1 / TTEMP_STEP) * left_ttemp) % 1 != 0):
-        return "Invalid settings for left temp target"
-    if (left_tempdev < TEMPDEV_MIN) or (left_tempdev > TEMPDEV_MAX) or (((1 / TEMPDEV_STEP) * left_tempdev) % 1 != 0):
-        return "Invalid settings for left temp tolerance"
-    if (left_teccd < TECCD_MIN) or (left_teccd > TECCD_MAX) or (((1 / TECCD_STEP) * left_teccd) % 1 != 0):
-        return "Invalid settings for left TEC CD"
-    if right_status not in ("ON", "OFF"):
-        return "Invalid settings for right status"
-    if (right_ttemp < TTEMP_MIN) or (right_ttemp > TTEMP_MAX) or (((1 / TTEMP_STEP) * right_ttemp) % 1 != 0):
-        return "Invalid settings for right temp target"
-    if (right_tempdev < TEMPDEV_MIN) or (right_tempdev > TEMPDEV_MAX) or (((1 / TEMPDEV_STEP) * right_tempdev) % 1 != 0):
-        return "Invalid settings for right temp tolerance"
-    if (right_teccd < TECCD_MIN) or (right_teccd > TECCD_MAX) or (((1 / TECCD_STEP) * right_teccd) % 1 != 0):
-        return "Invalid settings for right TEC CD"
-    # save to json
-    params = {
-        "loop_delay_seconds": cycle_len,
-        "left": {
-            "status": True if left_status == "ON" else False,
-            "target_temperature": left_ttemp,
-            "temperature_deviation": left_tempdev,
-            "tec_cooldown_seconds": left_teccd,
-        },
-        "right": {
-            "status": True if right_status == "ON" else False,
-            "target_temperature": right_ttemp,
-            "temperature_deviation": right_tempdev,
-            "tec_cooldown_seconds": right_teccd,
-        }
-    }
-    save_params(params)
+    for zone, status, ttemp, tempdev, teccd in zip(ZONES, statuses, ttemps, tempdevs, teccds):
+        if status not in ("ON", "OFF"):
+            return f"Invalid settings for {zone} status"
+        if (ttemp < TTEMP_MIN) or (ttemp > TTEMP_MAX) or (((1 / TTEMP_STEP) * ttemp) % 1 != 0):
+            return f"Invalid settings for {zone} temp target"
+        if (tempdev < TEMPDEV_MIN) or (tempdev > TEMPDEV_MAX) or (((1 / TEMPDEV_STEP) * tempdev) % 1 != 0):
+            return f"Invalid settings for {zone} temp tolerance"
+        if (teccd < TECCD_MIN) or (teccd > TECCD_MAX) or (((1 / TECCD_STEP) * teccd) % 1 != 0):
+            return f"Invalid settings for {zone} TEC CD"
+    # save to json, keeping the settings that cannot be edited here
+    params = copy.deepcopy(load_params_())
+    params["loop_delay_seconds"] = cycle_len
+    for zone, status, ttemp, tempdev, teccd in zip(ZONES, statuses, ttemps, tempdevs, teccds):
+        params.setdefault(zone, {})
+        params[zone]["status"] = True if status == "ON" else False
+        params[zone]["target_temperature"] = ttemp
+        params[zone]["temperature_deviation"] = tempdev
+        params[zone]["tec_cooldown_seconds"] = teccd
+    try:
+        save_params(params)
+    except ValueError as error:
+        return f"Not saved: {error}"
     return "Saved"
 
 
@@ -551,115 +749,111 @@ def side_stats_avgteconoffincreasedecrease(times_minutes, tec_measurements, temp
     return avg_var
 
 
+# consumption of one tec, for the statistics
+WATTS_PER_TEC = 85
+
+
+def zone_stats(entries, resolution_name=None):
+    # statistics of one zone over the window, as the lines shown next to its graph
+    # from a rollup, tec_status is the fraction of each bucket spent on: the time on still averages, but the stats that need
+    # to know when the tec was on or switched do not
+    zero_time = entries.time.iloc[-1]
+    times_minutes = ((zero_time - entries.time) / timedelta(minutes=1)).values
+    total_time = (zero_time - entries.time.iloc[0]) / timedelta(minutes=1)
+    tec_measurements, temp_measurements = entries.tec_status.values, entries.temperature.values
+
+    # pct time on
+    pct_time_on = lr_timeonoffstats(total_time=total_time, times_minutes=times_minutes, tec_measurements=tec_measurements)
+    lines = [f"Fraction time ON: {100 * pct_time_on:.1f}%",
+             f"Average consumption for {WATTS_PER_TEC}W TEC: {pct_time_on * WATTS_PER_TEC:.1f}W"]
+    if resolution_name is not None:
+        lines = [f"{line} (from {resolution_name} averages)" for line in lines]
+        lines.append("Temperature variations with the TEC ON/OFF: only for windows short enough to show every measurement")
+        return [html.P(line) for line in lines]
+
+    # median var
+    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements, temp_measurements=temp_measurements, increase=False)
+    lines.append(f"Mean temperature decrease when TEC is ON: {median_var:+.3f}°C/min")
+    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements, temp_measurements=temp_measurements, increase=True)
+    lines.append(f"Mean temperature increase when TEC is OFF: {median_var:+.3f}°C/min")
+
+    # tec based stats
+    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements, temp_measurements=temp_measurements, increase=False)
+    lines.append(f"Mean temperature decrease between TEC switches: {avg_var:+.3f}°C/min")
+    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements, temp_measurements=temp_measurements, increase=True)
+    lines.append(f"Mean temperature increase between TEC switches: {avg_var:+.3f}°C/min")
+    return [html.P(line) for line in lines]
+
+
 @callback(
     Output('current-backend-status', 'children'),
-    Output('live-update-graph-left', 'figure'),
-    Output('live-update-graph-right', 'figure'),
-    Output("left-frac-on", "children"),
-    Output("right-frac-on", "children"),
-    Output("left-watts", "children"),
-    Output("right-watts", "children"),
-    Output("left-tempinc", "children"),
-    Output("right-tempinc", "children"),
-    Output("left-tempdec", "children"),
-    Output("right-tempdec", "children"),
-    Output("left-tecbased-tempdec", "children"),
-    Output("left-tecbased-tempinc", "children"),
-    Output("right-tecbased-tempdec", "children"),
-    Output("right-tecbased-tempinc", "children"),
+    Output({"type": "zone-graph", "zone": ALL}, 'figure'),
+    Output({"type": "zone-stats", "zone": ALL}, 'children'),
+    Output({"type": "zone-div", "zone": ALL}, 'style'),
     Output("obs-cycle-length", "children"),
     Input('display-length-slider', 'value'),
     Input('refresh-button', 'n_clicks'),
     Input('diff-switch', 'value'),
+    Input('zone-select', 'value'),
 )
-def callback_update_from_db(param_minutes, n, diff_switch):
+def callback_update_from_db(param_minutes, n, diff_switch, selected_zones=None):
+    # only the selected zones are queried and drawn, the others are hidden
+    selected_zones = [zone for zone in ZONES if selected_zones is None or zone in selected_zones]
     # extract db
-    db_extract = fetch_db(param_minutes)
-    db_extract_entries = get_db_subset(db_extract=db_extract, events=["entry",])
-    db_extract_startups = get_db_subset(db_extract=db_extract, events=["startup",])
-
-    # prepare some variables
-    zero_time = db_extract_entries.time.tolist()[-1]
-    times_minutes = ((zero_time - db_extract_entries.time) / timedelta(minutes=1)).values
-    total_time = (zero_time - db_extract_entries.time.tolist()[0]) / timedelta(minutes=1)
-    tec_measurements, temp_measurements = {}, {}
-    for side in ("left", "right"):
-        tec_measurements[side] = db_extract_entries[f"{side}_tec_status"].values
-        temp_measurements[side] = db_extract_entries[f"{side}_temperature"].values
-
-    # current backend stats
-    seen_last_since = (datetime.now() - zero_time) / timedelta(seconds=1)
-    # time out is cycle length + 5 seconds tolerance
-    params = load_params_()
-    timeout_time = params["loop_delay_seconds"] + 5
-    backend_status = "ALIVE" if seen_last_since < timeout_time else "AWOL"
-    backend_status_str = f"Backend status is currently: {backend_status} (refreshed {seen_last_since:.0f} seconds ago)"
-
-    # left fig
-    left_fig = draw_main_grap(time=db_extract_entries.time, temperature=db_extract_entries.left_temperature, heatsink_temperature=db_extract_entries.left_heatsink_temperature,
-                              target=db_extract_entries.left_target, limithi=db_extract_entries.left_limithi,
-                              limitlo=db_extract_entries.left_limitlo, tec_status=db_extract_entries.left_tec_status,
-                              tec_on_cd=db_extract_entries.left_tec_on_cd,
-                              startup_times=db_extract_startups.time,
-                              display_diff=diff_switch)
-
-    # right fig
-    right_fig = draw_main_grap(time=db_extract_entries.time, temperature=db_extract_entries.right_temperature, heatsink_temperature=db_extract_entries.right_heatsink_temperature,
-                               target=db_extract_entries.right_target, limithi=db_extract_entries.right_limithi,
-                               limitlo=db_extract_entries.right_limitlo, tec_status=db_extract_entries.right_tec_status,
-                               tec_on_cd=db_extract_entries.right_tec_on_cd,
-                               startup_times=db_extract_startups.time,
-                               display_diff=diff_switch)
-
-    # pct time on
-    WATTS_PER_TEC = 85
-    pct_time_on = lr_timeonoffstats(total_time=total_time, times_minutes=times_minutes, tec_measurements=tec_measurements["left"])
-    left_pct_time_on_str = f"Fraction time ON: {100 * pct_time_on:.1f}%"
-    left_watts_str = f"Average consumption for {WATTS_PER_TEC}W TEC: {pct_time_on * WATTS_PER_TEC:.1f}W"
-    pct_time_on = lr_timeonoffstats(total_time=total_time, times_minutes=times_minutes, tec_measurements=tec_measurements["right"])
-    right_pct_time_on_str = f"Fraction time ON: {100 * pct_time_on:.1f}%"
-    right_watts_str = f"Average consumption for {WATTS_PER_TEC}W TEC: {pct_time_on * WATTS_PER_TEC:.1f}W"
-
-    # median var
-    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["left"], temp_measurements=temp_measurements["left"], increase=True)
-    left_temp_inc_str = f"Mean temperature increase when TEC is OFF: {median_var:+.3f}°C/min"
-    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["right"], temp_measurements=temp_measurements["right"], increase=True)
-    right_temp_inc_str = f"Mean temperature increase when TEC is OFF: {median_var:+.3f}°C/min"
-    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["left"], temp_measurements=temp_measurements["left"], increase=False)
-    left_temp_dec_str = f"Mean temperature decrease when TEC is ON: {median_var:+.3f}°C/min"
-    median_var = lr_stats_avgincdecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["right"], temp_measurements=temp_measurements["right"], increase=False)
-    right_temp_dec_str = f"Mean temperature decrease when TEC is ON: {median_var:+.3f}°C/min"
-
-    # tec based stats
-    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["left"], temp_measurements=temp_measurements["left"], increase=False)
-    left_tecb_tempdec = f"Mean temperature decrease between TEC switches: {avg_var:+.3f}°C/min"
-    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["left"], temp_measurements=temp_measurements["left"], increase=True)
-    left_tecb_tempinc = f"Mean temperature increase between TEC switches: {avg_var:+.3f}°C/min"
-    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["right"], temp_measurements=temp_measurements["right"], increase=False)
-    right_tecb_tempdec = f"Mean temperature decrease between TEC switches: {avg_var:+.3f}°C/min"
-    avg_var = side_stats_avgteconoffincreasedecrease(times_minutes=times_minutes, tec_measurements=tec_measurements["right"], temp_measurements=temp_measurements["right"], increase=True)
-    right_tecb_tempinc = f"Mean temperature increase between TEC switches: {avg_var:+.3f}°C/min"
-
-    # observed cycle length
-    avg_cl = float(- np.mean(np.diff(times_minutes)) * 60)
-    obs_cycle_length_str = f"Observed cycle length: {avg_cl:.2f}s"
+    fetched = fetch_db(param_minutes, selected_zones)
+    resolution_name = pick_resolution(param_minutes)
+
+    figures, stats, styles = [], [], []
+    last_times = []
+    for zone in ZONES:
+        if zone not in selected_zones:
+            figures.append(no_update)
+            stats.append(no_update)
+            styles.append({'width': '100%', 'display': 'none'})
+            continue
+        db_extract_entries, db_extract_startups = fetched[zone]
+        styles.append({'width': '100%', 'display': 'inline-block'})
+        if len(db_extract_entries) == 0:
+            figures.append(None)
+            stats.append([])
+            continue
+        last_times.append(db_extract_entries.time.iloc[-1])
+        figures.append(draw_main_grap(time=db_extract_entries.time, temperature=db_extract_entries.temperature, heatsink_temperature=db_extract_entries.heatsink_temperature,
+                                      target=db_extract_entries.target, limithi=db_extract_entries.limithi,
+                                      limitlo=db_extract_entries.limitlo, tec_status=db_extract_entries.tec_status,
+                                      tec_on_cd=db_extract_entries.tec_on_cd,
+                                      startup_times=db_extract_startups.time,
+                                      display_diff=diff_switch))
+        stats.append(zone_stats(db_extract_entries, resolution_name))
+
+    # current backend stats, from the last raw measurement (rollup buckets can be an hour long)
+    zero_time = max(last_times) if last_times else None
+    last_measurement_time = zero_time if resolution_name is None else db_get_last_measurement_time()
+    if last_measurement_time is None:
+        last_measurement_time = zero_time
+    if last_measurement_time is None:
+        backend_status_str = "Backend status is currently: AWOL (no measurements in the window)"
+    else:
+        seen_last_since = (datetime.now() - last_measurement_time) / timedelta(seconds=1)
+        # time out is cycle length + delay before buffered measurements are written + 5 seconds tolerance
+        params = load_params_()
+        timeout_time = params["loop_delay_seconds"] + params.get("db_flush_seconds", 0) + 5
+        backend_status = "ALIVE" if seen_last_since < timeout_time else "AWOL"
+        backend_status_str = f"Backend status is currently: {backend_status} (refreshed {seen_last_since:.0f} seconds ago)"
+
+    # observed cycle length, only meaningful on raw measurements
+    if resolution_name is None:
+        cycle_times = [fetched[zone][0].time for zone in selected_zones if len(fetched[zone][0]) > 1]
+        avg_cl = float(np.mean(np.diff(cycle_times[0].values)) / np.timedelta64(1, "s")) if cycle_times else np.nan
+        obs_cycle_length_str = f"Observed cycle length: {avg_cl:.2f}s"
+    else:
+        obs_cycle_length_str = f"Displaying {resolution_name} averages"
 
     return (
         backend_status_str,
-        left_fig,
-        right_fig,
-        left_pct_time_on_str,
-        right_pct_time_on_str,
-        left_watts_str,
-        right_watts_str,
-        left_temp_inc_str,
-        right_temp_inc_str,
-        left_temp_dec_str,
-        right_temp_dec_str,
-        left_tecb_tempdec,
-        left_tecb_tempinc,
-        right_tecb_tempdec,
-        right_tecb_tempinc,
+        figures,
+        stats,
+        styles,
         obs_cycle_length_str,
         )
 
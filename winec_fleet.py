@@ -0,0 +1,230 @@
+"""
+Fleet overview of several winec cabinets, each with its own backend and database.
+
+Every site is queried concurrently from a background thread, with a timeout
+per site; the page shows the latest result of each site, so an unreachable
+site only shows as such and never delays the others.
+
+python winec_fleet.py --sites_file sites.json
+
+sites.json is a list of sites, e.g.
+[{"name": "cellar", "db_platform": "mariadb", "db_host": "192.168.1.13", "db_user": "cav", "db_password": "caveavin", "db_database": "winec",
+  "url": "http://192.168.1.13:8050"},
+ {"name": "garage", "db_platform": "sqlite3", "rundir": "/mnt/garage/winec_rundir"}]
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from dash import Dash, html, dcc, Input, Output, callback
+import dash_bootstrap_components as dbc
+from winec_log import structured_logger
+from winec_db import db_reader, from_wall_seconds, CENTI, TEC_STATUS_FLAG, TEC_ON_CD_FLAG, EVENT_CODES
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dash_ip", default="192.168.1.13")
+parser.add_argument("--dash_port", default=8051)
+parser.add_argument("--sites_file", default="sites.json")
+parser.add_argument("--site_timeout_seconds", default=5)  # a site answering later is shown as unreachable until it answers
+parser.add_argument("--refresh_seconds", default=30)
+args = parser.parse_args()
+
+logger = structured_logger("winec_fleet")
+
+
+def log(s, level=logging.INFO, key=None, **fields):
+    logger.log(s, level=level, key=key, **fields)
+
+
+# latest sample of each zone with the setpoints in force: both subqueries stop at the first matching row
+LATEST_QUERY = ("SELECT z.name, s.time, s.temperature, e.target, e.limithi, e.limitlo, s.heatsink_temperature, s.tec_flags FROM zone_names z "
+                "JOIN zone_samples s ON s.zone_id = z.zone_id AND s.time = (SELECT time FROM zone_samples WHERE zone_id = z.zone_id ORDER BY time DESC LIMIT 1) "
+                f"LEFT JOIN zone_events e ON e.zone_id = z.zone_id AND e.event = {EVENT_CODES['setpoint']} AND e.time = "
+                f"(SELECT MAX(time) FROM zone_events WHERE zone_id = z.zone_id AND event = {EVENT_CODES['setpoint']} AND time <= s.time) ORDER BY z.name")
+# fraction of time each tec was on over the last hour, from the 1 minute rollups
+DUTY_QUERY = "SELECT zone, SUM(tec_status_sum) / SUM(n_entries) FROM zone_rollup_1m WHERE bucket >= :since AND n_entries > 0 GROUP BY zone"
+TEMPERATURE_COLUMNS = ("temperature", "target", "limithi", "limitlo", "heatsink_temperature")
+
+
+class site_client:
+    """Reads the latest state of one site from its database.
+
+    The database is opened on first use and kept, with the driver timeouts
+    set to the site timeout, see db_reader.
+    """
+
+    def __init__(self, site, timeout_seconds=5.):
+        self.site = site
+        self.name = site["name"]
+        platform = site.get("db_platform", "mariadb")
+        self.db = db_reader(platform, sqlite_path=os.path.join(site["rundir"], "winec_db_v1.db") if platform == "sqlite3" else None,
+                            host=site.get("db_host", "localhost"), port=site.get("db_port", 3306), user=site.get("db_user", "cav"),
+                            password=site.get("db_password", "caveavin"), database=site.get("db_database", "winec"),
+                            timeout_seconds=timeout_seconds, pool_size=1)
+
+    def fetch(self):
+        """Returns {"zones": zone -> latest entry, with the tec duty cycle of the last hour}."""
+        since = (datetime.now() - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+        zones = {}
+        for zone, sample_time, *values, tec_flags in self.db.read(LATEST_QUERY):
+            entry = {column: None if value is None else value / CENTI for column, value in zip(TEMPERATURE_COLUMNS, values)}
+            entry.update(time=from_wall_seconds(sample_time), tec_status=bool(tec_flags & TEC_STATUS_FLAG), tec_on_cd=bool(tec_flags & TEC_ON_CD_FLAG))
+            zones[zone] = entry
+        for zone, duty in self.db.read(DUTY_QUERY, {"since": since}):
+            if zone in zones and duty is not None:
+                zones[zone]["duty_cycle"] = float(duty)
+        return {"zones": zones}
+
+
+class fleet_poller:
+    """Queries all sites concurrently and keeps the latest result of each.
+
+    Each poll submits one query per site to a thread pool with one worker per
+    site, and waits for them up to timeout_seconds. Results are stored as
+    they arrive, even after the poll gave up on them. A site whose previous
+    query is still running is not queried again, so a hung site holds one
+    worker at most and the other sites are polled as usual.
+    """
+
+    def __init__(self, clients, timeout_seconds=5., log=print):
+        self.clients = clients
+        self.timeout_seconds = timeout_seconds
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(clients)), thread_name_prefix="winec_site")
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        # site name -> {"state": last successful result, "updated_at", "error": error of the last query, None if it succeeded}
+        self.results = {name: {"state": None, "updated_at": None, "error": None} for name in clients}
+
+    def store(self, name, future):
+        try:
+            state = future.result()
+        except Exception as error:
+            with self.lock:
+                self.results[name]["error"] = repr(error)
+            self.log(f"unable to query site {name}", level=logging.WARNING, key=f"site_error_{name}")
+            self.log(f"{error=}", key=f"site_error_detail_{name}")
+            return
+        with self.lock:
+            self.results[name] = {"state": state, "updated_at": datetime.now(), "error": None}
+
+    def poll(self):
+        """Queries every site not busy with a previous query and waits for them, up to the timeout."""
+        futures = []
+        for name, client in self.clients.items():
+            previous = self.in_flight.get(name)
+            if previous is not None and not previous.done():
+                with self.lock:
+                    self.results[name]["error"] = "still waiting for the previous query"
+                continue
+            future = self.in_flight[name] = self.executor.submit(client.fetch)
+            future.add_done_callback(lambda done, name=name: self.store(name, done))
+            futures.append(future)
+        wait(futures, timeout=self.timeout_seconds)
+        for name, future in self.in_flight.items():
+            if not future.done():
+                with self.lock:
+                    self.results[name]["error"] = f"no answer after {self.timeout_seconds}s"
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(result) for name, result in self.results.items()}
+
+    def run(self, period_seconds):
+        while True:
+            started = time.monotonic()
+            self.poll()
+            time.sleep(max(0., period_seconds - (time.monotonic() - started)))
+
+    def start(self, period_seconds):
+        threading.Thread(target=self.run, args=(period_seconds, ), name="winec_fleet_poller", daemon=True).start()
+
+
+def load_sites(path):
+    with open(path, "r") as f:
+        sites = json.load(f)
+    names = [site["name"] for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate site names in {path}")
+    return sites
+
+
+def format_value(value, unit="°C"):
+    return "-" if value is None else f"{value:.1f}{unit}"
+
+
+def site_status(result, now, awol_seconds):
+    # unreachable: no answer; AWOL: the database answers but the backend stopped writing
+    if result["state"] is None:
+        return "UNREACHABLE", "danger"
+    last_times = [entry["time"] for entry in result["state"]["zones"].values()]
+    if len(last_times) == 0 or (now - max(last_times)) / timedelta(seconds=1) > awol_seconds:
+        return "AWOL", "warning"
+    if result["error"] is not None:
+        return "STALE", "secondary"
+    return "ALIVE", "success"
+
+
+def site_card(site, result, now):
+    status, color = site_status(result, now, site.get("awol_seconds", 45))
+    header = [html.Span(site["name"], className="h5 me-2"), dbc.Badge(status, color=color)]
+    if site.get("url"):
+        header.append(html.A("dashboard", href=site["url"], className="ms-2"))
+    body = []
+    if result["error"] is not None:
+        body.append(html.P(result["error"], style={"color": "#aaaaaa"}))
+    if result["state"] is not None:
+        rows = []
+        for zone, entry in result["state"]["zones"].items():
+            age_seconds = (now - entry["time"]) / timedelta(seconds=1)
+            rows.append(html.Tr([
+                html.Td(zone.capitalize()),
+                html.Td(format_value(entry["temperature"])),
+                html.Td("-" if entry["target"] is None else f"{entry['target']:.1f} ± {(entry['limithi'] - entry['target']):.1f}°C"),
+                html.Td(format_value(entry["heatsink_temperature"])),
+                html.Td("ON" if entry["tec_status"] else ("CD" if entry["tec_on_cd"] else "OFF")),
+                html.Td(format_value(100 * entry["duty_cycle"], "%") if "duty_cycle" in entry else "-"),
+                html.Td(f"{age_seconds:.0f}s ago"),
+            ]))
+        header_row = html.Tr([html.Th(column) for column in ("Zone", "Temperature", "Target", "Heatsink", "TEC", "TEC on (1h)", "Measured")])
+        body.append(dbc.Table([html.Thead(header_row), html.Tbody(rows)], size="sm", className="mb-0"))
+        body.append(html.P(f"queried {result['updated_at']:%H:%M:%S}", style={"color": "#aaaaaa"}))
+    return dbc.Card([dbc.CardHeader(header), dbc.CardBody(body)], className="mb-3")
+
+
+sites = load_sites(args.sites_file)
+poller = fleet_poller({site["name"]: site_client(site, float(args.site_timeout_seconds)) for site in sites},
+                      timeout_seconds=float(args.site_timeout_seconds), log=log)
+
+app = Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
+app.layout = html.Div([
+    html.H2("WineC fleet", className="display-4"),
+    html.P(id="fleet-summary", className="lead"),
+    html.Div(id="fleet-sites"),
+    dcc.Interval(id="fleet-interval", interval=int(float(args.refresh_seconds) * 1000)),
+], style={"padding": "2rem 2rem"})
+
+
+@callback(
+    Output("fleet-summary", "children"),
+    Output("fleet-sites", "children"),
+    Input("fleet-interval", "n_intervals"),
+)
+def callback_update_fleet(n_intervals):
+    # only reads the cached results: the poller thread does the querying
+    results = poller.snapshot()
+    now = datetime.now()
+    cards = [site_card(site, results[site["name"]], now) for site in sites]
+    statuses = [site_status(results[site["name"]], now, site.get("awol_seconds", 45))[0] for site in sites]
+    summary = ", ".join(f"{statuses.count(status)} {status.lower()}" for status in ("ALIVE", "STALE", "AWOL", "UNREACHABLE") if status in statuses)
+    return f"{len(sites)} sites: {summary}", cards
+
+
+if __name__ == '__main__':
+    poller.start(float(args.refresh_seconds))
+    app.run(host=args.dash_ip, port=int(args.dash_port))
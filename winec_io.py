@@ -0,0 +1,106 @@
+import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+class io_stage:
+    """Runs the slow I/O of the backend (database, UDP) off the control loop.
+
+    Each lane is a single worker thread, so jobs of one lane run in order and
+    a slow database never holds back a UDP send. A job is skipped if the same
+    job is already queued and not started yet, so a stalled lane does not
+    pile up work.
+    """
+
+    def __init__(self, lanes=("db", "udp"), log=print):
+        self.log = log
+        self.executors = {lane: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"winec_{lane}") for lane in lanes}
+        self.pending = {}
+        self.skipped = {}
+
+    def submit(self, lane, name, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) on the given lane.
+
+        Returns False if the job was skipped because the previous one with the
+        same name is still waiting.
+        """
+        previous = self.pending.get(name)
+        if previous is not None and not previous.running() and not previous.done():
+            self.skipped[name] = self.skipped.get(name, 0) + 1
+            return False
+        self.pending[name] = self.executors[lane].submit(self.run_job, name, fn, *args, **kwargs)
+        return True
+
+    def run_job(self, name, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            self.log(f"error in background job {name}")
+            self.log(f"{error=}")
+            return None
+
+    def shutdown(self, wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+
+class sensor_acquisition:
+    """Reads all the sensors of a cycle at the same time.
+
+    Each read runs in its own daemon thread, so a cycle waits for the slowest
+    sensor instead of the sum of all of them, and a sensor that hangs never
+    blocks the cycle (or the exit of the process) longer than the timeout.
+    A sensor whose previous read is still running is not read again until
+    that read ends.
+    """
+
+    def __init__(self, sensors, log=print, now=datetime.now):
+        # sensors: name -> function returning the measurement
+        self.sensors = sensors
+        self.log = log
+        # timestamps the snapshots, can be replaced by a simulated clock
+        self.now = now
+        self.in_flight = {}
+
+    def start_read(self, name, fn):
+        result = {"done": threading.Event()}
+
+        def read():
+            started = time.monotonic()
+            try:
+                result["value"] = fn()
+            except Exception as error:
+                result["error"] = error
+            result["seconds"] = time.monotonic() - started
+            result["done"].set()
+
+        threading.Thread(target=read, name=f"winec_sensor_{name}", daemon=True).start()
+        return result
+
+    def read(self, timeout_seconds=2.):
+        """Returns one snapshot: {"time": datetime at the start of the reads,
+        "values": name -> measurement (None if failed, timed out or busy),
+        "read_seconds": name -> duration of the reads that ended}.
+        """
+        snapshot = {"time": self.now(), "values": {}, "read_seconds": {}}
+        deadline = time.monotonic() + timeout_seconds
+        started = {}
+        for name, fn in self.sensors.items():
+            snapshot["values"][name] = None
+            previous = self.in_flight.get(name)
+            if previous is not None and not previous["done"].is_set():
+                self.log(f"{name} sensor is still busy with a previous read, skipped")
+                continue
+            started[name] = self.in_flight[name] = self.start_read(name, fn)
+        for name, result in started.items():
+            if not result["done"].wait(max(0., deadline - time.monotonic())):
+                self.log(f"{name} sensor read timed out after {timeout_seconds}s")
+                continue
+            snapshot["read_seconds"][name] = result["seconds"]
+            if "error" in result:
+                self.log(f"unable to read {name} sensor")
+                self.log(f"error={result['error']!r}")
+            else:
+                snapshot["values"][name] = result["value"]
+        return snapshot
@@ -0,0 +1,169 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import collections
+import logging.handlers
+from datetime import datetime
+
+
+def record_event(record):
+    # the structured form of a record: what the file sink and the ring buffer keep
+    event = {
+        "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+        "level": record.levelname,
+        "message": record.getMessage(),
+    }
+    if getattr(record, "key", None) is not None:
+        event["key"] = record.key
+    if getattr(record, "suppressed", 0):
+        event["suppressed"] = record.suppressed
+    event.update(getattr(record, "fields", None) or {})
+    return event
+
+
+class text_formatter(logging.Formatter):
+    """The console format of the winec scripts: date, 4 spaces, message."""
+
+    def format(self, record):
+        line = f"{datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')}    {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        if getattr(record, "suppressed", 0):
+            line += f" ({record.suppressed} similar messages suppressed)"
+        return line
+
+
+class json_formatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        return json.dumps(record_event(record), default=str)
+
+
+class rate_limit_filter(logging.Filter):
+    """Lets at most burst records of a key through every interval_seconds.
+
+    The key is the key given to log(), else the message itself, so the same
+    error repeated at every cycle is logged burst times, then once per
+    interval with the number of copies dropped meanwhile.
+    """
+
+    def __init__(self, interval_seconds=60., burst=3, max_keys=1000, clock=time.monotonic):
+        super().__init__()
+        self.interval_seconds = interval_seconds
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> [start of the interval, records let through, records dropped]
+        self.keys = {}
+
+    def filter(self, record):
+        key = getattr(record, "key", None) or record.getMessage()
+        now = self.clock()
+        with self.lock:
+            state = self.keys.get(key)
+            if state is None or now - state[0] >= self.interval_seconds:
+                record.suppressed = 0 if state is None else state[2]
+                if state is None and len(self.keys) >= self.max_keys:
+                    self.prune(now)
+                self.keys[key] = [now, 1, 0]
+                return True
+            if state[1] < self.burst:
+                state[1] += 1
+                record.suppressed = 0
+                return True
+            state[2] += 1
+            return False
+
+    def prune(self, now):
+        # call with the lock held: forget the keys whose interval is over
+        for key in [key for key, state in self.keys.items() if now - state[0] >= self.interval_seconds]:
+            del self.keys[key]
+
+
+class ring_buffer_handler(logging.Handler):
+    """Keeps the last size events in memory."""
+
+    def __init__(self, size=1000):
+        super().__init__()
+        self.events = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.events.append(record_event(record))
+
+    def recent(self, n=None):
+        events = list(self.events)
+        return events if n is None else events[-n:]
+
+
+class dropping_queue_handler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records when the queue is full instead of raising."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class structured_logger:
+    """Non-blocking logger: the caller only filters and queues the record.
+
+    A listener thread writes the records to the console (text), to a size
+    rotated file (JSON lines) if path is given, and to an in-memory ring
+    buffer of recent events. A slow console only fills the queue; once full,
+    records are dropped and counted rather than stalling the caller.
+    """
+
+    def __init__(self, name, path=None, max_bytes=1_000_000, backup_count=5, ring_size=1000, interval_seconds=60., burst=3,
+                 queue_size=10000, stream=None):
+        console_handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+        console_handler.setFormatter(text_formatter())
+        self.ring = ring_buffer_handler(ring_size)
+        handlers = [console_handler, self.ring]
+        if path is not None:
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+            file_handler.setFormatter(json_formatter())
+            handlers.append(file_handler)
+        self.handler = dropping_queue_handler(queue.Queue(queue_size))
+        self.handler.addFilter(rate_limit_filter(interval_seconds, burst))
+        self.logger = logging.getLogger(name)
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers)
+        self.listener.start()
+        self.stopped = False
+        # registered first, so it runs after the other exit hooks and their last messages are written
+        atexit.register(self.stop)
+
+    def log(self, message, level=logging.INFO, key=None, **fields):
+        """Logs message; records with the same key (by default, the same message) are rate limited."""
+        self.logger.log(level, message, extra={"key": key, "fields": fields})
+
+    def recent(self, n=None):
+        return self.ring.recent(n)
+
+    def dropped(self):
+        return self.handler.dropped
+
+    def stop(self):
+        # writes out the queued records
+        if self.stopped:
+            return
+        self.stopped = True
+        self.logger.handlers = []
+        try:
+            self.listener.stop()
+        except queue.Full:
+            pass
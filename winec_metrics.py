@@ -0,0 +1,166 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class metric:
+    """A counter or gauge, optionally labelled.
+
+    Values are either updated by the code (inc, set) or, when collect is
+    given, read at scrape time from collect(), which returns
+    {label values tuple: value}: the hot path then pays nothing at all.
+    """
+
+    def __init__(self, name, help, kind, labelnames=(), collect=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1.):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0.) + amount
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}")
+        return lines
+
+
+class histogram(metric):
+    """A histogram with fixed bucket upper bounds, optionally labelled."""
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        super().__init__(name, help, "histogram", labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                # per bucket counts (not cumulative), +Inf last, then sum
+                state = self.values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.]
+            state[index] += 1
+            state[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = {labelvalues: list(state) for labelvalues, state in self.values.items()}
+        for labelvalues, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), state[:-1]):
+                cumulative += count
+                labels = format_labels(self.labelnames, labelvalues, extra=[("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class metrics_registry:
+    """The metrics of a process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, new_metric):
+        self.metrics.append(new_metric)
+        return new_metric
+
+    def counter(self, name, help, labelnames=(), collect=None):
+        return self.add(metric(name, help, "counter", labelnames, collect))
+
+    def gauge(self, name, help, labelnames=(), collect=None):
+        return self.add(metric(name, help, "gauge", labelnames, collect))
+
+    def histogram(self, name, help, buckets, labelnames=()):
+        return self.add(histogram(name, help, buckets, labelnames))
+
+    def render(self):
+        lines = []
+        for registered in self.metrics:
+            lines.extend(registered.render())
+        return "\n".join(lines) + "\n"
+
+
+class metrics_server:
+    """Serves a registry on http://host:port/metrics from a daemon thread.
+
+    routes -- other paths to serve: path -> function returning (content type, body).
+    """
+
+    def __init__(self, registry, host="127.0.0.1", port=9110, log=print, routes=None):
+        self.registry = registry
+        self.log = log
+        self.routes = {"/metrics": self.render_metrics, "/": self.render_metrics, **(routes or {})}
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(handler_self):
+                route = self.routes.get(handler_self.path.split("?")[0])
+                if route is None:
+                    handler_self.send_error(404)
+                    return
+                try:
+                    content_type, body = route()
+                    body = body.encode("utf-8")
+                except Exception as error:
+                    self.log(f"error rendering {handler_self.path}")
+                    self.log(f"{error=}")
+                    handler_self.send_error(500)
+                    return
+                handler_self.send_response(200)
+                handler_self.send_header("Content-Type", content_type)
+                handler_self.send_header("Content-Length", str(len(body)))
+                handler_self.end_headers()
+                handler_self.wfile.write(body)
+
+            def log_message(handler_self, format, *args):
+                # scrapes are not worth a log line each
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="winec_metrics", daemon=True)
+
+    def render_metrics(self):
+        return "text/plain; version=0.0.4; charset=utf-8", self.registry.render()
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
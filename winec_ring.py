@@ -0,0 +1,136 @@
+import os
+import math
+import struct
+import numpy as np
+
+RING_MAGIC = b"WINECRNG"
+RING_VERSION = 1
+# the records start on the second page
+RING_HEADER_BYTES = 4096
+RING_HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("capacity", "<u4"), ("record_bytes", "<u4"), ("n_zones", "<u4"),
+                              ("cursor", "<u8"), ("zones", "S3072")])
+RING_CURSOR_OFFSET = RING_HEADER_DTYPE.fields["cursor"][1]
+RING_CURSOR_STRUCT = struct.Struct("<Q")
+RING_SEQ_STRUCT = struct.Struct("<q")
+RING_EVENTS = ("entry", "startup")
+# measurement values of a zone, in the order of the rows of db_store_measurements
+RING_FLOAT_FIELDS = ("temperature", "target", "limithi", "limitlo", "heatsink_temperature")
+RING_FLAG_FIELDS = ("tec_status", "tec_on_cd")
+
+
+def ring_record_dtype(n_zones):
+    # one record per cycle, with one value per zone in each field; aligned, so every record starts on 8 bytes
+    fields = [("seq", "<i8"), ("time", "<i8")]
+    fields += [(name, "<f4", (n_zones, )) for name in RING_FLOAT_FIELDS]
+    fields += [(name, "u1", (n_zones, )) for name in RING_FLAG_FIELDS]
+    fields += [("event", "u1")]
+    return np.dtype(fields, align=True)
+
+
+def ring_record_struct(dtype, n_zones):
+    # the same layout as a struct, to pack a record in one call: fields are contiguous, the padding is at the end
+    fmt = f"<qq{len(RING_FLOAT_FIELDS) * n_zones}f{len(RING_FLAG_FIELDS) * n_zones}BB"
+    return struct.Struct(fmt + f"{dtype.itemsize - struct.calcsize(fmt)}x")
+
+
+class measurement_ring:
+    """Fixed-size ring of the latest measurements in a memory-mapped file, shared between processes.
+
+    The file holds a header (layout, zone names and the write cursor, i.e.
+    the number of records ever written) and one record per cycle, with the
+    values of every zone. Each record is written twice, at its slot and one
+    capacity further, so that the last capacity records are always one
+    contiguous slice: readers get numpy views of the file, with no copy and
+    no query. A record is marked invalid (seq -1) while it is written, then
+    gets its sequence number, then the cursor moves on; a reader copies what
+    it needs, then keeps the records that were not overwritten meanwhile,
+    see unchanged.
+
+    With zones, opens the ring for writing: the file is created again, so
+    the ring only holds the cycles of the running backend and everything
+    older is in the database. Without, maps an existing ring read-only.
+    """
+
+    def __init__(self, path, zones=None, capacity=8640):
+        self.path = path
+        if zones is not None:
+            self.create(list(zones), capacity)
+        self.stat = os.stat(path)
+        header = np.memmap(path, dtype=RING_HEADER_DTYPE, mode="r", shape=())
+        if header["magic"] != RING_MAGIC or header["version"] != RING_VERSION:
+            raise ValueError(f"{path} is not a measurement ring")
+        self.capacity = int(header["capacity"])
+        self.zones = header["zones"].item().decode("ascii").split(",")
+        self.dtype = ring_record_dtype(len(self.zones))
+        if header["record_bytes"] != self.dtype.itemsize or len(self.zones) != header["n_zones"]:
+            raise ValueError(f"unexpected record layout in {path}")
+        mode = "r" if zones is None else "r+"
+        self.header = np.memmap(path, dtype=RING_HEADER_DTYPE, mode=mode, shape=())
+        self.records = np.memmap(path, dtype=self.dtype, mode=mode, offset=RING_HEADER_BYTES, shape=(2 * self.capacity, ))
+        if zones is not None:
+            # the writer packs records with struct into the bytes of the mapping: numpy field by field costs tens of microseconds
+            self.record_struct = ring_record_struct(self.dtype, len(self.zones))
+            self.record_bytes = memoryview(self.records.view(np.uint8).reshape(-1))
+            self.header_bytes = memoryview(self.header.reshape(1).view(np.uint8))
+
+    def create(self, zones, capacity):
+        header = np.zeros((), dtype=RING_HEADER_DTYPE)
+        header["magic"], header["version"], header["capacity"] = RING_MAGIC, RING_VERSION, capacity
+        header["record_bytes"], header["n_zones"] = ring_record_dtype(len(zones)).itemsize, len(zones)
+        header["zones"] = ",".join(zones).encode("ascii")
+        records = np.zeros(2 * capacity, dtype=ring_record_dtype(len(zones)))
+        records["seq"] = -1
+        # written out in full rather than sparse, so that a full disk fails here and not on a later write to the mapping;
+        # replaced in one rename, so that readers never map a half-written file
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(header.tobytes().ljust(RING_HEADER_BYTES, b"\0"))
+            f.write(records.tobytes())
+        os.replace(self.path + ".tmp", self.path)
+
+    def replaced(self):
+        # the backend created the file again (new inode): readers have to map it again
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_size) != (self.stat.st_ino, self.stat.st_size)
+
+    def append(self, seconds, zone_measurements=None, event="entry"):
+        """Adds one record.
+
+        seconds -- the measurement time, in wall clock seconds.
+        zone_measurements -- zone -> (temperature, target, limithi, limitlo, heatsink temperature, tec status, tec on cooldown).
+        """
+        # field by field, then zone by zone, as the subarrays of the record dtype
+        rows = [(zone_measurements or {}).get(zone) for zone in self.zones]
+        n_floats = len(RING_FLOAT_FIELDS)
+        floats = [math.nan if row is None or row[k] is None else row[k] for k in range(n_floats) for row in rows]
+        flags = [row is not None and bool(row[k]) for k in range(n_floats, n_floats + len(RING_FLAG_FIELDS)) for row in rows]
+        cursor, = RING_CURSOR_STRUCT.unpack_from(self.header_bytes, RING_CURSOR_OFFSET)
+        for slot in (cursor % self.capacity, cursor % self.capacity + self.capacity):
+            offset = slot * self.dtype.itemsize
+            self.record_struct.pack_into(self.record_bytes, offset, -1, seconds, *floats, *flags, RING_EVENTS.index(event))
+            RING_SEQ_STRUCT.pack_into(self.record_bytes, offset, cursor)
+        RING_CURSOR_STRUCT.pack_into(self.header_bytes, RING_CURSOR_OFFSET, cursor + 1)
+
+    def read(self, start_seconds, end_seconds):
+        """Returns the records with start_seconds <= time <= end_seconds, the seq of the first one, and the time of the oldest record held.
+
+        The records are a view of the mapped file, oldest first. Records older
+        than the returned time (None if the ring is empty) are only in the
+        database.
+        """
+        cursor = int(self.header["cursor"])
+        # the record after the newest is the next one overwritten: leave it out
+        n_records = min(cursor, self.capacity - 1)
+        end = cursor % self.capacity + self.capacity
+        held = self.records[end - n_records:end]
+        if n_records == 0:
+            return held, cursor, None
+        times = held["time"]
+        first, last = np.searchsorted(times, start_seconds, side="left"), np.searchsorted(times, end_seconds, side="right")
+        return held[first:last], cursor - n_records + first, int(times[0])
+
+    def unchanged(self, records, first_seq):
+        """True for the records of a read that were not overwritten since; call after copying them."""
+        return np.asarray(records["seq"]) == first_seq + np.arange(len(records))
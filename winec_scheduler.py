@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class periodic_job:
+    """One job of the scheduler, with its lateness statistics.
+
+    The period is either a number of seconds or a function returning it, so
+    that a job follows settings changed while the backend runs. If the
+    function fails, the job keeps its last period.
+    """
+
+    # period of a job whose period function failed before ever returning
+    FALLBACK_PERIOD_SECONDS = 1.
+
+    def __init__(self, name, fn, period):
+        self.name = name
+        self.fn = fn
+        self.period = period
+        self.last_period = None
+        self.reset()
+
+    def reset(self):
+        self.runs = 0
+        self.missed = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+        self.max_duration = 0.
+
+    def period_seconds(self):
+        return self.period() if callable(self.period) else self.period
+
+    def summary(self):
+        mean_lateness = self.total_lateness / self.runs if self.runs > 0 else 0.
+        return (f"{self.name}: {self.runs} runs, {self.missed} missed, lateness mean {1000 * mean_lateness:.1f}ms "
+                f"max {1000 * self.max_lateness:.1f}ms, max duration {1000 * self.max_duration:.1f}ms")
+
+
+class deadline_scheduler:
+    """Runs periodic jobs on a monotonic clock, sleeping until the next deadline.
+
+    Jobs sit in a heap ordered by deadline. The next deadline of a job is its
+    previous deadline plus its period (not the time it actually ran), so
+    lateness does not accumulate into drift. If a job overruns by more than
+    a period, the missed runs are counted and skipped instead of run back to
+    back. Jobs with the same deadline run in the order they were added.
+
+    clock and sleep can be replaced, e.g. by a simulated clock that runs
+    faster than real time. on_run, if given, is called after each run with
+    the job name, its lateness and its duration.
+    """
+
+    def __init__(self, clock=time.monotonic, sleep=None, log=print, on_run=None):
+        self.clock = clock
+        self.log = log
+        self.on_run = on_run
+        self.stop_event = threading.Event()
+        # waiting on the stop event lets stop() wake the scheduler up
+        self.sleep = self.stop_event.wait if sleep is None else sleep
+        self.heap = []
+        self.sequence = itertools.count()
+        self.jobs = {}
+
+    def add_job(self, name, fn, period, delay=0.):
+        """Runs fn() every period seconds, the first time after delay seconds."""
+        job = periodic_job(name, fn, period)
+        self.jobs[name] = job
+        heapq.heappush(self.heap, (self.clock() + delay, next(self.sequence), job))
+        return job
+
+    def run_next(self):
+        """Waits for the earliest deadline, runs its job and schedules the next run."""
+        deadline, sequence, job = heapq.heappop(self.heap)
+        wait = deadline - self.clock()
+        if wait > 0:
+            self.sleep(wait)
+        if self.stop_event.is_set():
+            heapq.heappush(self.heap, (deadline, sequence, job))
+            return
+        started = self.clock()
+        lateness = max(0., started - deadline)
+        try:
+            job.fn()
+        except Exception as error:
+            self.log(f"error in scheduled job {job.name}")
+            self.log(f"{error=}")
+        ended = self.clock()
+        job.runs += 1
+        job.total_lateness += lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job.max_duration = max(job.max_duration, ended - started)
+        if self.on_run is not None:
+            self.on_run(job.name, lateness, ended - started)
+        # next deadline from the previous one, skipping the runs that are already over
+        try:
+            period = job.last_period = max(job.period_seconds(), 0.001)
+        except Exception as error:
+            period = job.FALLBACK_PERIOD_SECONDS if job.last_period is None else job.last_period
+            self.log(f"unable to get the period of scheduled job {job.name}, running it again in {period}s")
+            self.log(f"{error=}")
+        next_deadline = deadline + period
+        if next_deadline < ended:
+            missed = int((ended - next_deadline) // period) + 1
+            job.missed += missed
+            next_deadline += missed * period
+        heapq.heappush(self.heap, (next_deadline, next(self.sequence), job))
+
+    def run(self):
+        """Runs the jobs until stop() is called."""
+        while not self.stop_event.is_set() and self.heap:
+            self.run_next()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def summary(self):
+        return "scheduler stats: " + "; ".join(job.summary() for job in self.jobs.values())
+
+    def reset(self):
+        for job in self.jobs.values():
+            job.reset()
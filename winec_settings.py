@@ -0,0 +1,123 @@
+import os
+import json
+import tempfile
+import threading
+from bmp180 import bmp180
+
+
+def write_json_atomic(path, data):
+    """Writes data as json through a temporary file renamed over path.
+
+    Readers see either the old or the new file, never a half-written one.
+    Each call writes its own temporary file, so concurrent writers (backend
+    and dashboard workers) never write into or rename each other's file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            # mkstemp creates the file readable by its owner only: keep the mode of the file replaced
+            try:
+                os.fchmod(f.fileno(), os.stat(path).st_mode & 0o777)
+            except FileNotFoundError:
+                os.fchmod(f.fileno(), 0o644)
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def check_params(params, zones):
+    """Raises ValueError if params hold a value the control loop cannot run on.
+
+    Shared by the backend (on every change of settings.json) and the
+    dashboard (before saving), so that neither writes a file the other
+    rejects. Only the keys present are checked: missing ones are completed
+    with valid defaults by the backend.
+    """
+    for key in ("loop_delay_seconds", "esp_udp_refresh_delay", "sensor_timeout_seconds", "retention_interval_seconds", "db_flush_rows", "db_flush_seconds"):
+        if key in params and not (isinstance(params[key], (int, float)) and params[key] > 0):
+            raise ValueError(f"invalid {key}: {params[key]}")
+    if "ds18b20_resolution" in params and params["ds18b20_resolution"] not in (9, 10, 11, 12):
+        raise ValueError(f"invalid ds18b20_resolution: {params['ds18b20_resolution']}")
+    for zone in zones:
+        if not isinstance(params.get(zone), dict):
+            raise ValueError(f"invalid {zone} settings: {params.get(zone)}")
+        for key in ("target_temperature", "temperature_deviation", "tec_cooldown_seconds"):
+            if key in params[zone] and not isinstance(params[zone][key], (int, float)):
+                raise ValueError(f"invalid {zone} {key}: {params[zone][key]}")
+        if "bmp180_samples" in params[zone] and not (isinstance(params[zone]["bmp180_samples"], int) and params[zone]["bmp180_samples"] >= 1):
+            raise ValueError(f"invalid {zone} bmp180_samples: {params[zone]['bmp180_samples']}")
+        # the zone reads only the temperature, its burst must end before the sensor read times out
+        if "bmp180_samples" in params[zone] and "sensor_timeout_seconds" in params and bmp180.burst_seconds(params[zone]["bmp180_samples"]) > params["sensor_timeout_seconds"]:
+            raise ValueError(f"invalid {zone} bmp180_samples: {params[zone]['bmp180_samples']} readings take longer than sensor_timeout_seconds ({params['sensor_timeout_seconds']})")
+
+
+class settings_cache:
+    """Keeps settings.json parsed in memory and reloads it only when it changes.
+
+    get() costs one stat() call: the file is read again only when its
+    modification time, inode or size changed. New settings go through
+    validate (which returns the settings to use or raises) once, then replace
+    the previous ones in a single assignment. Invalid or unreadable files are
+    logged once and the previous settings are kept; error holds why, until a
+    valid file is loaded (None if the file was loaded or does not exist).
+
+    The returned dict is shared: copy it before changing it.
+    """
+
+    def __init__(self, path, validate=None, log=print):
+        self.path = path
+        self.validate = validate
+        self.log = log
+        self.lock = threading.Lock()
+        self.params = None
+        self.file_key = None
+        self.error = None
+        self.reloads = 0
+
+    def stat_key(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def get(self):
+        """Current settings, or None if none could ever be loaded."""
+        try:
+            file_key = self.stat_key()
+        except OSError:
+            self.error = None
+            return self.params
+        if file_key == self.file_key:
+            return self.params
+        with self.lock:
+            if file_key != self.file_key:
+                self.file_key = file_key
+                try:
+                    with open(self.path, "r") as f:
+                        params = json.load(f)
+                    if self.validate is not None:
+                        params = self.validate(params)
+                    self.params = params
+                    self.error = None
+                    self.reloads += 1
+                except Exception as error:
+                    self.error = error
+                    self.log(f"unable to load settings from {self.path}, keeping previous settings")
+                    self.log(f"{error=}")
+        return self.params
+
+    def save(self, params):
+        """Validates params, writes them atomically and makes them current."""
+        if self.validate is not None:
+            params = self.validate(params)
+        with self.lock:
+            write_json_atomic(self.path, params)
+            self.params = params
+            self.error = None
+            self.file_key = self.stat_key()
+        return params
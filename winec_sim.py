@@ -0,0 +1,231 @@
+import os
+import math
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+
+
+class system_clock:
+    """The real clock, with the interface of sim_clock."""
+
+    speed = 1.
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(max(0., seconds))
+
+
+class sim_clock:
+    """A clock running speed times faster than real time.
+
+    Simulated time starts at the current date. Sleeping for a simulated
+    duration takes 1/speed of it in real time, so a backend driven by this
+    clock runs its cycles faster than real time.
+    """
+
+    def __init__(self, speed=1., start=None):
+        self.speed = float(speed)
+        self.real_start = time.monotonic()
+        self.start = datetime.now() if start is None else start
+        self.start_epoch = self.start.timestamp()
+
+    def monotonic(self):
+        return (time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.start_epoch + self.monotonic()
+
+    def now(self):
+        return self.start + timedelta(seconds=self.monotonic())
+
+    def sleep(self, seconds):
+        time.sleep(max(0., seconds) / self.speed)
+
+
+class thermal_model:
+    """First-order thermal model of the zones of a cabinet and their heatsinks.
+
+    Each zone relaxes toward the ambient temperature with time constant
+    zone_tau_seconds; a running TEC moves its equilibrium tec_cooling degrees
+    below ambient. Each heatsink relaxes toward ambient with time constant
+    heatsink_tau_seconds, tec_heating degrees above it while the TEC runs.
+    The TEC state is constant between switches, so the model is advanced with
+    the exact exponential solution, whatever the time step.
+    """
+
+    def __init__(self, zones, clock, ambient=20., zone_tau_seconds=3600., tec_cooling=15., heatsink_tau_seconds=120., tec_heating=25.,
+                 noise=0.02, seed=0):
+        self.clock = clock
+        self.ambient = ambient
+        self.zone_tau_seconds = zone_tau_seconds
+        self.tec_cooling = tec_cooling
+        self.heatsink_tau_seconds = heatsink_tau_seconds
+        self.tec_heating = tec_heating
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.zones = {zone: {"temperature": ambient, "heatsink_temperature": ambient, "tec": False} for zone in zones}
+        self.last_time = clock.monotonic()
+
+    def advance(self):
+        # call with the lock held
+        now = self.clock.monotonic()
+        dt = now - self.last_time
+        self.last_time = now
+        if dt <= 0:
+            return
+        zone_decay = math.exp(-dt / self.zone_tau_seconds)
+        heatsink_decay = math.exp(-dt / self.heatsink_tau_seconds)
+        for state in self.zones.values():
+            zone_target = self.ambient - (self.tec_cooling if state["tec"] else 0.)
+            heatsink_target = self.ambient + (self.tec_heating if state["tec"] else 0.)
+            state["temperature"] = zone_target + (state["temperature"] - zone_target) * zone_decay
+            state["heatsink_temperature"] = heatsink_target + (state["heatsink_temperature"] - heatsink_target) * heatsink_decay
+
+    def set_tec(self, zone, on):
+        with self.lock:
+            self.advance()
+            self.zones[zone]["tec"] = bool(on)
+
+    def read(self, zone, key):
+        with self.lock:
+            self.advance()
+            return self.zones[zone][key] + self.random.gauss(0., self.noise)
+
+    def temperature(self, zone):
+        return self.read(zone, "temperature")
+
+    def heatsink_temperature(self, zone):
+        return self.read(zone, "heatsink_temperature")
+
+
+class fake_bmp180_smbus:
+    """SMBus stand-in emulating the registers of a BMP180.
+
+    Holds the datasheet example calibration, answers the chip id, and fills
+    the data registers when a conversion is started through the control
+    register: the raw temperature is computed back from temperature(), the
+    raw pressure is the datasheet example scaled to the oversampling mode.
+    """
+
+    CALIBRATION = (408, -72, -14383, 32741, 32757, 23153, 6190, 4, -32768, -8711, 2868)
+    RAW_PRESSURE = 23843
+
+    def __init__(self, temperature):
+        self.temperature = temperature
+        self.registers = bytearray(256)
+        self.registers[0xD0] = 0x55
+        for index, value in enumerate(self.CALIBRATION):
+            self.registers[0xAA + 2 * index:0xAC + 2 * index] = (value & 0xFFFF).to_bytes(2, "big")
+
+    def raw_temp(self, temperature):
+        # inverse of the datasheet compensation: B5 = X1 + MC * 2^11 / (X1 + MD), solved for X1
+        ac1, ac2, ac3, ac4, ac5, ac6, b1, b2, mb, mc, md = self.CALIBRATION
+        b5 = temperature * 160
+        x1 = ((b5 - md) + math.sqrt((md - b5) ** 2 - 4 * (mc * 2048 - b5 * md))) / 2
+        return min(max(int(round(x1 * 32768 / ac5 + ac6)), 0), 0xFFFF)
+
+    def write_byte_data(self, address, register, value):
+        self.registers[register] = value
+        if register != 0xF4:
+            return
+        if value == 0x2E:
+            self.registers[0xF6:0xF8] = self.raw_temp(self.temperature()).to_bytes(2, "big")
+        elif value & 0x3F == 0x34:
+            mode = value >> 6
+            self.registers[0xF6:0xF9] = ((self.RAW_PRESSURE << mode) << (8 - mode)).to_bytes(3, "big")
+
+    def read_byte_data(self, address, register):
+        return self.registers[register]
+
+    def read_i2c_block_data(self, address, register, length):
+        return list(self.registers[register:register + length])
+
+
+class fake_w1_tree:
+    """A w1 sysfs tree in a directory, for ds18b20 and ds18b20_bus.
+
+    Each probe gets a 28-<address> directory with temperature and resolution
+    attributes, and the bus master a therm_bulk_read attribute. A daemon
+    thread rewrites the temperatures in place (same inode, fixed width), so
+    descriptors kept open by ds18b20 see the new values.
+    """
+
+    def __init__(self, rootdir, probes, refresh_seconds=0.05):
+        # probes: address -> function returning the temperature
+        self.rootdir = rootdir
+        self.probes = probes
+        self.refresh_seconds = refresh_seconds
+        os.makedirs(os.path.join(rootdir, "w1_bus_master1"), exist_ok=True)
+        with open(os.path.join(rootdir, "w1_bus_master1", "therm_bulk_read"), "w") as f:
+            f.write("0\n")
+        self.fds = {}
+        for address in probes:
+            device_dir = os.path.join(rootdir, "28-" + address)
+            os.makedirs(device_dir, exist_ok=True)
+            with open(os.path.join(device_dir, "resolution"), "w") as f:
+                f.write("12\n")
+            self.fds[address] = os.open(os.path.join(device_dir, "temperature"), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.write()
+        threading.Thread(target=self.run, name="winec_sim_w1", daemon=True).start()
+
+    def write(self):
+        for address, temperature in self.probes.items():
+            # a 12 bit probe has 1/16 degree steps
+            millidegrees = int(round(temperature() * 16)) * 1000 // 16
+            os.pwrite(self.fds[address], f"{millidegrees:>9d}\n".encode("ascii"), 0)
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            self.write()
+
+
+class fake_led:
+    """gpiozero.LED stand-in switching the TEC of a zone in the thermal model."""
+
+    def __init__(self, model, zone):
+        self.model = model
+        self.zone = zone
+        self.is_lit = False
+
+    def on(self):
+        self.is_lit = True
+        self.model.set_tec(self.zone, True)
+
+    def off(self):
+        self.is_lit = False
+        self.model.set_tec(self.zone, False)
+
+
+class simulator:
+    """Simulated hardware for the backend: clock, thermal model and fake devices.
+
+    zones -- the zone names.
+    heatsink_addresses -- zone -> address of its heatsink ds18b20.
+    w1_rootdir -- where the fake w1 tree is created.
+    speed -- how much faster than real time the simulated clock runs.
+    Other keyword arguments go to thermal_model.
+    """
+
+    def __init__(self, zones, heatsink_addresses, w1_rootdir, speed=1., **model_kwargs):
+        self.clock = sim_clock(speed)
+        self.model = thermal_model(zones, self.clock, **model_kwargs)
+        self.w1_rootdir = w1_rootdir
+        self.w1 = fake_w1_tree(w1_rootdir, {address: (lambda zone=zone: self.model.heatsink_temperature(zone))
+                                            for zone, address in heatsink_addresses.items()})
+
+    def smbus(self, zone):
+        return fake_bmp180_smbus(lambda: self.model.temperature(zone))
+
+    def led(self, zone):
+        return fake_led(self.model, zone)